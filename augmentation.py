@@ -1,6 +1,9 @@
-from simplified_song import Measure, Note, Chord
-from copy import deepcopy
+from simplified_song import MAX_PITCH, Instrument, Measure, Note, Chord, NoteData
+from copy import copy, deepcopy
 from random import randint
+from typing import Callable, List, Union
+
+import numpy as np
 
 JITTER_RANGE = 10
 
@@ -25,15 +28,110 @@ def jitter(note: Note) -> None:
     note.velocity += randint(-JITTER_RANGE, JITTER_RANGE)
 
 
+# Octave shifts keep the spelling of the note and skip notes that would
+# leave octaves 1 to 9 or the midi range
 def octave_up(note: Note) -> None:
-    if int(note.name[-1]) + 1 < 10:
-        note.name = note.name[:-1] + str(int(note.name[-1]) + 1)
+    if note.octave + 1 < 10 and note.pitch + 12 <= MAX_PITCH:
+        note.transpose(12, respell=False)
 
 
 def octave_down(note: Note) -> None:
-    if int(note.name[-1]) - 1 > 0:
-        note.name = note.name[:-1] + str(int(note.name[-1]) - 1)
+    if note.octave - 1 > 0:
+        note.transpose(-12, respell=False)
 
 
 def invert_chord(chord: Chord) -> None:
     octave_down(chord.notes[-1])
+
+
+# Batch augmentations work on all notes of a part at once. Each one receives
+# the augmented data and a mask of the rows to change, and has the same
+# effect on those rows as the augmentation of a single note above.
+
+
+# Copy a field of augmented data the first time it is written, other fields
+# stay shared with the original data
+def writable(data: NoteData, original: NoteData, field: str) -> np.ndarray:
+    values = getattr(data, field)
+    if values is getattr(original, field):
+        values = values.copy()
+        setattr(data, field, values)
+    return values
+
+
+# Octave of the written pitch name, like Note.octave
+def octaves(data: NoteData) -> np.ndarray:
+    return (data.pitch - data.alter) // 12 - 1
+
+
+def batch_jitter(
+    data: NoteData, original: NoteData, rows: np.ndarray, rng: np.random.Generator
+) -> None:
+    velocity = writable(data, original, 'velocity')
+    velocity[rows] += rng.integers(
+        -JITTER_RANGE, JITTER_RANGE, size=np.count_nonzero(rows), endpoint=True
+    ).astype(velocity.dtype)
+
+
+def batch_octave_up(
+    data: NoteData, original: NoteData, rows: np.ndarray, rng: np.random.Generator
+) -> None:
+    rows = rows & (octaves(data) + 1 < 10) & (data.pitch + 12 <= MAX_PITCH)
+    writable(data, original, 'pitch')[rows] += 12
+
+
+def batch_octave_down(
+    data: NoteData, original: NoteData, rows: np.ndarray, rng: np.random.Generator
+) -> None:
+    rows = rows & (octaves(data) - 1 > 0)
+    writable(data, original, 'pitch')[rows] -= 12
+
+
+def batch_invert_chord(
+    data: NoteData, original: NoteData, rows: np.ndarray, rng: np.random.Generator
+) -> None:
+    # Only the highest note of every chord moves down
+    highest = np.zeros_like(rows)
+    highest[data.group_starts[1:][data.group_is_chord] - 1] = True
+    batch_octave_down(data, original, rows & highest, rng)
+
+
+BATCH_AUGMENTATIONS = {
+    jitter: batch_jitter,
+    octave_up: batch_octave_up,
+    octave_down: batch_octave_down,
+    invert_chord: batch_invert_chord,
+}
+
+
+def augment_part(
+    part: Instrument,
+    augmentations: Union[Callable, List[Callable]],
+    rng: Union[np.random.Generator, int] = None,
+) -> Instrument:
+    '''
+    Augment every measure of a part. With a single augmentation all measures
+    get it, with a list every measure gets one chosen at random. rng can be
+    a numpy generator or a seed for reproducible augmentations.
+
+    The part is not modified, the returned part shares every array that the
+    augmentations did not change.
+    '''
+    if callable(augmentations):
+        augmentations = [augmentations]
+    rng = np.random.default_rng(rng)
+
+    original = part.data
+    data = copy(original)
+
+    # Augmentation of every measure, repeated for every row in the measure
+    choices = rng.integers(len(augmentations), size=original.n_measures)
+    rows_per_measure = np.diff(original.group_starts[original.measure_starts])
+    row_choices = np.repeat(choices, rows_per_measure)
+
+    for i, augmentation in enumerate(augmentations):
+        rows = row_choices == i
+        if rows.any():
+            BATCH_AUGMENTATIONS[augmentation](data, original, rows, rng)
+
+    return Instrument.from_data(data, part.num_notes)
@@ -0,0 +1,292 @@
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from io import StringIO
+from random import Random
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple
+
+from augmentation import augment_part
+from generate_dataset import augmentation_list, write_part
+from simplified_song import MEASURE_CACHE, READERS, SPELLINGS, WRITERS, Instrument, Song
+
+# Times every stage of the data pipeline and of generation on midi fixtures
+# and prints the results as JSON, so runs can be compared across commits:
+#
+#   python benchmark.py --output before.json
+#   python benchmark.py midi_files/Bach/*.mid --repeat 5
+
+STAGES = ("parse", "serialize", "pack", "augment", "to_midi", "sanitize", "generate")
+# Stages that format measures. Every run starts with an empty MEASURE_CACHE,
+# their warm_seconds are timed again with the measures of the last run cached.
+CACHED_STAGES = ("serialize", "pack")
+REPEAT = 3
+SEED = 0
+READER = "music21"
+WRITER = "mido"
+# Synthetic fixture used when no midi files are given
+SYNTHETIC_MEASURES = 100
+SYNTHETIC_PARTS = 2
+# Generation with a tiny randomly initialized GPT-2, so no trained model or
+# GPU is needed
+GENERATE_TOKENS = 512
+# The tokenizer ships with the repo, found next to this file so that the
+# benchmark can be run from any directory
+TOKENIZER_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "music-gpt2-tokenizer"
+)
+
+# Result of a single run of a stage: (number of notes, number of rows)
+Counts = Tuple[int, int]
+
+
+def synthetic_part(rng: Random, n_measures: int) -> List[str]:
+    """Words of a random part with notes and chords in 3/4 and 4/4."""
+    words = []
+    for _ in range(n_measures):
+        numerator = rng.choice((3, 4))
+        words.append(f"{numerator}/4")
+        offset = 0.0
+        while offset < numerator:
+            # One note or a chord of up to four notes at every offset
+            for _ in range(rng.choice((1, 1, 1, 2, 3, 4))):
+                pitch = rng.choice(SPELLINGS) + str(rng.randint(2, 6))
+                duration = rng.choice((0.25, 0.5, 1.0))
+                words += [pitch, str(duration), str(offset), str(rng.randint(40, 110))]
+            offset += rng.choice((0.25, 0.5, 1.0))
+    # The last measure is only read when a time signature follows it
+    return words + ["4/4"]
+
+
+def write_synthetic_midi(path: str, seed: int = SEED) -> None:
+    rng = Random(seed)
+    song = Song(string_list=synthetic_part(rng, SYNTHETIC_MEASURES))
+    song.parts += [
+        Song(string_list=synthetic_part(rng, SYNTHETIC_MEASURES)).parts[0]
+        for _ in range(SYNTHETIC_PARTS - 1)
+    ]
+    # Written by Music21 so the fixture stays the same across commits
+    song.to_midi(path, writer="music21")
+
+
+def peak_rss_mb() -> float:
+    """Peak memory of the process so far, not of the last stage alone."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def time_runs(run: Callable[[], Counts], repeat: int, cold: bool) -> Tuple[List[float], Counts]:
+    """Times of repeat runs, cold ones start with an empty MEASURE_CACHE."""
+    times = []
+    for _ in range(repeat):
+        if cold:
+            MEASURE_CACHE.clear()
+        start = perf_counter()
+        # The parts print their progress, which is not part of the benchmark
+        with redirect_stdout(StringIO()):
+            counts = run()
+        times.append(perf_counter() - start)
+    return times, counts
+
+
+def time_stage(run: Callable[[], Counts], repeat: int, warm: bool = False) -> Dict[str, float]:
+    """
+    Best time of repeat cold runs, with notes/s and rows/s at that time. With
+    warm, also the best time of runs reusing the measures cached by the
+    previous one.
+    """
+    times, (n_notes, n_rows) = time_runs(run, repeat, cold=True)
+    best = min(times)
+    result = {
+        "seconds": best,
+        "mean_seconds": sum(times) / len(times),
+        "notes": n_notes,
+        "notes_per_s": n_notes / best,
+    }
+    if n_rows is not None:
+        result["rows"] = n_rows
+        result["rows_per_s"] = n_rows / best
+    if warm:
+        result["warm_seconds"] = min(time_runs(run, repeat, cold=False)[0])
+    # ru_maxrss only grows, so this includes every stage run before
+    result["cumulative_peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def count_notes(words: List[str]) -> int:
+    return sum(1 for word in words if "/" not in word) // 4
+
+
+def generate_stage(n_tokens: int, seed: int) -> Callable[[], Counts]:
+    import torch
+    from transformers import GPT2TokenizerFast
+
+    from generate_music import GenerationSession, random_prompt, tiny_model
+    from note_grammar import NoteGrammar
+
+    tokenizer = GPT2TokenizerFast.from_pretrained(TOKENIZER_PATH)
+    torch.manual_seed(seed)
+    model = tiny_model(tokenizer)
+    grammar = NoteGrammar(tokenizer)
+
+    # Rows are generated tokens
+    def run() -> Counts:
+        session = GenerationSession(model, tokenizer, seed=seed, grammar=grammar)
+        words = []
+        for valid in session.feed(random_prompt(Random(seed))):
+            words += valid
+        # A random model ends songs early, so it is prompted again
+        while session.n_generated < n_tokens:
+            before = session.n_generated
+            for valid in session.generate(n_tokens - session.n_generated):
+                words += valid
+            if session.n_generated == before:
+                for valid in session.feed(" " + random_prompt(Random(seed))):
+                    words += valid
+        for valid in session.flush():
+            words += valid
+        return count_notes(words), session.n_generated
+
+    return run
+
+
+def main(
+    paths: List[str],
+    stages: List[str] = STAGES,
+    repeat: int = REPEAT,
+    reader: str = READER,
+    n_tokens: int = GENERATE_TOKENS,
+    seed: int = SEED,
+    writer: str = WRITER,
+) -> Dict:
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "reader": reader,
+        "writer": writer,
+        "repeat": repeat,
+        "stages": {},
+    }
+
+    with TemporaryDirectory() as tmp:
+        if not paths:
+            paths = [os.path.join(tmp, "synthetic.mid")]
+            with redirect_stdout(StringIO()):
+                write_synthetic_midi(paths[0], seed)
+        results["fixtures"] = [os.path.basename(path) for path in paths]
+
+        with redirect_stdout(StringIO()):
+            songs = [Song(path=path, reader=reader) for path in paths]
+        songs = [song for song in songs if song.parsed]
+        if not songs:
+            raise Exception("None of the midi files could be parsed.")
+        parts: List[Instrument] = [part for song in songs for part in song.parts]
+        # Notes of chords count one by one, unlike Song.num_notes
+        n_notes = sum(part.data.n_notes for part in parts)
+        n_measures = sum(len(part.measures) for part in parts)
+        # Model output as long as the fixtures, with a broken note at the end
+        text = " ".join(part.as_string() for part in parts) + " C4 1.0"
+
+        def parse() -> Counts:
+            for path in paths:
+                Song(path=path, reader=reader)
+            return n_notes, None
+
+        def serialize() -> Counts:
+            for part in parts:
+                for measure in part.measures:
+                    measure.as_string(tokenize=True)
+            return n_notes, n_measures
+
+        def pack() -> Counts:
+            n_rows = 0
+            for part in parts:
+                n_rows += write_part(part.measures, StringIO())[1]
+            return n_notes, n_rows
+
+        def augment() -> Counts:
+            for part in parts:
+                augment_part(part, augmentation_list, seed)
+            return n_notes, n_measures
+
+        def to_midi() -> Counts:
+            for song in songs:
+                song.to_midi(os.path.join(tmp, "out.mid"), writer=writer)
+            return n_notes, None
+
+        def sanitize() -> Counts:
+            return count_notes(Instrument.sanitize(text)[0]), None
+
+        runs: Dict[str, Callable[[], Counts]] = {
+            "parse": parse,
+            "serialize": serialize,
+            "pack": pack,
+            "augment": augment,
+            "to_midi": to_midi,
+            "sanitize": sanitize,
+        }
+
+        for stage in stages:
+            if stage == "generate":
+                try:
+                    runs[stage] = generate_stage(n_tokens, seed)
+                except ImportError as e:
+                    # Generation needs torch and transformers, any other
+                    # failure is an error of the benchmark
+                    results["stages"][stage] = {"skipped": str(e)}
+                    continue
+            print(f"Benchmarking {stage}", file=sys.stderr)
+            results["stages"][stage] = time_stage(
+                runs[stage], repeat, warm=stage in CACHED_STAGES
+            )
+
+    results["peak_rss_mb"] = peak_rss_mb()
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark parsing, packing and generation.")
+    parser.add_argument("paths", nargs="*", help="Midi files, synthetic by default")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--reader", choices=READERS, default=READER)
+    parser.add_argument("--writer", choices=WRITERS, default=WRITER)
+    parser.add_argument("--tokens", type=int, default=GENERATE_TOKENS)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--output", help="Also write the JSON to this file")
+    args = parser.parse_args()
+
+    results = main(
+        args.paths,
+        args.stages,
+        args.repeat,
+        args.reader,
+        args.tokens,
+        args.seed,
+        args.writer,
+    )
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
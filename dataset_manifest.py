@@ -0,0 +1,127 @@
+import json
+import os
+from hashlib import sha256
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+BUILD_DIR = "./dataset_build"
+MANIFEST_FILE = "manifest.json"
+ROWS_DIR = "rows"
+# Bump whenever the rows of a song change for the same settings, so that
+# every song is processed again
+MANIFEST_VERSION = 2
+
+# (row, number of notes) of every row of a single written part
+PartRows = Iterable[Tuple[str, int]]
+
+
+def file_hash(path: str) -> str:
+    digest = sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_settings(path: str = BUILD_DIR) -> Optional[dict]:
+    """Settings of the last build in path, None if there is none."""
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)["settings"]
+
+
+class DatasetManifest:
+    """
+    Manifest of an incremental dataset build. Every source file has an entry
+    with its content hash, seed, transposition and the number of notes of
+    every row of its parts. The rows of every song are kept in their own file in the build
+    directory, so the dataset can be assembled again without parsing songs
+    whose files did not change.
+
+    Entries are only valid for the settings they were built with, when the
+    settings change every song is processed again.
+    """
+
+    def __init__(self, path: str = BUILD_DIR, settings: dict = None) -> None:
+        self.path = path
+        self.settings = {"version": MANIFEST_VERSION, **(settings or {})}
+        os.makedirs(os.path.join(path, ROWS_DIR), exist_ok=True)
+
+        self.entries: Dict[str, dict] = {}
+        previous = load_settings(path)
+        if previous == self.settings:
+            with open(os.path.join(path, MANIFEST_FILE)) as f:
+                self.entries = json.load(f)["entries"]
+        elif previous is not None:
+            print(f"Settings of the build in {path} changed, rebuilding every song")
+
+    def rows_path(self, digest: str) -> str:
+        return os.path.join(self.path, ROWS_DIR, digest + ".txt")
+
+    def is_current(self, name: str, digest: str) -> bool:
+        entry = self.entries.get(name)
+        if entry is None or entry["hash"] != digest:
+            return False
+        # Songs that failed have no rows, unchanged they fail again
+        return entry["failure"] is not None or os.path.exists(self.rows_path(digest))
+
+    def update(
+        self,
+        name: str,
+        digest: str,
+        seed: int,
+        transpose: int,
+        written: Optional[Iterable[PartRows]],
+        failure: str = None,
+    ) -> None:
+        # Rows are written one at a time as they come
+        parts = []
+        if written is not None:
+            rows_path = self.rows_path(digest)
+            with open(rows_path + ".tmp", "w") as f:
+                for rows in written:
+                    parts.append([])
+                    for row, notes in rows:
+                        f.write(row + "\n")
+                        parts[-1].append(notes)
+            os.replace(rows_path + ".tmp", rows_path)
+
+        self.entries[name] = {
+            "hash": digest,
+            "seed": seed,
+            "transpose": transpose,
+            "parts": parts,
+            "failure": failure if written is None else None,
+        }
+
+    def read(self, name: str) -> Optional[Iterator[PartRows]]:
+        """
+        Rows of every part of a song, None if it failed. Rows are read from
+        the file as they are iterated, so parts have to be read in order.
+        """
+        entry = self.entries[name]
+        if entry["failure"] is not None:
+            return None
+        return self.read_rows(entry)
+
+    def read_rows(self, entry: dict) -> Iterator[PartRows]:
+        with open(self.rows_path(entry["hash"])) as f:
+            for notes in entry["parts"]:
+                yield ((f.readline()[:-1], n) for n in notes)
+
+    def prune(self, names: List[str]) -> None:
+        """Remove entries of files that are gone, and rows nothing refers to."""
+        names = set(names)
+        self.entries = {n: e for n, e in self.entries.items() if n in names}
+        digests = {entry["hash"] for entry in self.entries.values()}
+        rows_dir = os.path.join(self.path, ROWS_DIR)
+        for file in os.listdir(rows_dir):
+            if file[: -len(".txt")] not in digests:
+                os.remove(os.path.join(rows_dir, file))
+
+    def save(self) -> None:
+        manifest_path = os.path.join(self.path, MANIFEST_FILE)
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump({"settings": self.settings, "entries": self.entries}, f, indent=1)
+        os.replace(manifest_path + ".tmp", manifest_path)
@@ -0,0 +1,186 @@
+import json
+import os
+from typing import Dict, Iterator, List
+
+import numpy as np
+
+TOKENIZER_PATH = "./music-gpt2-tokenizer"
+SHARD_DIR = "./dataset_shards"
+# Upper bound for the size of a single shard file
+MAX_SHARD_BYTES = 256 * 1024**2
+# Token ids of the music tokenizer fit in 16 bits
+TOKEN_DTYPE = np.uint16
+INDEX_FILE = "index.json"
+
+
+def load_tokenizer(path: str = TOKENIZER_PATH):
+    # Imported here so that reading shards does not need transformers
+    from transformers import GPT2TokenizerFast
+
+    return GPT2TokenizerFast.from_pretrained(path)
+
+
+def shard_paths(path: str, shard: int):
+    """Paths of the token file and the row offsets of a shard."""
+    name = os.path.join(path, f"shard_{shard:05d}")
+    return name + ".bin", name + ".idx.npy"
+
+
+class ShardWriter:
+    """
+    Writes dataset rows as token ids into size-bounded binary shards. Every
+    shard is a flat .bin file of tokens with a .idx.npy file holding the
+    offset of every row, so row i is tokens[offsets[i] : offsets[i + 1]].
+
+    Used like the text dataset file: write() takes newline terminated rows,
+    which are tokenized and appended to the current shard right away. Only
+    the row offsets of the current shard are kept in memory.
+    """
+
+    def __init__(
+        self,
+        path: str = SHARD_DIR,
+        tokenizer=None,
+        max_bytes: int = MAX_SHARD_BYTES,
+    ) -> None:
+        self.path = path
+        self.tokenizer = tokenizer if tokenizer is not None else load_tokenizer()
+        self.max_bytes = max_bytes
+        if len(self.tokenizer) > np.iinfo(TOKEN_DTYPE).max + 1:
+            raise Exception(
+                f"Tokenizer with {len(self.tokenizer)} tokens does not fit {TOKEN_DTYPE.__name__}"
+            )
+
+        os.makedirs(path, exist_ok=True)
+        # Remove shards of a previous run so the index matches the files
+        for name in os.listdir(path):
+            if name.startswith("shard_") or name == INDEX_FILE:
+                os.remove(os.path.join(path, name))
+
+        self.shards: List[Dict[str, int]] = []
+        self.file = None
+        self.offsets: List[int] = []
+        # Start of a row that has not been terminated by a newline yet
+        self.pending = ""
+
+    def __enter__(self) -> "ShardWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def write(self, text: str) -> None:
+        lines = (self.pending + text).split("\n")
+        self.pending = lines.pop()
+        lines = [line for line in lines if line]
+        if not lines:
+            return
+
+        # The same tokenization as the training notebook, batched per call.
+        # Rows are kept whole like in the text dataset, readers cut or pack
+        # them to the context
+        ids = self.tokenizer(lines)["input_ids"]
+        for row in ids:
+            self.write_ids(np.asarray(row, dtype=TOKEN_DTYPE))
+
+    def write_ids(self, row: np.ndarray) -> None:
+        size = self.offsets[-1] * row.itemsize if self.file else 0
+        if self.file is None or (
+            size + row.nbytes > self.max_bytes and len(self.offsets) > 1
+        ):
+            self.next_shard()
+        row.tofile(self.file)
+        self.offsets.append(self.offsets[-1] + len(row))
+
+    def next_shard(self) -> None:
+        self.close_shard()
+        tokens_path, _ = shard_paths(self.path, len(self.shards))
+        self.file = open(tokens_path, "wb")
+        self.offsets = [0]
+
+    def close_shard(self) -> None:
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+
+        _, offsets_path = shard_paths(self.path, len(self.shards))
+        np.save(offsets_path, np.array(self.offsets, dtype=np.int64))
+        self.shards.append(
+            {"rows": len(self.offsets) - 1, "tokens": self.offsets[-1]}
+        )
+
+    def close(self) -> None:
+        if self.pending:
+            self.write("\n")
+        self.close_shard()
+
+        index = {
+            "dtype": np.dtype(TOKEN_DTYPE).name,
+            "vocab_size": len(self.tokenizer),
+            "eos_token_id": self.tokenizer.eos_token_id,
+            "shards": self.shards,
+        }
+        with open(os.path.join(self.path, INDEX_FILE), "w") as f:
+            json.dump(index, f, indent=2)
+
+        n_rows = sum(shard["rows"] for shard in self.shards)
+        n_tokens = sum(shard["tokens"] for shard in self.shards)
+        print(
+            f"Wrote {n_rows} rows with {n_tokens} tokens to {len(self.shards)} shards in {self.path}"
+        )
+
+
+class ShardDataset:
+    """
+    Rows of dataset shards, memory mapped. Rows are returned as views of the
+    mapped files, nothing is copied or read before a row is used. Items have
+    the input_ids of a row, cut to max_length tokens when it is set like the
+    truncating tokenization of the notebook, so the dataset can be given to a
+    Trainer as is.
+    """
+
+    def __init__(self, path: str = SHARD_DIR, max_length: int = None) -> None:
+        self.max_length = max_length
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+
+        self.tokens: List[np.ndarray] = []
+        self.offsets: List[np.ndarray] = []
+        for shard, info in enumerate(self.index["shards"]):
+            tokens_path, offsets_path = shard_paths(path, shard)
+            if info["tokens"]:
+                tokens = np.memmap(tokens_path, dtype=self.index["dtype"], mode="r")
+            else:
+                # Empty files can not be memory mapped
+                tokens = np.empty(0, dtype=self.index["dtype"])
+            self.tokens.append(tokens)
+            self.offsets.append(np.load(offsets_path, mmap_mode="r"))
+
+        # First row of every shard, to find the shard of a row
+        self.starts = np.cumsum([0] + [info["rows"] for info in self.index["shards"]])
+
+    def __len__(self) -> int:
+        return int(self.starts[-1])
+
+    def row(self, i: int) -> np.ndarray:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"Row {i} out of range for {len(self)} rows")
+        shard = int(np.searchsorted(self.starts, i, side="right")) - 1
+        offsets = self.offsets[shard]
+        i -= self.starts[shard]
+        return self.tokens[shard][offsets[i] : offsets[i + 1]]
+
+    def __getitem__(self, i: int) -> Dict[str, np.ndarray]:
+        return {"input_ids": self.row(i)[: self.max_length]}
+
+    def __iter__(self) -> Iterator[Dict[str, np.ndarray]]:
+        for i in range(len(self)):
+            yield self[i]
+
+    # Text of a row with the BPE tokenizer, an Instrument with a NoteTokenizer
+    def decode(self, i: int, tokenizer=None):
+        tokenizer = tokenizer if tokenizer is not None else load_tokenizer()
+        return tokenizer.decode(self.row(i))
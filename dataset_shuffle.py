@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+from random import Random
+from typing import List
+
+# Global shuffle of dataset rows in bounded memory. Rows are written to the
+# shuffler as they are generated and scattered into bucket files at random.
+# When the dataset is complete every bucket is read back, shuffled and
+# written out, one bucket at a time:
+#
+#   rows -> bucket 0 .. bucket n - 1 (temporary files) -> output
+#
+# A row lands in any bucket with the same probability and buckets are
+# shuffled uniformly, so every order of the rows is equally likely. Only a
+# bucket is held in memory, one larger than max_bytes is split the same way
+# again, so the dataset can be much larger than memory.
+
+SHUFFLE_BUCKETS = 64
+# Largest bucket shuffled in memory
+MAX_BUCKET_BYTES = 256 * 1024**2
+# Temporary buckets go here, the system temporary directory when None
+SHUFFLE_DIR = None
+
+
+class RowShuffler:
+    """
+    Writes newline terminated rows to output in a random order. Used like
+    the output it wraps: write() takes rows as they come, and the shuffled
+    rows are written to output when the shuffler is closed.
+    """
+
+    def __init__(
+        self,
+        output,
+        seed: int,
+        n_buckets: int = SHUFFLE_BUCKETS,
+        max_bytes: int = MAX_BUCKET_BYTES,
+        tmp_dir: str = SHUFFLE_DIR,
+    ) -> None:
+        self.output = output
+        self.rng = Random(seed)
+        self.n_buckets = n_buckets
+        self.max_bytes = max_bytes
+        self.path = tempfile.mkdtemp(prefix="shuffle_", dir=tmp_dir)
+        self.buckets = open_buckets(self.path, n_buckets)
+        # Start of a row that has not been terminated by a newline yet
+        self.pending = ""
+        self.n_rows = 0
+
+    def __enter__(self) -> "RowShuffler":
+        return self
+
+    def __exit__(self, *args) -> None:
+        try:
+            # Rows of a failed run are dropped, not shuffled
+            self.close(write=args[0] is None)
+        finally:
+            self.output.__exit__(*args)
+
+    def write(self, text: str) -> None:
+        lines = (self.pending + text).split("\n")
+        self.pending = lines.pop()
+        for line in lines:
+            if line:
+                self.buckets[self.rng.randrange(self.n_buckets)].write(line + "\n")
+                self.n_rows += 1
+
+    def close(self, write: bool = True) -> None:
+        """Write the shuffled rows to output, which is left open."""
+        if self.buckets is None:
+            return
+        if self.pending:
+            self.write("\n")
+        for bucket in self.buckets:
+            bucket.close()
+        try:
+            if write:
+                for bucket in self.buckets:
+                    self.shuffle_bucket(bucket.name)
+                print(f"Shuffled {self.n_rows} rows")
+        finally:
+            self.buckets = None
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def shuffle_bucket(self, path: str) -> None:
+        size = os.path.getsize(path)
+        with open(path, "r") as f:
+            first_row = f.readline()
+        # A single row can not be split further
+        if size <= self.max_bytes or len(first_row) >= size:
+            with open(path, "r") as f:
+                rows = f.readlines()
+            self.rng.shuffle(rows)
+            self.output.write("".join(rows))
+            return
+
+        # Too large for memory, scatter it into smaller buckets first
+        sub_path = tempfile.mkdtemp(prefix="bucket_", dir=self.path)
+        buckets = open_buckets(sub_path, self.n_buckets)
+        with open(path, "r") as f:
+            for row in f:
+                buckets[self.rng.randrange(self.n_buckets)].write(row)
+        for bucket in buckets:
+            bucket.close()
+        os.remove(path)
+        for bucket in buckets:
+            self.shuffle_bucket(bucket.name)
+        shutil.rmtree(sub_path, ignore_errors=True)
+
+
+def open_buckets(path: str, n_buckets: int) -> List:
+    return [open(os.path.join(path, f"bucket_{i:04d}.txt"), "w") for i in range(n_buckets)]
@@ -1,50 +1,120 @@
+from collections import deque
 from io import TextIOWrapper
-from augmentation import augment, jitter, octave_down, octave_up, invert_chord
-from simplified_song import Song, Measure
-from typing import List
+from itertools import chain
+from time import perf_counter
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from augmentation import augment_part, jitter, octave_down, octave_up, invert_chord
+from dataset_manifest import BUILD_DIR, DatasetManifest, PartRows, file_hash, load_settings
+from dataset_shards import SHARD_DIR, ShardWriter
+from dataset_shuffle import SHUFFLE_DIR, RowShuffler
+from metrics import METRICS_FORMATS, Metrics, profile
+from note_tokenizer import NoteTokenizer
+from simplified_song import READERS, Instrument, Song, Measure
+from song_cache import CACHE_DIR, SongCache
+from typing import Iterable, Iterator, List, Optional, Tuple
 from glob import glob
-from random import shuffle, randint, choice
+from hashlib import sha256
+from random import Random
+
+import numpy as np
 
 MAX_SEQ = 512
 MIN_SEQ = 256
 MAX_N_ROWS = 30000
 
+# Number of processes used to parse songs. 1 keeps everything in-process.
+N_WORKERS = 1
+# Seed for shuffling, transposition, sequence lengths and augmentations. When
+# None a seed is drawn at random and printed so the run can be reproduced.
+SEED = None
+# Midi reader used to parse songs, see simplified_song.READERS
+READER = "music21"
+
 MIDI_FILES_PATH = "./midi_files"
 OUTPUT_FILE_PATH = f"dataset_{MAX_SEQ}.txt"
+# "text" writes OUTPUT_FILE_PATH, "shards" writes tokenized binary shards to
+# SHARD_DIR that training can memory map, see dataset_shards.py
+OUTPUT_FORMAT = "text"
+OUTPUT_FORMATS = ("text", "shards")
+# Tokenizer of the shards, "bpe" is music-gpt2-tokenizer and "notes" the fixed
+# vocabulary of note_tokenizer.py
+TOKENIZER = "bpe"
+TOKENIZERS = ("bpe", "notes")
+# Shuffle the rows of the whole dataset, else the rows of a song and of its
+# augmentations are written next to each other, see dataset_shuffle.py. Off by
+# default so the output keeps its order, enable it with --shuffle
+SHUFFLE = False
+# Stage timings and failures are written here when set, see metrics.py
+METRICS_PATH = None
+METRICS_FORMAT = "jsonl"
 
 augmentation_list = [jitter, octave_down, octave_up, invert_chord]
 
 
-def write_row(
-    measures: List[Measure], ptr: int, file: TextIOWrapper, seq_len=MAX_SEQ
-) -> int:
-    seq = measures[ptr].as_string(tokenize=True)
-    n_notes = measures[ptr].num_notes
+def pack_rows(
+    measures: List[Measure], step=1, seq_len=MAX_SEQ, overlap: int = None
+) -> Iterator[Tuple[str, int]]:
+    """
+    Yield (row, number of notes) for windows of consecutive measures with
+    less than seq_len tokens. A window always holds its first measure and
+    grows while the next measure fits.
+
+    Each measure is serialized once, from the measure cache when an equal
+    measure was seen before, when the window reaches it. Only the measures
+    of the current window are kept, with their token and note counts. Windows
+    start every step measures, or if overlap is set, overlap measures before
+    the end of the previous window.
+    """
+    # (number of tokens, number of notes, text) of the measures start to end
+    window = deque()
+    n_tokens = 0
+    n_notes = 0
+    # Serialization of the measure at end, when it did not fit the window
+    following = None
 
-    ptr += 1
-    next_seq = None
+    start = 0
+    end = 0
+    while start < len(measures):
+        while end < len(measures):
+            tokens, text = following or measures[end].serialized()
+            following = None
+            if window and n_tokens + len(tokens) >= seq_len:
+                following = tokens, text
+                break
+            window.append((len(tokens), measures[end].num_notes, text))
+            n_tokens += len(tokens)
+            n_notes += measures[end].num_notes
+            end += 1
 
-    while ptr < len(measures):
-        next_seq = measures[ptr].as_string(tokenize=True)
+        yield " ".join(text for _, _, text in window), n_notes
 
-        if len(seq) + len(next_seq) < seq_len:
-            seq += next_seq
-            n_notes += measures[ptr].num_notes
+        if overlap is None:
+            start += step
         else:
-            break
-        ptr += 1
-
-    file.write(" ".join(seq) + "\n")
-    return n_notes
+            start = max(start + 1, end - overlap)
+        # The end of the window never moves back when its start moves forward
+        while window and end - len(window) < start:
+            tokens, notes, _ = window.popleft()
+            n_tokens -= tokens
+            n_notes -= notes
+        if end < start:
+            end = start
+            following = None
 
 
 def write_part(
-    measures: List[Measure], file: TextIOWrapper, step=1, seq_len=MAX_SEQ
+    measures: List[Measure],
+    file: TextIOWrapper,
+    step=1,
+    seq_len=MAX_SEQ,
+    overlap: int = None,
 ) -> int:
     n_notes = 0
     n_rows = 0
-    for i in range(0, len(measures), step):
-        n_notes += write_row(measures, i, file, seq_len)
+    for row, notes in pack_rows(measures, step, seq_len, overlap):
+        file.write(row + "\n")
+        n_notes += notes
         n_rows += 1
 
     print(f"Wrote part with {n_notes} notes to {n_rows} rows")
@@ -60,45 +130,369 @@ def should_break(n_rows: int, n_notes: int) -> bool:
     return False
 
 
-def main():
+def get_file_names() -> List[str]:
     bach = list(glob(MIDI_FILES_PATH + "/Bach/*.mid", recursive=True))
     bach = [f for f in bach if "Bach, Johann Sebastian" in f]
     ghibli = list(glob(MIDI_FILES_PATH + "/ghibli_dataset/*.mid", recursive=True))
 
-    file_names = ghibli + bach
-    shuffle(file_names)
+    # Sort so that the shuffle only depends on the seed, not on the file system
+    return sorted(ghibli + bach)
+
 
+def draw_transpose(rng: Random) -> int:
+    """Semitones a song is transposed by, the first draw of its seed."""
+    return rng.randint(1, 11)
+
+
+def part_rows(measures: List[Measure], seq_len: int, metrics: Metrics) -> PartRows:
+    """Rows of a part with their number of notes, yielded as they are packed."""
+    rows = pack_rows(measures, seq_len=seq_len)
     n_notes = 0
     n_rows = 0
-    with open(OUTPUT_FILE_PATH, "w") as f_ptr:
-        for i, name in enumerate(file_names):
-            song = Song(path=name, transpose=randint(1, 11))
-
-            if song.parsed:
-                print(f"Song {i+1}/{len(file_names)}. Rows written: {n_rows}")
-                for part in song.parts:
-                    if should_break(n_rows, n_notes):
-                        return
-                    notes, rows = write_part(
-                        part.measures, f_ptr, seq_len=randint(MIN_SEQ, MAX_SEQ)
-                    )
-                    n_notes += notes
-                    n_rows += rows
-
-                    augmented = [
-                        augment(m, choice(augmentation_list)) for m in part.measures
-                    ]
-                    if should_break(n_rows, n_notes):
-                        return
-                    notes, rows = write_part(
-                        augmented, f_ptr, seq_len=randint(MIN_SEQ, MAX_SEQ)
-                    )
-                    n_notes += notes
-                    n_rows += rows
+    seconds = 0.0
+    while True:
+        start = perf_counter()
+        row = next(rows, None)
+        seconds += perf_counter() - start
+        if row is None:
+            break
+        n_notes += row[1]
+        n_rows += 1
+        yield row
+    metrics.observe("write", seconds)
+    print(f"Wrote part with {n_notes} notes to {n_rows} rows")
+
+
+def song_rows(
+    name: str,
+    parts: Iterator[Instrument],
+    rng: Random,
+    augmentation_rng: np.random.Generator,
+    metrics: Metrics,
+) -> Iterator[PartRows]:
+    """
+    Rows of every part followed by its augmented copy, one part at a time.
+    Parts are read as they are reached and rows yielded as they are packed,
+    so only the current part, its augmentation and the window of rows being
+    packed are in memory. A part that can not be read ends the song.
+    """
+    while True:
+        try:
+            part = next(parts, None)
+        except Exception as e:
+            metrics.failure(name, f"{type(e).__name__}: {e}")
+            return
+        if part is None:
+            return
+        metrics.count("notes", part.num_notes)
+        with metrics.timer("augment"):
+            augmented = augment_part(part, augmentation_list, augmentation_rng)
+        for measures in (part.measures, augmented.measures):
+            yield part_rows(measures, rng.randint(MIN_SEQ, MAX_SEQ), metrics)
+
+
+def process_song(
+    job: Tuple[str, int, Optional[str], str], lazy: bool = False
+) -> Tuple[Optional[Iterable[PartRows]], Metrics]:
+    """
+    Parse, transpose, augment and serialize a single song. Returns the rows
+    of every part followed by its augmented copy, or None if the song could
+    not be parsed, and the metrics of the song. All randomness comes from the
+    song seed so the result does not depend on which process handles the
+    song.
+
+    When lazy, parts are read through Song.iter_parts and their rows packed
+    while they are written, so memory grows with the largest part and the
+    row window, not with the song. Otherwise the rows are returned as lists,
+    to be sent back from a worker process.
+    """
+    name, song_seed, cache_dir, reader = job
+    rng = Random(song_seed)
+    augmentation_rng = np.random.default_rng(song_seed)
+    metrics = Metrics()
+    metrics.start_file(name)
+
+    cache = SongCache(cache_dir) if cache_dir else None
+    parts = Song.iter_parts(name, draw_transpose(rng), reader, cache, metrics)
+    try:
+        # The file is read before its first part, a song that can not be
+        # read is skipped whole
+        first = next(parts, None)
+    except Exception as e:
+        print(f"Failed to load song with path: {name}, exception: {e}.")
+        metrics.failure(name, f"{type(e).__name__}: {e}")
+        return None, metrics
+    metrics.count("songs")
+
+    parts = chain([first], parts) if first is not None else iter(())
+    written = song_rows(name, parts, rng, augmentation_rng, metrics)
+    return (written if lazy else [list(rows) for rows in written]), metrics
+
+
+def process_songs(
+    jobs: List[Tuple[str, int, Optional[str], str]], n_workers: int
+) -> Iterator[Tuple[Optional[Iterable[PartRows]], Metrics]]:
+    """
+    Yield processed songs in the order of jobs. In a single process the rows
+    of a song are generated while they are consumed.
+    """
+    if n_workers <= 1:
+        for job in jobs:
+            yield process_song(job, lazy=True)
+        return
+
+    with Pool(n_workers) as pool:
+        # imap keeps the job order, which keeps the output deterministic
+        yield from pool.imap(process_song, jobs)
+
+
+def open_output(
+    output_format: str,
+    shard_dir: str,
+    tokenizer: str,
+    shuffle_seed: Optional[int] = None,
+    shuffle_dir: Optional[str] = SHUFFLE_DIR,
+):
+    """Output of the dataset, its rows are shuffled when shuffle_seed is set."""
+    if output_format == "shards":
+        output = ShardWriter(shard_dir, NoteTokenizer() if tokenizer == "notes" else None)
+    else:
+        output = open(OUTPUT_FILE_PATH, "w")
+    if shuffle_seed is None:
+        return output
+    return RowShuffler(output, shuffle_seed, tmp_dir=shuffle_dir)
+
+
+def write_songs(
+    f_ptr, songs: Iterator[Tuple[str, Optional[Iterable[PartRows]]]], n_songs: int, metrics: Metrics
+) -> None:
+    """Write the rows of (name, rows) songs until the dataset is full."""
+    n_notes = 0
+    n_rows = 0
+    for i, (name, written) in enumerate(songs):
+        if written is None:
+            continue
+
+        print(f"Song {i+1}/{n_songs}. Rows written: {n_rows}")
+        metrics.start_file(name)
+        for rows in written:
+            if should_break(n_rows, n_notes):
+                return
+            for row, notes in rows:
+                with metrics.timer("output"):
+                    f_ptr.write(row + "\n")
+                n_notes += notes
+                n_rows += 1
     print(
         f"Dataset generation complete. Total number of notes:{n_notes}, total rows: {n_rows}"
     )
 
 
+def write_metrics(metrics: Metrics, metrics_path: Optional[str], metrics_format: str):
+    if metrics_path:
+        metrics.write(metrics_path, metrics_format)
+        for seconds, name in metrics.slowest(5):
+            print(f"{seconds:.2f}s {name}")
+
+
+def main(
+    n_workers: int = N_WORKERS,
+    seed: Optional[int] = SEED,
+    cache_dir: Optional[str] = CACHE_DIR,
+    reader: str = READER,
+    output_format: str = OUTPUT_FORMAT,
+    shard_dir: str = SHARD_DIR,
+    tokenizer: str = TOKENIZER,
+    metrics_path: Optional[str] = METRICS_PATH,
+    metrics_format: str = METRICS_FORMAT,
+    shuffle: bool = SHUFFLE,
+    shuffle_dir: Optional[str] = SHUFFLE_DIR,
+):
+    if seed is None:
+        seed = Random().randint(0, 2**32 - 1)
+    print(f"Generating dataset with seed {seed} and {n_workers} worker(s)")
+
+    rng = Random(seed)
+    file_names = get_file_names()
+    rng.shuffle(file_names)
+    jobs = [(name, rng.getrandbits(32), cache_dir, reader) for name in file_names]
+    # Drawn after the jobs, which keeps the rows of a seed the same
+    shuffle_seed = rng.getrandbits(32) if shuffle else None
+
+    metrics = Metrics()
+
+    def processed() -> Iterator[Tuple[str, Optional[Iterable[PartRows]]]]:
+        for job, (written, song_metrics) in zip(jobs, process_songs(jobs, n_workers)):
+            try:
+                yield job[0], written
+            finally:
+                # Lazy rows add to the metrics of the song while written
+                metrics.merge(song_metrics)
+
+    try:
+        with open_output(output_format, shard_dir, tokenizer, shuffle_seed, shuffle_dir) as f_ptr:
+            write_songs(f_ptr, processed(), len(jobs), metrics)
+    finally:
+        write_metrics(metrics, metrics_path, metrics_format)
+
+
+def song_seed(seed: int, digest: str) -> int:
+    """Seed of a song in incremental builds, independent of the other songs."""
+    return int.from_bytes(sha256(f"{seed}:{digest}".encode()).digest()[:4], "little")
+
+
+def main_incremental(
+    n_workers: int = N_WORKERS,
+    seed: Optional[int] = SEED,
+    cache_dir: Optional[str] = CACHE_DIR,
+    reader: str = READER,
+    output_format: str = OUTPUT_FORMAT,
+    shard_dir: str = SHARD_DIR,
+    tokenizer: str = TOKENIZER,
+    build_dir: str = BUILD_DIR,
+    metrics_path: Optional[str] = METRICS_PATH,
+    metrics_format: str = METRICS_FORMAT,
+    shuffle: bool = SHUFFLE,
+    shuffle_dir: Optional[str] = SHUFFLE_DIR,
+):
+    """
+    Build the dataset from the rows of every song kept in build_dir. Only
+    new or changed files are processed, then the dataset is assembled from
+    the rows of all songs in a shuffled order.
+
+    Every song has a seed derived from its content, so songs do not depend
+    on each other, which also means the rows differ from those of main().
+    """
+    if seed is None:
+        # Keep the seed of the previous build, else every song is rebuilt
+        previous = load_settings(build_dir)
+        seed = previous["seed"] if previous else Random().randint(0, 2**32 - 1)
+    print(f"Building dataset incrementally in {build_dir} with seed {seed}")
+
+    settings = {"seed": seed, "reader": reader, "min_seq": MIN_SEQ, "max_seq": MAX_SEQ}
+    manifest = DatasetManifest(build_dir, settings)
+    file_names = get_file_names()
+    manifest.prune(file_names)
+
+    digests = {name: file_hash(name) for name in file_names}
+    jobs = [
+        (name, song_seed(seed, digests[name]), cache_dir, reader)
+        for name in file_names
+        if not manifest.is_current(name, digests[name])
+    ]
+    print(f"{len(file_names) - len(jobs)} songs unchanged, processing {len(jobs)}")
+
+    metrics = Metrics()
+    metrics.count("reused", len(file_names) - len(jobs))
+    try:
+        # Songs are added to the manifest as they come, so an interrupted
+        # build only processes the remaining songs next time
+        for job, (written, song_metrics) in zip(jobs, process_songs(jobs, n_workers)):
+            name, job_seed = job[0], job[1]
+            manifest.update(
+                name,
+                digests[name],
+                job_seed,
+                draw_transpose(Random(job_seed)),
+                written,
+                song_metrics.failures.get(name),
+            )
+            metrics.merge(song_metrics)
+        manifest.prune(file_names)
+
+        rng = Random(seed)
+        rng.shuffle(file_names)
+        shuffle_seed = rng.getrandbits(32) if shuffle else None
+        songs = ((name, manifest.read(name)) for name in file_names)
+        with open_output(output_format, shard_dir, tokenizer, shuffle_seed, shuffle_dir) as f_ptr:
+            write_songs(f_ptr, songs, len(file_names), metrics)
+    finally:
+        manifest.save()
+        write_metrics(metrics, metrics_path, metrics_format)
+
+
 if __name__ == "__main__":
-    main()
+    parser = ArgumentParser(description="Generate a text dataset from midi files.")
+    parser.add_argument("--workers", type=int, default=N_WORKERS)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--reader", choices=READERS, default=READER)
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default=OUTPUT_FORMAT)
+    parser.add_argument("--shard-dir", default=SHARD_DIR)
+    parser.add_argument("--tokenizer", choices=TOKENIZERS, default=TOKENIZER)
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Always parse the midi files"
+    )
+    parser.add_argument(
+        "--clear-cache", action="store_true", help="Invalidate all cached songs"
+    )
+    parser.add_argument("--metrics", help="Write stage timings and failures here")
+    parser.add_argument(
+        "--metrics-format", choices=METRICS_FORMATS, default=METRICS_FORMAT
+    )
+    parser.add_argument(
+        "--profile-song",
+        help="Profile processing a single midi file with cProfile and tracemalloc",
+    )
+    parser.add_argument("--profile-output", help="Save the cProfile stats here")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only process new or changed midi files, see --build-dir",
+    )
+    parser.add_argument("--build-dir", default=BUILD_DIR)
+    parser.add_argument(
+        "--shuffle",
+        action="store_true",
+        help="Shuffle the rows of the whole dataset with bounded memory, see dataset_shuffle.py",
+    )
+    parser.add_argument(
+        "--shuffle-dir",
+        default=SHUFFLE_DIR,
+        help="Temporary buckets of the shuffle go here, needs room for the dataset",
+    )
+    args = parser.parse_args()
+
+    if args.clear_cache:
+        SongCache(args.cache_dir).clear()
+
+    if args.profile_song:
+        job = (
+            args.profile_song,
+            args.seed or 0,
+            None if args.no_cache else args.cache_dir,
+            args.reader,
+        )
+        profile(process_song, job, path=args.profile_output)
+        exit()
+
+    if args.incremental:
+        main_incremental(
+            n_workers=args.workers,
+            seed=args.seed,
+            cache_dir=None if args.no_cache else args.cache_dir,
+            reader=args.reader,
+            output_format=args.format,
+            shard_dir=args.shard_dir,
+            tokenizer=args.tokenizer,
+            build_dir=args.build_dir,
+            metrics_path=args.metrics,
+            metrics_format=args.metrics_format,
+            shuffle=args.shuffle,
+            shuffle_dir=args.shuffle_dir,
+        )
+        exit()
+
+    main(
+        n_workers=args.workers,
+        seed=args.seed,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        reader=args.reader,
+        output_format=args.format,
+        shard_dir=args.shard_dir,
+        tokenizer=args.tokenizer,
+        metrics_path=args.metrics,
+        metrics_format=args.metrics_format,
+        shuffle=args.shuffle,
+        shuffle_dir=args.shuffle_dir,
+    )
@@ -1,10 +1,21 @@
-from augmentation import jitter, octave_down, octave_up, invert_chord
-from sys import argv
-from transformers import pipeline
-from random import choice, randint
-from simplified_song import Instrument, Song, Note
+import os
+import random
+from argparse import ArgumentParser
+from time import perf_counter
+from typing import Iterator, List, Optional, Tuple, Union, TYPE_CHECKING
+from midi_writer import MidiWriter, write_words
+from note_grammar import START, NoteGrammar, NoteGrammarLogitsProcessor
+from note_parser import is_valid_note
+from suffix_index import INDEX_DIR, SuffixIndex, context_draft
+
+# Torch and transformers are imported when a model is used, so that
+# validating notes does not pay for their import
+if TYPE_CHECKING:
+    import torch
+    from transformers import GPT2LMHeadModel, GPT2TokenizerFast
 
 DEFAULT_MODEL_PATH = "music-gpt2-2.3"
+TOKENIZER_PATH = "./music-gpt2-tokenizer"
 
 NOTES = ["A", "B", "C", "D", "E", "F", "G"]
 ACCIDENTAL = ["#", "-", ""]
@@ -14,40 +25,546 @@ TIME_SIGNATURE_TOP = ["3", "4"]
 TIME_SIGNATURE_BOTTOM = ["4"]
 
 ITERATIONS = 10
+TOKENS_PER_ITERATION = 256
 
+# Tokens kept when the context of the model is full. The cache is rebuilt
+# from them, after which the rest of the context fills up again one token at
+# a time.
+CONTEXT_KEEP = 768
+TOP_K = 50
+TEMPERATURE = 1.0
+# Tokens drafted ahead per forward pass by speculative decoding
+DRAFT_TOKENS = 8
 
-def main():
-    print(f"Loading model at path {DEFAULT_MODEL_PATH}")
-    generator = pipeline("text-generation", model=DEFAULT_MODEL_PATH)
+# Batch generation, every song is generated in a single context window
+N_SONGS = 1
+SEED = 0
+BATCH_SIZE = 8
+TOKENS_PER_SONG = 1000
+DEVICE = "cpu"
+OUTPUT_DIR = "./generated"
+# Small randomly initialized GPT-2, runs anywhere without a trained model
+TINY_GPT2 = dict(n_positions=1024, n_embd=64, n_layer=2, n_head=2)
 
-    in_seq = choice(TIME_SIGNATURE_TOP) + "/" + choice(TIME_SIGNATURE_BOTTOM)
-    in_seq += f" {choice(NOTES) + choice(ACCIDENTAL) + choice(OCTAVE)}"
-    print(f"Generating sequence with initial input: {in_seq}")
 
-    song_seq = []
+class NoteValidator:
+    """
+    Validates generated words one at a time like Instrument.sanitize. Instead
+    of stopping at the first invalid note, words are skipped until the next
+    time signature so that a long generation can recover.
+    """
+
+    def __init__(self) -> None:
+        self.note: List[str] = []
+        self.skipping = False
+        self.n_invalid = 0
+
+    def push(self, word: str) -> Optional[List[str]]:
+        """Returns a time signature or a complete valid note, else None."""
+        if "/" in word:
+            self.note = []
+            self.skipping = False
+            return [word]
+        if self.skipping:
+            return None
+
+        self.note.append(word)
+        if len(self.note) < 4:
+            return None
+
+        note, self.note = self.note, []
+        if is_valid_note(note):
+            return note
+        self.n_invalid += 1
+        self.skipping = True
+        return None
+
+
+class GenerationSession:
+    """
+    Continuous generation that keeps the key/value cache of the model between
+    calls, so every new token costs a single forward step. When the context
+    reaches the maximum length of the model, only the last keep tokens are
+    kept and the cache is rebuilt from them.
+
+    Generated text is split into words as it comes and validated, generate()
+    yields time signatures and notes as lists of words in the format of
+    Song(string_list=...). With a grammar, tokens that would break the note
+    grammar are masked before sampling, so every generated note is valid.
+    """
+
+    def __init__(
+        self,
+        model: "GPT2LMHeadModel",
+        tokenizer: "GPT2TokenizerFast",
+        max_context: int = None,
+        keep: int = CONTEXT_KEEP,
+        top_k: int = TOP_K,
+        temperature: float = TEMPERATURE,
+        seed: int = None,
+        grammar: NoteGrammar = None,
+    ) -> None:
+        import torch
+
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        self.max_context = max_context or model.config.n_positions
+        self.keep = min(keep, self.max_context - 1)
+        self.top_k = top_k
+        self.temperature = temperature
+        self.generator = torch.Generator(device=model.device)
+        if seed is not None:
+            self.generator.manual_seed(seed)
+
+        # Token ids in the context of the model and their cache
+        self.ids: List[int] = []
+        self.past = None
+        self.logits: "torch.Tensor" = None
+        # Decoded text after the last complete word
+        self.text = ""
+        self.validator = NoteValidator()
+        self.grammar = grammar
+        self.state = START
+        self.n_generated = 0
+        self.n_rebuilds = 0
+
+    def forward(self, ids: List[int]) -> "torch.Tensor":
+        """Add ids to the context, returns the logits after each of them."""
+        import torch
+
+        n_new = len(ids)
+        if len(self.ids) + len(ids) > self.max_context:
+            # Positions are absolute, so a cropped cache can not be reused
+            self.ids = (self.ids + ids)[-self.keep :]
+            self.past = None
+            ids = self.ids
+            self.n_rebuilds += 1
+        else:
+            self.ids += ids
+
+        input_ids = torch.tensor([ids], device=self.model.device)
+        with torch.no_grad():
+            output = self.model(
+                input_ids=input_ids, past_key_values=self.past, use_cache=True
+            )
+        self.past = output.past_key_values
+        self.logits = output.logits[0, -1]
+        return output.logits[0, -n_new:]
+
+    def probabilities(self, logits: "torch.Tensor") -> "torch.Tensor":
+        """Distribution the next token is sampled from, given its logits."""
+        import torch
+
+        logits = logits / self.temperature
+        if self.grammar is not None:
+            logits = self.grammar.constrain(self.state, logits)
+        if self.top_k:
+            values, indices = torch.topk(logits, min(self.top_k, logits.shape[-1]))
+            logits = torch.full_like(logits, float("-inf")).scatter(0, indices, values)
+        return torch.softmax(logits, dim=-1)
+
+    def sample(self) -> int:
+        import torch
+
+        probabilities = self.probabilities(self.logits)
+        return int(torch.multinomial(probabilities, 1, generator=self.generator))
+
+    def words(self, text: str) -> Iterator[List[str]]:
+        self.text += text
+        words = self.text.split(" ")
+        # The last word may still continue in the next token
+        self.text = words.pop()
+        for word in words:
+            if word:
+                valid = self.validator.push(word)
+                if valid:
+                    yield valid
+
+    def feed(self, text: str) -> Iterator[List[str]]:
+        """Add text to the context, yields its valid words."""
+        if self.grammar is not None:
+            self.state = self.grammar.advance_text(self.state, text)
+            if self.state is None:
+                raise Exception(f"Text does not follow the note grammar: {text}")
+        ids = self.tokenizer(text)["input_ids"]
+        # Split long prompts so every forward fits the context
+        for start in range(0, len(ids), self.keep):
+            self.forward(ids[start : start + self.keep])
+        yield from self.words(text)
+
+    def generate(self, n_tokens: int) -> Iterator[List[str]]:
+        """Generate up to n_tokens tokens, yields valid words as they come."""
+        if self.logits is None:
+            raise Exception("Feed a prompt before generating.")
+
+        for _ in range(n_tokens):
+            token = self.sample()
+            if token == self.tokenizer.eos_token_id:
+                break
+            if self.grammar is not None:
+                self.state = self.grammar.advance(self.state, token)
+            self.forward([token])
+            self.n_generated += 1
+            yield from self.words(self.tokenizer.decode([token]))
+
+    def flush(self) -> Iterator[List[str]]:
+        """Validate the last, unterminated word."""
+        yield from self.words(" ")
+
+
+class SpeculativeSession(GenerationSession):
+    """
+    GenerationSession with speculative decoding. Tokens are drafted ahead,
+    from a repetition in the song or from a suffix index of the dataset, and
+    checked by a single forward pass of the model, which gives the
+    distribution after each of them.
+
+    Drafts are deterministic, so a drafted token is accepted with the
+    probability the model gives it. At the first rejection, the token is
+    sampled from that distribution without the rejected token, and the rest
+    of the draft is dropped from the context. Drafts end where the context
+    is full, so the context is rebuilt at the same token as in
+    GenerationSession and every token is sampled after the same context.
+    Generated text has the distribution of plain sampling. The token sampled
+    last is only added to the context with the next draft, so every step
+    takes one forward pass and gives from one to n_draft + 1 tokens. A
+    sample left over when generation stops is dropped, logits stay those of
+    the context.
+    """
+
+    def __init__(
+        self,
+        model: "GPT2LMHeadModel",
+        tokenizer: "GPT2TokenizerFast",
+        index: SuffixIndex,
+        n_draft: int = DRAFT_TOKENS,
+        **kwargs,
+    ) -> None:
+        super().__init__(model, tokenizer, **kwargs)
+        self.index = index
+        self.n_draft = n_draft
+        self.n_drafted = 0
+        self.n_accepted = 0
+        self.n_steps = 0
 
-    for _ in range(ITERATIONS):
-        output = generator(in_seq, max_length=256)[0]
+    def draft(self, context: List[int], n_tokens: int) -> List[int]:
+        return context_draft(context, n_tokens) or self.index.draft(context, n_tokens)
 
-        output = output["generated_text"]
-        output, last_note = Instrument.sanitize(output)
+    def accept(self, token: int) -> Iterator[List[str]]:
+        if self.grammar is not None:
+            self.state = self.grammar.advance(self.state, token)
+        self.n_generated += 1
+        yield from self.words(self.tokenizer.decode([token]))
 
-        song_seq += output
+    def generate(self, n_tokens: int) -> Iterator[List[str]]:
+        import torch
 
-        augmentation = jitter
+        if self.logits is None:
+            raise Exception("Feed a prompt before generating.")
 
-        seq = output[last_note:-1] if "/" in output[-1] else output[last_note:]
+        # Sampled but not in the context yet
+        pending = self.sample()
+        n_done = 0
+        while pending != self.tokenizer.eos_token_id and n_done < n_tokens:
+            yield from self.accept(pending)
+            n_done += 1
+            # Room left in the context after pending, none when it is rebuilt
+            room = self.max_context - len(self.ids) - 1
+            draft = self.draft(
+                self.ids + [pending], min(self.n_draft, n_tokens - n_done, room)
+            )
+            logits = self.forward([pending] + draft)
+            self.n_steps += 1
+            self.n_drafted += len(draft)
 
-        n = Note(string_list=seq)
-        augmentation(n)
-        in_seq = str(n)
+            for i, token in enumerate(draft):
+                probabilities = self.probabilities(logits[i])
+                if torch.rand(1, generator=self.generator) < probabilities[token]:
+                    self.n_accepted += 1
+                    n_done += 1
+                    yield from self.accept(token)
+                    continue
+                # Rejected, the rest of the draft leaves the context
+                n_dropped = len(draft) - i
+                self.ids = self.ids[:-n_dropped]
+                self.past.crop(-n_dropped)
+                self.logits = logits[i]
+                probabilities[token] = 0
+                pending = int(
+                    torch.multinomial(probabilities, 1, generator=self.generator)
+                )
+                break
+            else:
+                # All accepted, forward left the logits after the draft
+                pending = self.sample()
 
-        print(f"Next in seq {in_seq}")
+    def stats(self) -> str:
+        rate = self.n_accepted / self.n_drafted if self.n_drafted else 0.0
+        per_step = self.n_generated / self.n_steps if self.n_steps else 0.0
+        return (
+            f"{self.n_accepted}/{self.n_drafted} drafted tokens accepted ({rate:.1%}), "
+            f"{per_step:.2f} tokens per forward pass"
+        )
 
-    s = Song(string_list=song_seq)
 
-    s.to_midi("test.mid")
+def random_prompt(rng=random, time_signature: str = None) -> str:
+    in_seq = rng.choice(TIME_SIGNATURE_TOP) + "/" + rng.choice(TIME_SIGNATURE_BOTTOM)
+    if time_signature is not None:
+        in_seq = time_signature
+    return in_seq + f" {rng.choice(NOTES) + rng.choice(ACCIDENTAL) + rng.choice(OCTAVE)}"
+
+
+def tiny_model(tokenizer: "GPT2TokenizerFast") -> "GPT2LMHeadModel":
+    """A TINY_GPT2 model with random weights, seeded by torch's seed."""
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    config = GPT2Config(
+        vocab_size=len(tokenizer),
+        bos_token_id=tokenizer.eos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        **TINY_GPT2,
+    )
+    return GPT2LMHeadModel(config).eval()
+
+
+class SeededSampler:
+    """
+    Logits processor for model.generate that samples the next token of every
+    row with its own seeded generator, so a song depends on its seed and not
+    on the rows batched with it. Every other token is masked, generate has to
+    run greedily to take the sampled one.
+    """
+
+    def __init__(
+        self,
+        seeds: List[int],
+        top_k: int = TOP_K,
+        temperature: float = TEMPERATURE,
+        device: str = DEVICE,
+    ) -> None:
+        import torch
+
+        self.top_k = top_k
+        self.temperature = temperature
+        self.generators = [
+            torch.Generator(device=device).manual_seed(seed) for seed in seeds
+        ]
+
+    def __call__(
+        self, input_ids: "torch.LongTensor", scores: "torch.FloatTensor"
+    ) -> "torch.FloatTensor":
+        import torch
+
+        logits = scores / self.temperature
+        if self.top_k:
+            values, indices = torch.topk(logits, min(self.top_k, logits.shape[-1]))
+            logits = torch.full_like(logits, float("-inf")).scatter(1, indices, values)
+        probabilities = torch.softmax(logits, dim=-1)
+        tokens = torch.cat(
+            [
+                torch.multinomial(row, 1, generator=generator)
+                for row, generator in zip(probabilities, self.generators)
+            ]
+        )
+        return torch.full_like(scores, float("-inf")).scatter(1, tokens[:, None], 0.0)
+
+
+def generate_batch(
+    model: "GPT2LMHeadModel",
+    tokenizer: "GPT2TokenizerFast",
+    prompts: List[str],
+    n_tokens: Union[int, List[int]] = TOKENS_PER_SONG,
+    grammar: NoteGrammar = None,
+    top_k: int = TOP_K,
+    temperature: float = TEMPERATURE,
+    seeds: List[int] = None,
+) -> Tuple[List[List[str]], int]:
+    """
+    Generate a song for every prompt in one padded batch. Returns the valid
+    words of every song and the number of generated tokens. n_tokens can be
+    a list with the length of every song, the batch runs until the longest
+    one is done and the others are cut. With a seed for every prompt, each
+    song is sampled from its own seed, otherwise from torch's random state.
+    """
+    import torch
+
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    # Left padding so every row continues right after its prompt
+    tokenizer.padding_side = "left"
+    inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(model.device)
+    prompt_length = inputs["input_ids"].shape[1]
+    if isinstance(n_tokens, int):
+        n_tokens = [n_tokens] * len(prompts)
+
+    processors = [NoteGrammarLogitsProcessor(grammar)] if grammar else []
+    if seeds is not None:
+        processors.append(SeededSampler(seeds, top_k, temperature, model.device))
+        sampling = dict(do_sample=False)
+    else:
+        sampling = dict(do_sample=True, top_k=top_k, temperature=temperature)
+    with torch.no_grad():
+        output = model.generate(
+            **inputs,
+            max_new_tokens=min(max(n_tokens), model.config.n_positions - prompt_length),
+            pad_token_id=tokenizer.pad_token_id,
+            logits_processor=processors or None,
+            **sampling,
+        )
+
+    songs = []
+    n_generated = 0
+    for prompt, ids, limit in zip(prompts, output[:, prompt_length:].tolist(), n_tokens):
+        ids = ids[:limit]
+        if tokenizer.eos_token_id in ids:
+            ids = ids[: ids.index(tokenizer.eos_token_id)]
+        n_generated += len(ids)
+
+        validator = NoteValidator()
+        song_seq = []
+        for word in (prompt + tokenizer.decode(ids)).split():
+            valid = validator.push(word)
+            if valid:
+                song_seq += valid
+        songs.append(song_seq)
+    return songs, n_generated
+
+
+def main_batch(
+    model_path: str = DEFAULT_MODEL_PATH,
+    n_songs: int = N_SONGS,
+    seed: int = SEED,
+    batch_size: int = BATCH_SIZE,
+    n_tokens: int = TOKENS_PER_SONG,
+    threads: int = None,
+    device: str = DEVICE,
+    output_dir: str = OUTPUT_DIR,
+    int8: bool = False,
+):
+    import torch
+    from transformers import GPT2TokenizerFast
+    from quantize_model import load_model
+
+    if threads:
+        torch.set_num_threads(threads)
+    model = load_model(model_path, int8, device)
+    tokenizer = GPT2TokenizerFast.from_pretrained(TOKENIZER_PATH)
+    grammar = NoteGrammar(tokenizer)
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Every seed gives its own prompt, song and song file, whatever the batch
+    seeds = list(range(seed, seed + n_songs))
+    n_generated = 0
+    start = perf_counter()
+    for i in range(0, len(seeds), batch_size):
+        batch = seeds[i : i + batch_size]
+        prompts = [random_prompt(random.Random(s)) for s in batch]
+        songs, n_batch = generate_batch(
+            model, tokenizer, prompts, n_tokens, grammar=grammar, seeds=batch
+        )
+        n_generated += n_batch
+        for s, song_seq in zip(batch, songs):
+            write_words(song_seq, os.path.join(output_dir, f"song_{s}.mid"))
+        print(f"Generated {i + len(batch)}/{len(seeds)} songs")
+
+    elapsed = perf_counter() - start
+    print(
+        f"Generated {len(seeds)} songs and {n_generated} tokens in {elapsed:.2f}s: "
+        f"{len(seeds) / elapsed:.2f} songs/s, {n_generated / elapsed:.1f} tokens/s"
+    )
+
+
+def main(
+    model_path: str = DEFAULT_MODEL_PATH,
+    int8: bool = False,
+    index_dir: str = None,
+    n_draft: int = DRAFT_TOKENS,
+):
+    from transformers import GPT2TokenizerFast
+    from quantize_model import load_model
+
+    model = load_model(model_path, int8)
+    tokenizer = GPT2TokenizerFast.from_pretrained(TOKENIZER_PATH)
+    grammar = NoteGrammar(tokenizer)
+    if index_dir:
+        print(f"Drafting {n_draft} tokens ahead from the suffix index at {index_dir}")
+        session = SpeculativeSession(
+            model, tokenizer, SuffixIndex(index_dir), n_draft, grammar=grammar
+        )
+    else:
+        session = GenerationSession(model, tokenizer, grammar=grammar)
+
+    in_seq = random_prompt()
+    print(f"Generating sequence with initial input: {in_seq}")
+
+    # The midi file is rewritten after every iteration, so it can be played
+    # while the song is still being generated
+    writer = MidiWriter("test.mid")
+    n_words = 0
+    for words in session.feed(in_seq):
+        writer.add_words(words)
+        n_words += len(words)
+
+    for i in range(ITERATIONS):
+        for words in session.generate(TOKENS_PER_ITERATION):
+            writer.add_words(words)
+            n_words += len(words)
+        writer.save()
+        print(
+            f"Iteration {i+1}/{ITERATIONS}: {n_words} words, "
+            f"{session.validator.n_invalid} invalid notes skipped"
+        )
+        if index_dir:
+            print(session.stats())
+    for words in session.flush():
+        writer.add_words(words)
+    writer.save()
 
 
 if __name__ == "__main__":
-    main()
+    parser = ArgumentParser(description="Generate songs with a trained model.")
+    parser.add_argument("model_path", nargs="?", default=DEFAULT_MODEL_PATH)
+    parser.add_argument(
+        "--songs",
+        type=int,
+        help="Generate this many songs in batches instead of one long song",
+    )
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--tokens", type=int, default=TOKENS_PER_SONG)
+    parser.add_argument("--threads", type=int, help="Torch threads, all by default")
+    parser.add_argument("--device", default=DEVICE)
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument(
+        "--int8",
+        action="store_true",
+        help="Quantize the model to int8 for faster CPU inference. Quantized "
+        "checkpoints saved by quantize_model.py are loaded as such",
+    )
+    parser.add_argument(
+        "--speculative",
+        nargs="?",
+        const=INDEX_DIR,
+        metavar="INDEX_DIR",
+        help="Speculative decoding with drafts from a suffix index built by "
+        "suffix_index.py, for a single long song",
+    )
+    parser.add_argument("--draft", type=int, default=DRAFT_TOKENS, help="Tokens drafted per step")
+    args = parser.parse_args()
+    if args.songs and args.speculative:
+        parser.error("--speculative generates a single song, not --songs")
+
+    if args.songs:
+        main_batch(
+            args.model_path,
+            args.songs,
+            args.seed,
+            args.batch_size,
+            args.tokens,
+            args.threads,
+            args.device,
+            args.output_dir,
+            args.int8,
+        )
+    else:
+        main(args.model_path, args.int8, args.speculative, args.draft)
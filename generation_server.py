@@ -0,0 +1,367 @@
+import asyncio
+import json
+import os
+import random
+import re
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from time import perf_counter
+from typing import Callable, Dict, List, Optional, Tuple, TYPE_CHECKING
+from urllib.parse import parse_qs, urlsplit
+
+import torch
+
+from generate_music import (
+    BATCH_SIZE,
+    DEFAULT_MODEL_PATH,
+    DEVICE,
+    TOKENIZER_PATH,
+    TOKENS_PER_SONG,
+    generate_batch,
+    random_prompt,
+    tiny_model,
+)
+from metrics import METRIC_PREFIX, Metrics
+from midi_writer import MidiWriter
+from note_grammar import DENOMINATORS, MAX_NUMERATOR, START, NoteGrammar
+from quantize_model import load_model as load_pretrained, quantize
+
+if TYPE_CHECKING:
+    from transformers import GPT2LMHeadModel, GPT2TokenizerFast
+
+# Local generation server. The model is loaded once and requests are queued,
+# a scheduler gathers the requests that arrive close together into a single
+# padded batch for generate_batch:
+#
+#   POST /generate  {"seed": 1, "tokens": 500, "time_signature": "3/4",
+#                    "format": "text" or "midi"}
+#   GET  /metrics   queue depth, batch sizes and latencies, in the Prometheus
+#                   text format or as JSON lines with ?format=jsonl
+#
+#   python generation_server.py --tiny --port 8765
+#   curl -d '{"seed": 1, "tokens": 200}' localhost:8765/generate
+
+HOST = "127.0.0.1"
+PORT = 8765
+# Seconds the oldest request of a batch waits for others to join it
+MAX_LATENCY = 0.05
+MAX_BATCH_SIZE = BATCH_SIZE
+FORMATS = ("text", "midi")
+CONTENT_TYPES = {"text": "text/plain; charset=utf-8", "midi": "audio/midi"}
+TIME_SIGNATURE_REGEX = re.compile(r"([1-9]\d?)/(\d{1,2})")
+MAX_REQUEST_BYTES = 1 << 16
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+
+class GenerationRequest:
+    """A song to generate, as read from the body of a request."""
+
+    def __init__(
+        self,
+        seed: int = None,
+        tokens: int = TOKENS_PER_SONG,
+        time_signature: str = None,
+        format: str = "text",
+    ) -> None:
+        self.seed = random.randrange(1 << 31) if seed is None else int(seed)
+        self.tokens = int(tokens)
+        if self.tokens < 1:
+            raise Exception(f"tokens must be positive, got {self.tokens}")
+        if time_signature is not None and not is_time_signature(time_signature):
+            raise Exception(
+                f"Invalid time signature {time_signature}, use a numerator up to "
+                f"{MAX_NUMERATOR} and a denominator in {', '.join(DENOMINATORS)}"
+            )
+        self.time_signature = time_signature
+        if format not in FORMATS:
+            raise Exception(f"Unknown format {format}, use one of {FORMATS}")
+        self.format = format
+        self.enqueued: float = None
+
+    @property
+    def prompt(self) -> str:
+        return random_prompt(random.Random(self.seed), self.time_signature)
+
+
+# Time signatures the note grammar accepts, others could not be generated
+def is_time_signature(time_signature: str) -> bool:
+    match = TIME_SIGNATURE_REGEX.fullmatch(time_signature)
+    return (
+        match is not None
+        and int(match.group(1)) <= MAX_NUMERATOR
+        and match.group(2) in DENOMINATORS
+    )
+
+
+class MicroBatcher:
+    """
+    Gathers concurrent requests into batches. A batch starts with the oldest
+    waiting request and takes the requests arriving within max_latency of
+    it, up to max_batch_size. Batches run one at a time in a worker thread,
+    so requests keep queueing while the model is busy and the next batch
+    starts full. When a batch fails, its requests are generated again one
+    at a time, so a failing request does not fail the others.
+    """
+
+    def __init__(
+        self,
+        generate: Callable[[List[GenerationRequest]], Tuple[List[List[str]], int]],
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_latency: float = MAX_LATENCY,
+        metrics: Metrics = None,
+    ) -> None:
+        self.generate = generate
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.metrics = metrics or Metrics()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    async def submit(self, request: GenerationRequest) -> List[str]:
+        """Queue a request, returns the valid words of its song."""
+        future = asyncio.get_running_loop().create_future()
+        request.enqueued = perf_counter()
+        await self.queue.put((request, future))
+        return await future
+
+    async def next_batch(self) -> List[Tuple[GenerationRequest, asyncio.Future]]:
+        batch = [await self.queue.get()]
+        deadline = batch[0][0].enqueued + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - perf_counter()
+            try:
+                if timeout > 0:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                else:
+                    # Past the deadline only requests already waiting join
+                    batch.append(self.queue.get_nowait())
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                break
+        # Requests whose client went away are not generated
+        return [(request, future) for request, future in batch if not future.done()]
+
+    async def run(self) -> None:
+        while True:
+            batch = await self.next_batch()
+            if not batch:
+                continue
+            start = perf_counter()
+            for request, _ in batch:
+                self.metrics.observe("queue", start - request.enqueued)
+            await self.run_batch(batch)
+
+    async def run_batch(self, batch: List[Tuple[GenerationRequest, asyncio.Future]]) -> None:
+        loop = asyncio.get_running_loop()
+        requests = [request for request, _ in batch]
+        start = perf_counter()
+        try:
+            songs, n_generated = await loop.run_in_executor(
+                self.executor, self.generate, requests
+            )
+        except Exception as e:
+            self.metrics.count("failed_batches")
+            if len(batch) > 1:
+                for request, future in batch:
+                    if not future.done():
+                        await self.run_batch([(request, future)])
+                return
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.metrics.observe("batch", perf_counter() - start)
+        self.metrics.count("batches")
+        self.metrics.count("batched_requests", len(batch))
+        self.metrics.count("generated_tokens", n_generated)
+        for (_, future), words in zip(batch, songs):
+            if not future.done():
+                future.set_result(words)
+
+
+class GenerationServer:
+    """
+    HTTP/1.1 server on a TCP port or a Unix socket, one request per
+    connection. Generation goes through a MicroBatcher, everything else is
+    answered right away.
+    """
+
+    def __init__(
+        self,
+        model: "GPT2LMHeadModel",
+        tokenizer: "GPT2TokenizerFast",
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_latency: float = MAX_LATENCY,
+    ) -> None:
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        self.grammar = NoteGrammar(tokenizer)
+        self.metrics = Metrics()
+        self.batcher = MicroBatcher(
+            self.generate, max_batch_size, max_latency, self.metrics
+        )
+
+    def generate(self, requests: List[GenerationRequest]) -> Tuple[List[List[str]], int]:
+        # Every request samples from its own seed, so its song does not
+        # depend on the requests batched with it
+        return generate_batch(
+            self.model,
+            self.tokenizer,
+            [request.prompt for request in requests],
+            [request.tokens for request in requests],
+            grammar=self.grammar,
+            seeds=[request.seed for request in requests],
+        )
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        start = perf_counter()
+        try:
+            status, content_type, body = await self.respond(reader)
+        except Exception as e:
+            status, content_type, body = 400, CONTENT_TYPES["text"], f"{e}\n".encode()
+        head = (
+            f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        try:
+            writer.write(head.encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+        self.metrics.count("requests")
+        self.metrics.count(f"responses_{status}")
+        self.metrics.observe("request", perf_counter() - start)
+
+    async def respond(self, reader: asyncio.StreamReader) -> Tuple[int, str, bytes]:
+        method, target, body = await read_request(reader)
+        url = urlsplit(target)
+        if method == "POST" and url.path == "/generate":
+            request = GenerationRequest(**json.loads(body or b"{}"))
+            # Prompts breaking the grammar are rejected before they can fail
+            # the batch they join
+            if self.grammar.advance_text(START, request.prompt) is None:
+                raise Exception(f"Prompt {request.prompt} does not follow the note grammar")
+            try:
+                words = await self.batcher.submit(request)
+            except Exception as e:
+                return 500, CONTENT_TYPES["text"], f"{e}\n".encode()
+            if request.format == "midi":
+                return 200, CONTENT_TYPES["midi"], midi_bytes(words)
+            return 200, CONTENT_TYPES["text"], (" ".join(words) + "\n").encode()
+
+        if method == "GET" and url.path == "/metrics":
+            format = parse_qs(url.query).get("format", ["prometheus"])[0]
+            return 200, CONTENT_TYPES["text"], self.metrics_text(format).encode()
+        return 404, CONTENT_TYPES["text"], f"No route for {method} {url.path}\n".encode()
+
+    def metrics_text(self, format: str = "prometheus") -> str:
+        if format == "jsonl":
+            queue = {"type": "queue", "depth": self.batcher.depth}
+            return self.metrics.to_jsonl() + json.dumps(queue) + "\n"
+        name = f"{METRIC_PREFIX}_queue_depth"
+        return (
+            self.metrics.to_prometheus()
+            + f"# TYPE {name} gauge\n{name} {self.batcher.depth}\n"
+        )
+
+    async def serve(self, host: str = HOST, port: int = PORT, socket: str = None) -> None:
+        if socket:
+            server = await asyncio.start_unix_server(self.handle, path=socket)
+            print(f"Serving on {socket}")
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            print(f"Serving on http://{host}:{port}")
+        batcher = asyncio.create_task(self.batcher.run())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            if socket and os.path.exists(socket):
+                os.remove(socket)
+
+
+async def read_request(reader: asyncio.StreamReader) -> Tuple[str, str, bytes]:
+    """Method, target and body of an HTTP request."""
+    head = await reader.readuntil(b"\r\n\r\n")
+    if len(head) > MAX_REQUEST_BYTES:
+        raise Exception("Request head too large")
+    lines = head.decode("latin-1").split("\r\n")
+    method, target, _ = lines[0].split(" ", 2)
+    headers: Dict[str, str] = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length > MAX_REQUEST_BYTES:
+        raise Exception("Request body too large")
+    body = await reader.readexactly(length) if length else b""
+    return method, target, body
+
+
+def midi_bytes(words: List[str]) -> bytes:
+    writer = MidiWriter()
+    writer.add_words(words)
+    buffer = BytesIO()
+    writer.midi_file().save(file=buffer)
+    return buffer.getvalue()
+
+
+def load_model(
+    model_path: Optional[str], tiny: bool, device: str, int8: bool = False
+) -> Tuple["GPT2LMHeadModel", "GPT2TokenizerFast"]:
+    from transformers import GPT2TokenizerFast
+
+    tokenizer = GPT2TokenizerFast.from_pretrained(TOKENIZER_PATH)
+    if tiny:
+        print("Using a tiny randomly initialized model")
+        model = tiny_model(tokenizer)
+        if int8:
+            model = quantize(model)
+        return model.to(device), tokenizer
+    return load_pretrained(model_path, int8, device), tokenizer
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Serve song generation over HTTP.")
+    parser.add_argument("model_path", nargs="?", default=DEFAULT_MODEL_PATH)
+    parser.add_argument(
+        "--tiny", action="store_true", help="Serve a tiny random model instead"
+    )
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--socket", help="Listen on this Unix socket instead")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument(
+        "--max-latency",
+        type=float,
+        default=MAX_LATENCY,
+        help="Seconds a request waits for others to batch with",
+    )
+    parser.add_argument("--threads", type=int, help="Torch threads, all by default")
+    parser.add_argument("--device", default=DEVICE)
+    parser.add_argument(
+        "--int8", action="store_true", help="Quantize the model to int8 for the cpu"
+    )
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model, tokenizer = load_model(
+        args.model_path, args.tiny, args.device, args.int8
+    )
+    server = GenerationServer(model, tokenizer, args.max_batch_size, args.max_latency)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
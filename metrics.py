@@ -0,0 +1,194 @@
+import cProfile
+import json
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+from io import StringIO
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List
+
+# Upper bounds in seconds of the buckets of every stage histogram
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+METRIC_PREFIX = 'music_gpt'
+METRICS_FORMATS = ('jsonl', 'prometheus')
+# Functions and allocation sites printed by profile()
+PROFILE_TOP = 25
+
+
+def empty_histogram() -> dict:
+    return {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * len(BUCKETS)}
+
+
+class Metrics:
+    '''
+    Timing and failure metrics of the dataset pipeline. Stages are timed with
+    timer(), which adds the time to a histogram of the stage and to the time
+    of the current file. Failures are kept per file with their reason.
+
+    Metrics only hold plain dicts, so workers can return theirs to the main
+    process to be merged. Disabled metrics record nothing.
+    '''
+
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self.counters: Dict[str, float] = {}
+        # stage -> {'count', 'sum', 'max', 'buckets'}
+        self.stages: Dict[str, dict] = {}
+        # file -> {stage: seconds}
+        self.files: Dict[str, Dict[str, float]] = {}
+        # file -> reason
+        self.failures: Dict[str, str] = {}
+        self.file: str = None
+
+    ''' Time the enclosed block as a stage of the current file'''
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, perf_counter() - start)
+
+    def observe(self, stage: str, seconds: float) -> None:
+        if not self.enabled:
+            return
+        histogram = self.stages.setdefault(stage, empty_histogram())
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+        histogram['max'] = max(histogram['max'], seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+                break
+
+        if self.file is not None:
+            times = self.files.setdefault(self.file, {})
+            times[stage] = times.get(stage, 0.0) + seconds
+
+    ''' Attribute the following stages to a file'''
+    def start_file(self, file: str) -> None:
+        self.file = file
+
+    def count(self, name: str, value: float = 1) -> None:
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def failure(self, file: str, reason: str) -> None:
+        if self.enabled:
+            self.failures[file] = reason
+            self.count('failures')
+
+    def merge(self, other: 'Metrics') -> None:
+        if not self.enabled:
+            return
+        for name, value in other.counters.items():
+            self.count(name, value)
+        for stage, theirs in other.stages.items():
+            ours = self.stages.setdefault(stage, empty_histogram())
+            ours['count'] += theirs['count']
+            ours['sum'] += theirs['sum']
+            ours['max'] = max(ours['max'], theirs['max'])
+            ours['buckets'] = [a + b for a, b in zip(ours['buckets'], theirs['buckets'])]
+        for file, times in other.files.items():
+            ours = self.files.setdefault(file, {})
+            for stage, seconds in times.items():
+                ours[stage] = ours.get(stage, 0.0) + seconds
+        self.failures.update(other.failures)
+
+    ''' One JSON object per line: counters, every stage, every file'''
+    def to_jsonl(self) -> str:
+        lines = [{'type': 'counters', **self.counters}]
+        for stage, histogram in self.stages.items():
+            lines.append(
+                {
+                    'type': 'stage',
+                    'stage': stage,
+                    **histogram,
+                    'buckets': dict(zip(map(str, BUCKETS), histogram['buckets'])),
+                }
+            )
+        for file in sorted(set(self.files) | set(self.failures)):
+            lines.append(
+                {
+                    'type': 'file',
+                    'file': file,
+                    'seconds': sum(self.files.get(file, {}).values()),
+                    'stages': self.files.get(file, {}),
+                    'failure': self.failures.get(file),
+                }
+            )
+        return ''.join(json.dumps(line) + '\n' for line in lines)
+
+    ''' Text exposition format read by the node exporter textfile collector'''
+    def to_prometheus(self) -> str:
+        name = f'{METRIC_PREFIX}_stage_seconds'
+        lines = [f'# TYPE {name} histogram']
+        for stage, histogram in self.stages.items():
+            cumulative = 0
+            for bound, n in zip(BUCKETS, histogram['buckets']):
+                cumulative += n
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram["count"]}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram["sum"]}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram["count"]}')
+
+        for counter, value in self.counters.items():
+            lines.append(f'# TYPE {METRIC_PREFIX}_{counter}_total counter')
+            lines.append(f'{METRIC_PREFIX}_{counter}_total {value}')
+
+        # Failures per reason, the files are in the JSON lines export
+        reasons: Dict[str, int] = {}
+        for reason in self.failures.values():
+            # Label values are the exception types, quotes would break them
+            reason = reason.split(':')[0].replace('\\', '').replace('"', '')
+            reasons[reason] = reasons.get(reason, 0) + 1
+        lines.append(f'# TYPE {METRIC_PREFIX}_file_failures_total counter')
+        for reason, n in reasons.items():
+            lines.append(f'{METRIC_PREFIX}_file_failures_total{{reason="{reason}"}} {n}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str, format: str = 'jsonl') -> None:
+        if format not in METRICS_FORMATS:
+            raise Exception(f'Unknown metrics format {format}, use one of {METRICS_FORMATS}')
+        with open(path, 'w') as f:
+            f.write(self.to_jsonl() if format == 'jsonl' else self.to_prometheus())
+        print(f'Wrote metrics to {path}')
+
+    ''' Files that took the longest'''
+    def slowest(self, n: int = 10) -> List[tuple]:
+        totals = [(sum(times.values()), file) for file, times in self.files.items()]
+        return sorted(totals, reverse=True)[:n]
+
+
+# Metrics for callers that do not collect any
+NO_METRICS = Metrics(enabled=False)
+
+
+def profile(function: Callable, *args, path: str = None):
+    '''
+    Run a function under cProfile and tracemalloc and print the functions
+    with the most cumulative time and the lines that allocated the most
+    memory. The profile is saved to path if given, for snakeviz or pstats.
+    '''
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    try:
+        result = profiler.runcall(function, *args)
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    stream = StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(PROFILE_TOP)
+    print(stream.getvalue())
+    print(f'Peak traced memory: {peak / 1024**2:.1f} MiB')
+    for stat in snapshot.statistics('lineno')[:PROFILE_TOP]:
+        print(stat)
+    if path:
+        profiler.dump_stats(path)
+        print(f'Saved profile to {path}')
+    return result
@@ -0,0 +1,233 @@
+import mido
+from typing import Iterable, List, Tuple
+
+from simplified_song import Measure, Song, parse_pitch_name
+from mido_song import PERCUSSION_CHANNEL
+
+# Fast midi writer built directly on mido messages. Notes are written from
+# the note data of simplified songs, or from generated words, without
+# building any Music21 streams:
+#
+#   1. track 0 holds the tempo, and the time signatures when every part has
+#      the same ones. Readers then apply them to every part, otherwise each
+#      part track holds its own
+#   2. every part gets its own track and channel
+#   3. a measure starts where the bar of the previous one ends, whatever its
+#      notes, so offsets and time signatures read back the same
+#   4. notes keep their duration past the bar line, like Music21 writes
+#      them. Midi can not hold two notes of the same pitch at once, a note
+#      ends where the next note of its pitch starts. Readers store the part
+#      of a tied note after the bar line as a note of the next measure, so
+#      such notes end there, as when they were read
+
+# Divisible by 3, 4, 5 and 16 so triplets and sixteenths land on ticks
+TICKS_PER_BEAT = 480
+# Microseconds per quarter note, 120 bpm like Music21's default
+TEMPO = 500000
+MIN_VELOCITY = 1
+MAX_VELOCITY = 127
+NOTE_OFF = 0
+NOTE_ON = 1
+
+
+class MidiWriter:
+    '''
+    Writes measures to a midi file. Measures and notes can be added as they
+    are generated, save() writes everything added so far and can be called
+    again as the song grows.
+    '''
+
+    def __init__(
+        self,
+        path: str = None,
+        n_parts: int = 1,
+        tempo: int = TEMPO,
+        ticks_per_beat: int = TICKS_PER_BEAT,
+    ) -> None:
+        self.path = path
+        self.tempo = tempo
+        self.ticks_per_beat = ticks_per_beat
+        # Per part: (tick, numerator, denominator) of every time signature
+        # change, start and length of the current measure in ticks, note words
+        # waiting for the rest of their note and (start, end, pitch, velocity)
+        # of the notes
+        self.time_signatures: List[List[Tuple[int, int, int]]] = [
+            [] for _ in range(n_parts)
+        ]
+        self.measure_ticks: List[int] = [None] * n_parts
+        self.bar_ticks: List[int] = [0] * n_parts
+        self.words: List[List[str]] = [[] for _ in range(n_parts)]
+        self.notes: List[List[Tuple[int, int, int, int]]] = [
+            [] for _ in range(n_parts)
+        ]
+
+    def start_measure(self, time_signature: tuple, part: int = 0) -> None:
+        numerator, denominator = int(time_signature[0]), int(time_signature[1])
+        if self.measure_ticks[part] is None:
+            tick = 0
+        else:
+            tick = self.measure_ticks[part] + self.bar_ticks[part]
+        self.measure_ticks[part] = tick
+        self.bar_ticks[part] = round(
+            numerator * 4 / denominator * self.ticks_per_beat
+        )
+        time_signatures = self.time_signatures[part]
+        if not time_signatures or time_signatures[-1][1:] != (numerator, denominator):
+            time_signatures.append((tick, numerator, denominator))
+
+    ''' Add a note to the current measure, offset and duration in quarters'''
+    def add_note(
+        self, pitch: int, duration: float, offset: float, velocity: int, part: int = 0
+    ) -> None:
+        if self.measure_ticks[part] is None:
+            raise Exception('A time signature must come before the first note.')
+        measure_tick = self.measure_ticks[part]
+        start = max(measure_tick + round(offset * self.ticks_per_beat), 0)
+        end = start + round(duration * self.ticks_per_beat)
+        # Notes out of the midi range or without length can not be written
+        if not 0 <= pitch <= 127 or end <= start:
+            return
+        velocity = min(max(int(velocity), MIN_VELOCITY), MAX_VELOCITY)
+        self.notes[part].append((start, end, pitch, velocity))
+
+    def add_measure(self, measure: Measure, part: int = 0) -> None:
+        self.start_measure(measure.time_signature, part)
+        rows = measure.rows
+        data = measure.data
+        for pitch, duration, offset, velocity in zip(
+            data.pitch[rows.start : rows.stop].tolist(),
+            data.duration[rows.start : rows.stop].tolist(),
+            data.offset[rows.start : rows.stop].tolist(),
+            data.velocity[rows.start : rows.stop].tolist(),
+        ):
+            self.add_note(pitch, duration, offset, velocity, part)
+
+    '''
+    Add words in the format of Song(string_list=...), time signatures and
+    valid notes of 4 words, as they are generated. A note may be split over
+    calls.
+    '''
+    def add_words(self, words: Iterable[str], part: int = 0) -> None:
+        note = self.words[part]
+        for word in words:
+            if '/' in word:
+                self.start_measure(word.split('/'), part)
+                note.clear()
+                continue
+            note.append(word)
+            if len(note) == 4:
+                name, duration, offset, velocity = note
+                note.clear()
+                self.add_note(
+                    parse_pitch_name(name)[0],
+                    float(duration),
+                    float(offset),
+                    int(velocity),
+                    part,
+                )
+
+    def add_song(self, song: Song) -> None:
+        for part, instrument in enumerate(song.parts):
+            for measure in instrument.measures:
+                self.add_measure(measure, part)
+
+    def channel(self, part: int) -> int:
+        # Channel 10 plays percussion, parts skip it
+        channel = part % 15
+        return channel + 1 if channel >= PERCUSSION_CHANNEL else channel
+
+    def save(self, path: str = None) -> None:
+        self.midi_file().save(path or self.path)
+
+    ''' Midi file of everything added so far'''
+    def midi_file(self) -> mido.MidiFile:
+        midi = mido.MidiFile(ticks_per_beat=self.ticks_per_beat)
+
+        shared = all(t == self.time_signatures[0] for t in self.time_signatures)
+        conductor = [(0, mido.MetaMessage('set_tempo', tempo=self.tempo, time=0))]
+        if shared:
+            conductor += time_signature_messages(self.time_signatures[0])
+        midi.tracks.append(to_track(conductor))
+
+        for part, notes in enumerate(self.notes):
+            channel = self.channel(part)
+            # Note offs before note ons at the same tick, so repeated notes
+            # are not cut
+            messages = [
+                (
+                    tick,
+                    mido.Message(
+                        'note_on' if kind == NOTE_ON else 'note_off',
+                        note=pitch,
+                        velocity=velocity,
+                        channel=channel,
+                    ),
+                )
+                for tick, kind, pitch, velocity in note_events(notes)
+            ]
+            if not shared:
+                messages = sorted(
+                    time_signature_messages(self.time_signatures[part]) + messages,
+                    key=lambda message: message[0],
+                )
+            midi.tracks.append(to_track(messages))
+        return midi
+
+
+# Note on and off events of (start, end, pitch, velocity) notes, a note ends
+# at the latest where the next note of the same pitch starts
+def note_events(
+    notes: List[Tuple[int, int, int, int]]
+) -> List[Tuple[int, int, int, int]]:
+    notes = sorted(notes)
+    ends = [end for _, end, _, _ in notes]
+    last = {}
+    for i, (start, _, pitch, _) in enumerate(notes):
+        if pitch in last:
+            ends[last[pitch]] = min(ends[last[pitch]], start)
+        last[pitch] = i
+    events = []
+    for (start, _, pitch, velocity), end in zip(notes, ends):
+        if end > start:
+            events.append((start, NOTE_ON, pitch, velocity))
+            events.append((end, NOTE_OFF, pitch, 0))
+    return sorted(events)
+
+
+def time_signature_messages(
+    time_signatures: List[Tuple[int, int, int]]
+) -> List[Tuple[int, mido.MetaMessage]]:
+    return [
+        (
+            tick,
+            mido.MetaMessage(
+                'time_signature', numerator=numerator, denominator=denominator
+            ),
+        )
+        for tick, numerator, denominator in time_signatures
+    ]
+
+
+# Track of (absolute tick, message) pairs sorted by tick
+def to_track(messages: Iterable[Tuple[int, mido.Message]]) -> mido.MidiTrack:
+    track = mido.MidiTrack()
+    last = 0
+    for tick, message in messages:
+        message.time = tick - last
+        track.append(message)
+        last = tick
+    track.append(mido.MetaMessage('end_of_track', time=0))
+    return track
+
+
+def write_song(song: Song, path: str) -> None:
+    writer = MidiWriter(path, n_parts=max(len(song.parts), 1))
+    writer.add_song(song)
+    writer.save()
+
+
+''' Write words in the format of Song(string_list=...) to a midi file'''
+def write_words(words: Iterable[str], path: str) -> None:
+    writer = MidiWriter(path)
+    writer.add_words(words)
+    writer.save()
@@ -1,26 +1,572 @@
 import mido
+from copy import copy
+from fractions import Fraction
+from math import floor
+from random import randint
+from typing import Dict, Iterator, List, Tuple, Union
 
-# class MusicObject:
-#     def __init__(self, song_name=None) -> None:
-#         self.song_name = song_name
+from simplified_song import Instrument, NoteData, SPELLING_ALTERS, compare_songs
+from simplified_song import Song as SimplifiedSong
+
+# Fast midi reader built directly on mido messages. It reproduces what
+# Music21's midi import (converter.parse) does to the notes a simplified song
+# keeps, without building any Music21 streams:
+#
+#   1. note on/off events are paired and notes starting and ending together
+#      are grouped into chords
+#   2. offsets and durations are quantized to sixteenths or triplet eighths
+#   3. notes are split into measures using the time signatures of the
+#      conductor track (or of the part itself)
+#   4. overlapping notes are moved into voices, which decides their order
+#   5. notes crossing a bar line are split into tied notes
+
+# Music21's default quantization units, in divisions of a quarter note
+QUARTER_LENGTH_DIVISORS = (4, 3)
+# Music21 stores offsets with at most this denominator
+DENOM_LIMIT = 65535
+# Music21 channels start at 1, channel 10 holds unpitched percussion
+PERCUSSION_CHANNEL = 9
+SUSTAIN_PEDAL = 64
+
+Offset = Union[float, Fraction]
+
+
+# Same representation of a quarter length as Music21's opFrac: floats for
+# binary fractions, Fractions for everything else
+def op_frac(value: Union[float, Fraction]) -> Offset:
+    value = Fraction(value).limit_denominator(DENOM_LIMIT)
+    if value.denominator & (value.denominator - 1) == 0:
+        return value.numerator / value.denominator
+    return value
+
+
+# Music21's common.nearestMultiple: (match, error)
+def nearest_multiple(n: float, unit: float) -> Tuple[float, float]:
+    mult = floor(n / unit)
+    match_low = unit * mult
+    match_high = unit * (mult + 1)
+    if match_low <= n <= match_low + unit / 2.0:
+        return match_low, round(n - match_low, 7)
+    return match_high, round(match_high - n, 7)
+
+
+# Music21's Stream.quantize bestMatch: (match, divisor) with the smallest
+# error, ties go to the smallest unit
+def best_match(target: float, divisors=QUARTER_LENGTH_DIVISORS) -> Tuple[float, int]:
+    found = []
+    for divisor in divisors:
+        match, error = nearest_multiple(target, 1 / divisor)
+        found.append((error, 1 / divisor, match, divisor))
+    _, _, match, divisor = sorted(found)[0]
+    return match, divisor
 
 
 class Pedal:
-    def __init__(self) -> None:
-        pass
+    '''
+    A sustain pedal press in ticks. Music21 ignores pedals so they are only
+    recorded, not applied to note durations.
+    '''
+
+    def __init__(self, offset: int = None, duration: int = None) -> None:
+        self.offset = offset
+        self.duration = duration
 
 
 class Note:
+    '''
+    A note as read from midi messages: pitch, duration and offset in ticks,
+    velocity and channel.
+    '''
+
     def __init__(
         self,
         note: int = None,
         duration: int = None,
         offset: int = None,
         velocity: int = None,
+        channel: int = 0,
     ) -> None:
-        pass
+        self.note = note
+        self.duration = duration
+        self.offset = offset
+        self.velocity = velocity
+        self.channel = channel
+
+    @property
+    def end(self) -> int:
+        return self.offset + self.duration
+
+
+class Element:
+    '''
+    A note or chord while measures are made, equivalent to the Music21 object
+    read from the midi file. Offsets are quarter lengths.
+    '''
+
+    def __init__(
+        self, notes: List[Note], offset: Offset, duration: Offset, is_chord: bool
+    ) -> None:
+        self.notes = notes
+        self.offset = offset
+        self.duration = duration
+        self.is_chord = is_chord
+        # Music21 reads channel 10 as unpitched, the simplified song skips it
+        self.percussion = any(n.channel == PERCUSSION_CHANNEL for n in notes)
+
+    @property
+    def end(self) -> Offset:
+        return op_frac(self.offset + self.duration)
+
+    def split(self, duration: Offset) -> 'Element':
+        remainder = Element(
+            self.notes, 0.0, op_frac(self.duration - duration), self.is_chord
+        )
+        self.duration = op_frac(duration)
+        return remainder
+
+
+class Track:
+    '''Notes, meta events and pedals of a midi track, times in ticks.'''
+
+    def __init__(self, track: mido.MidiTrack) -> None:
+        self.notes: List[Note] = []
+        self.time_signatures: List[Tuple[int, int, int]] = []
+        # Ticks of the meta events Music21 keeps in a part
+        self.meta_ticks: List[int] = []
+        self.pedals: List[Pedal] = []
+
+        # Note ons waiting for their note off, by channel and pitch
+        pending: Dict[Tuple[int, int], List[Note]] = {}
+        pedal_down: Dict[int, int] = {}
+        tick = 0
+        for message in track:
+            tick += message.time
+            if message.type == 'note_on' and message.velocity > 0:
+                note = Note(message.note, None, tick, message.velocity, message.channel)
+                self.notes.append(note)
+                pending.setdefault((message.channel, message.note), []).append(note)
+            elif message.type in ('note_on', 'note_off'):
+                waiting = pending.get((message.channel, message.note))
+                if waiting:
+                    note = waiting.pop(0)
+                    note.duration = tick - note.offset
+            elif message.type == 'time_signature':
+                self.time_signatures.append(
+                    (tick, message.numerator, message.denominator)
+                )
+                self.meta_ticks.append(tick)
+            elif message.type in (
+                'key_signature',
+                'set_tempo',
+                'instrument_name',
+                'track_name',
+                'program_change',
+            ):
+                self.meta_ticks.append(tick)
+            elif message.type == 'control_change' and message.control == SUSTAIN_PEDAL:
+                if message.value >= 64:
+                    pedal_down.setdefault(message.channel, tick)
+                elif message.channel in pedal_down:
+                    start = pedal_down.pop(message.channel)
+                    self.pedals.append(Pedal(start, tick - start))
+
+        # Music21 drops notes that are never turned off
+        self.notes = [n for n in self.notes if n.duration is not None]
+
+    @property
+    def has_notes(self) -> bool:
+        return len(self.notes) > 0
+
+
+class Measure:
+    '''A measure while it is being made, Music21's makeMeasures output.'''
+
+    def __init__(self, offset: Offset, bar: Offset, time_signature: tuple) -> None:
+        self.offset = offset
+        self.bar = bar
+        # Only set where the time signature changes, like Music21
+        self.time_signature = time_signature
+        # Elements directly in the measure and in voices, in insertion order
+        self.elements: List[Element] = []
+        self.voices: List[Tuple[int, List[Element]]] = []
+
+    def flattened(self) -> List[Element]:
+        '''Elements in the order of Music21's Measure.flatten()'''
+        containers = [elements for _, elements in self.voices] + [self.elements]
+        ordered = [
+            (e.offset, rank, i, e)
+            for rank, elements in enumerate(containers)
+            for i, e in enumerate(elements)
+        ]
+        ordered.sort(key=lambda item: item[:3])
+        return [e for _, _, _, e in ordered]
+
+
+def group_chords(notes: List[Note], ticks_per_beat: int) -> Tuple[List[List[Note]], bool]:
+    '''
+    Group notes into chords like Music21's midiTrackToStream. Returns the
+    groups and whether notes started together but ended apart, which makes
+    Music21 put notes into voices.
+    '''
+    tolerance = ticks_per_beat / max(QUARTER_LENGTH_DIVISORS)
+    groups = []
+    gathered = set()
+    voices_required = False
+    for i, note in enumerate(notes):
+        if i in gathered:
+            continue
+        chord = []
+        for j in range(i + 1, len(notes)):
+            other = notes[j]
+            if abs(other.offset - note.offset) < tolerance:
+                if abs(other.end - note.end) > tolerance:
+                    voices_required = True
+                    continue
+                if not chord:
+                    chord = [note]
+                    gathered.add(i)
+                chord.append(other)
+                gathered.add(j)
+            else:
+                break
+        groups.append(chord if chord else [note])
+    return groups, voices_required
+
+
+def quantize(groups: List[List[Note]], ticks_per_beat: int) -> List[Element]:
+    '''Quantize offsets and durations like Music21's Stream.quantize'''
+    elements = []
+    for i, notes in enumerate(groups):
+        offset, _ = best_match(notes[0].offset / ticks_per_beat)
+        offset = op_frac(offset)
+
+        # A chord lasts as long as its last note
+        ql = max(notes[-1].duration / ticks_per_beat, 0)
+        duration, _ = best_match(ql)
+        # Avoid small gaps to the next element by using its quantization unit
+        if i + 1 < len(groups):
+            next_offset, next_divisor = best_match(
+                groups[i + 1][0].offset / ticks_per_beat
+            )
+            gap = next_offset - (float(offset) + duration)
+            if 0 < gap < 1 / max(QUARTER_LENGTH_DIVISORS):
+                duration, _ = best_match(ql, (next_divisor,))
+        if duration == 0:
+            duration = 1 / max(QUARTER_LENGTH_DIVISORS)
+
+        elements.append(Element(notes, offset, op_frac(duration), len(notes) > 1))
+    return elements
+
+
+def quantize_ticks(tick: int, ticks_per_beat: int) -> Offset:
+    return op_frac(best_match(tick / ticks_per_beat)[0])
+
+
+def layering_sizes(spans: List[Tuple[Offset, Offset]]) -> int:
+    '''
+    Largest group of overlapping notes as found by Music21's getOverlaps,
+    which decides the number of voices of a measure.
+    '''
+    overlaps = [[] for _ in spans]
+    for i in range(len(spans)):
+        for j in range(i + 1, len(spans)):
+            a, b = sorted([spans[i], spans[j]])
+            if b[0] < a[1]:
+                overlaps[i].append(j)
+                overlaps[j].append(i)
+            else:
+                break
+
+    groups: Dict[Offset, List[int]] = {}
+
+    def stored(index):
+        for key, members in groups.items():
+            if index in members:
+                return key
+        return None
+
+    for i, indices in enumerate(overlaps):
+        if not indices:
+            continue
+        offset = None
+        for j in sorted(indices):
+            key = stored(j)
+            if key is not None:
+                offset = key
+            if offset is None:
+                offset = spans[i][0]
+            if key is None:
+                groups.setdefault(offset, []).append(j)
+        if stored(i) is None:
+            if offset is None:
+                offset = spans[i][0]
+            groups.setdefault(offset, []).append(i)
+
+    return max([len(members) for members in groups.values()], default=1)
+
+
+def make_voices(measure: Measure) -> None:
+    '''Move overlapping notes into voices like Music21's makeVoices'''
+    elements = sorted(measure.elements, key=lambda e: e.offset)
+    n_voices = layering_sizes([(e.offset, e.end) for e in elements])
+    if n_voices == 1:
+        return
+
+    voices = [[] for _ in range(n_voices)]
+    ends = [0] * n_voices
+    for e in elements:
+        for v in range(n_voices):
+            if ends[v] <= e.offset:
+                voices[v].append(e)
+                ends[v] = max(ends[v], e.end)
+                break
+        # Music21 loses elements that fit in no voice
+    measure.elements = []
+    measure.voices = [(v, voice) for v, voice in enumerate(voices) if voice]
+
+
+def make_measures(
+    elements: List[Element],
+    meter: List[Tuple[Offset, tuple]],
+    highest_time: Offset,
+    voices_required: bool,
+) -> List[Measure]:
+    '''
+    Split elements into measures like Music21's makeMeasures, makeVoices and
+    makeTies. meter holds (offset, time signature) sorted by offset.
+    '''
+    def active_time_signature(offset):
+        active = None
+        for ts_offset, ts in meter:
+            if ts_offset <= offset:
+                active = (ts_offset, ts)
+        return active
+
+    measures: List[Measure] = []
+    offset = 0.0
+    last = None
+    while True:
+        active = active_time_signature(offset)
+        ts = active[1]
+        bar = op_frac(Fraction(4 * ts[0], ts[1]))
+        measures.append(Measure(offset, bar, ts if active is not last else None))
+        last = active
+        offset = op_frac(offset + bar)
+        if offset >= highest_time:
+            break
+
+    end = offset
+
+    for e in sorted(elements, key=lambda e: e.offset):
+        for m in measures:
+            if m.offset <= e.offset < m.offset + m.bar:
+                e.offset = op_frac(e.offset - m.offset)
+                m.elements.append(e)
+                break
+
+    if voices_required:
+        for m in measures:
+            make_voices(m)
+
+    i = 0
+    while i < len(measures):
+        m = measures[i]
+        if i + 1 == len(measures):
+            measures.append(Measure(op_frac(m.offset + m.bar), m.bar, None))
+            added = True
+        else:
+            added = False
+        next_measure = measures[i + 1]
+        next_has_voices = bool(next_measure.voices)
+
+        bundle = m.voices if m.voices else [(None, m.elements)]
+        split = False
+        for voice_id, elements in bundle:
+            # Music21 visits the elements of a measure sorted by offset
+            for e in sorted(elements, key=lambda e: e.offset):
+                if e.end <= m.bar or e.offset >= m.bar:
+                    continue
+                remainder = e.split(op_frac(m.bar - e.offset))
+                split = True
+
+                if next_has_voices:
+                    # Voice ids of Music21 are unique objects that never match
+                    # a voice of the next measure, so remainders coming from a
+                    # voice stay outside of the voices and are not split again
+                    if voice_id is None:
+                        destination = next_measure.voices[0][1]
+                    else:
+                        destination = next_measure.elements
+                elif voice_id is not None:
+                    # Music21 moves all notes of the next measure into a voice
+                    if not next_measure.voices:
+                        next_measure.voices = [(0, next_measure.elements)]
+                        next_measure.elements = []
+                    destination = next_measure.voices[0][1]
+                else:
+                    destination = next_measure.elements
+                destination.append(remainder)
+
+        if added and not split:
+            measures.pop()
+        i += 1
+
+    # A time signature right at the end of the part is stored at its end,
+    # where Music21 finds it for the last measure while that one is empty.
+    # The rests filling the measure are then split at the new bar length.
+    last = measures[-1]
+    for ts_offset, ts in meter[1:]:
+        if ts_offset == end == highest_time and not last.flattened():
+            last.bar = op_frac(Fraction(4 * ts[0], ts[1]))
+            while last.offset + last.bar < end:
+                last = Measure(op_frac(last.offset + last.bar), last.bar, None)
+                measures.append(last)
+
+    for m in measures:
+        # A single voice is merged back into the measure after its elements
+        if len(m.voices) == 1:
+            m.elements += m.voices[0][1]
+            m.voices = []
+    return measures
+
+
+def measures_to_note_data(measures: List[Measure]) -> Tuple[NoteData, int]:
+    '''NoteData of measures and the number of Music21 notes they hold'''
+    data = NoteData()
+    time_signature = (4, 4)
+    n_notes = 0
+    for m in measures:
+        if m.time_signature is not None:
+            time_signature = m.time_signature
+        num_notes = 0
+        for e in m.flattened():
+            n_notes += 1
+            if e.percussion:
+                continue
+            # Notes of a Music21 chord keep their default duration of a
+            # quarter note, only the chord itself has the read duration
+            duration = 1.0 if e.is_chord else float(round(e.duration, 2))
+            offset = float(round(e.offset, 2))
+            # Chord notes stay in the order of their note on events, Chord's
+            # sortAscending() call returns a sorted copy
+            for note in e.notes:
+                data.pitch.append(note.note)
+                data.alter.append(SPELLING_ALTERS[note.note % 12])
+                data.duration.append(duration)
+                data.offset.append(offset)
+                data.velocity.append(note.velocity)
+            data.end_group(e.is_chord)
+            num_notes += 1
+        data.end_measure(time_signature, None, num_notes)
+    return data.freeze(), n_notes
 
 
 class Song:
+    '''
+    A midi file read with mido. The parts are simplified_song Instruments with
+    the same measures and notes Music21 would produce.
+    '''
+
     def __init__(self, midi_path=None, text_path=None) -> None:
-        pass
+        self.name: str = None
+        self.parts: List[Instrument] = []
+        self.time_signature: tuple = None
+        self.tracks: List[Track] = []
+        self.pedals: List[Pedal] = []
+        self.ticks_per_beat: int = None
+
+        if midi_path:
+            self.read_midi(midi_path)
+            self.name = midi_path[(-(midi_path[::-1].find('/'))) : -4]
+        elif text_path:
+            song = SimplifiedSong(path=text_path)
+            self.name = song.name
+            self.parts = song.parts
+
+    def read_midi(self, path: str) -> None:
+        self.parts = list(self.iter_parts(path))
+        if self.parts and self.parts[0].measures:
+            self.time_signature = self.parts[0].measures[0].time_signature
+
+    ''' Parts of a midi file, converted one track at a time'''
+    def iter_parts(self, path: str) -> Iterator[Instrument]:
+        midi = mido.MidiFile(path)
+        tpb = midi.ticks_per_beat
+        self.ticks_per_beat = tpb
+        self.tracks = [Track(track) for track in midi.tracks]
+        # Only the notes and events of the tracks are kept while the parts
+        # are made, not the messages of the whole file
+        del midi
+        self.pedals = [pedal for track in self.tracks for pedal in track.pedals]
+
+        # Time signatures of tracks without notes apply to every part
+        conductor = [t for t in self.tracks if not t.has_notes]
+        conductor_meter = [
+            (quantize_ticks(tick, tpb), (num, den))
+            for t in conductor
+            for tick, num, den in t.time_signatures
+        ]
+        conductor_ticks = [
+            quantize_ticks(tick, tpb) for t in conductor for tick in t.meta_ticks
+        ]
+        if conductor_meter and not any(o == 0 for o, _ in conductor_meter):
+            conductor_meter.insert(0, (0.0, (4, 4)))
+
+        for track in self.tracks:
+            if not track.has_notes:
+                continue
+
+            meter = conductor_meter or [
+                (quantize_ticks(tick, tpb), (num, den))
+                for tick, num, den in track.time_signatures
+            ]
+            if not meter or meter[0][0] > 0:
+                meter.insert(0, (0.0, (4, 4)))
+            meter.sort(key=lambda item: item[0])
+
+            groups, voices_required = group_chords(track.notes, tpb)
+            elements = quantize(groups, tpb)
+            highest_time = max(
+                [e.end for e in elements]
+                + [quantize_ticks(tick, tpb) for tick in track.meta_ticks]
+                + conductor_ticks
+            )
+            measures = make_measures(elements, meter, highest_time, voices_required)
+            data, n_notes = measures_to_note_data(measures)
+            yield Instrument.from_data(data, n_notes)
+
+
+def compare_readers(path: str, transpose: int = None) -> List[str]:
+    '''
+    Parity check of this reader against Music21, untransposed and transposed
+    like the dataset transposes songs, by a random number of semitones when
+    transpose is None. Returns the differences between the measures of both
+    readers, an empty list if they agree.
+    '''
+    if transpose is None:
+        transpose = randint(1, 11)
+    differences = []
+    for semitones in (0, transpose):
+        expected = SimplifiedSong(path=path, transpose=semitones)
+        if not expected.parsed:
+            return [f'Music21 could not read {path}']
+        song = SimplifiedSong(path=path, transpose=semitones, reader='mido')
+        # Streamed parts are transposed on their own
+        streamed = copy(song)
+        streamed.parts = list(SimplifiedSong.iter_parts(path, semitones, reader='mido'))
+        for name, other in (('', song), ('streamed ', streamed)):
+            differences += [
+                f'{name}transpose {semitones}: {difference}'
+                for difference in compare_songs(expected, other)
+            ]
+    return differences
+
+
+if __name__ == '__main__':
+    from sys import argv
+
+    for path in argv[1:]:
+        differences = compare_readers(path)
+        print(f'{path}: {"OK" if not differences else "DIFFERENT"}')
+        for difference in differences:
+            print(f'  {difference}')
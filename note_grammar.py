@@ -0,0 +1,243 @@
+import re
+from math import ceil
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+
+# Torch is imported when masks are built, so that checking text against the
+# grammar does not pay for its import
+if TYPE_CHECKING:
+    import torch
+
+# Grammar of the generated note language, checked one character at a time so
+# that it works with any tokenizer:
+#
+#   time signature -> (pitch -> duration -> offset -> velocity)* -> ...
+#
+# Words are separated by single spaces. Offsets never decrease inside a
+# measure and stay below the length of the bar. Numbers are matched by their
+# prefix, a prefix is allowed while some completion of it is still valid.
+
+# Fields of the grammar, ITEM is the start of a time signature or a pitch
+ITEM, TIME_SIGNATURE, PITCH, DURATION, OFFSET, VELOCITY = range(6)
+NEXT_FIELD = {
+    TIME_SIGNATURE: ITEM,
+    PITCH: DURATION,
+    DURATION: OFFSET,
+    OFFSET: VELOCITY,
+    VELOCITY: ITEM,
+}
+
+TIME_SIGNATURE_PREFIX = re.compile(r"([1-9]\d?)(/(\d{0,2}))?")
+MAX_NUMERATOR = 16
+DENOMINATORS = ("1", "2", "4", "8", "16", "32")
+PITCH_PREFIX = re.compile(r"[A-G]([#-]\d?|\d)?")
+PITCH_WORD = re.compile(r"[A-G][#-]?\d")
+# Quarter lengths of the dataset have at most two integer and two decimal
+# digits, they are compared as integer hundredths
+NUMBER_PREFIX = re.compile(r"(0|[1-9]\d?)(\.\d{0,2})?")
+NUMBER_WORD = re.compile(r"(0|[1-9]\d?)(\.\d{1,2})?")
+VELOCITY_PREFIX = re.compile(r"0|[1-9]\d{0,2}")
+MAX_VELOCITY = 127
+MAX_HUNDREDTHS = 9999
+# Masks cached per state before the cache is cleared
+MAX_CACHED_MASKS = 100000
+
+# (field, current word, bar length and last offset in hundredths)
+State = Tuple[int, str, Optional[int], Optional[int]]
+START: State = (ITEM, "", None, None)
+
+
+def hundredths(word: str) -> int:
+    integer, _, decimals = word.partition(".")
+    return int(integer) * 100 + int(decimals.ljust(2, "0"))
+
+
+def number_ranges(prefix: str) -> List[Tuple[int, int]]:
+    """Ranges of hundredths that completions of a number prefix can reach."""
+    integer, dot, decimals = prefix.partition(".")
+    if dot:
+        value = int(integer) * 100 + int(decimals.ljust(2, "0"))
+        return [(value, value + 10 ** (2 - len(decimals)) - 1)]
+    value = int(integer)
+    ranges = [(value * 100, value * 100 + 99)]
+    if len(integer) == 1 and value != 0:
+        ranges.append((value * 1000, value * 1000 + 999))
+    return ranges
+
+
+def reachable(prefix: str, low: int, high: int) -> bool:
+    return any(
+        max(start, low) <= min(end, high) for start, end in number_ranges(prefix)
+    )
+
+
+class NoteGrammar:
+    """
+    State machine of the note grammar over the tokens of a tokenizer. For a
+    state, mask() returns the tokens that keep the text valid, advance() moves
+    the state over a token.
+    """
+
+    def __init__(self, tokenizer) -> None:
+        self.tokenizer = tokenizer
+        self.eos_token_id = tokenizer.eos_token_id
+        self.special_ids = set(tokenizer.all_special_ids)
+        self.token_strings = [
+            None if i in self.special_ids else tokenizer.decode([i])
+            for i in range(len(tokenizer))
+        ]
+        self.masks: Dict[State, "torch.Tensor"] = {}
+
+    def feasible(self, field: int, word: str, bar: Optional[int], last: Optional[int]) -> bool:
+        if field == TIME_SIGNATURE:
+            match = TIME_SIGNATURE_PREFIX.fullmatch(word)
+            if match is None or int(match.group(1)) > MAX_NUMERATOR:
+                return False
+            denominator = match.group(3)
+            return denominator is None or any(
+                d.startswith(denominator) for d in DENOMINATORS
+            )
+        if field == PITCH:
+            return PITCH_PREFIX.fullmatch(word) is not None
+        if field == VELOCITY:
+            return (
+                VELOCITY_PREFIX.fullmatch(word) is not None
+                and int(word) <= MAX_VELOCITY
+            )
+        if NUMBER_PREFIX.fullmatch(word) is None:
+            return False
+        if field == DURATION:
+            return reachable(word, 1, MAX_HUNDREDTHS)
+        # Offsets do not decrease and stay inside the bar
+        return reachable(word, last, bar - 1)
+
+    def complete(self, field: int, word: str, bar: Optional[int], last: Optional[int]) -> bool:
+        if field == TIME_SIGNATURE:
+            return (
+                self.feasible(field, word, bar, last)
+                and word.partition("/")[2] in DENOMINATORS
+            )
+        if field == PITCH:
+            return PITCH_WORD.fullmatch(word) is not None
+        if field == VELOCITY:
+            return self.feasible(field, word, bar, last)
+        if field in (DURATION, OFFSET):
+            if NUMBER_WORD.fullmatch(word) is None:
+                return False
+            # The word ends here, so its own value has to be in range
+            value = hundredths(word)
+            if field == DURATION:
+                return 1 <= value <= MAX_HUNDREDTHS
+            return last <= value <= bar - 1
+        return False
+
+    def next_state(self, state: State) -> State:
+        field, word, bar, last = state
+        if field == TIME_SIGNATURE:
+            numerator, denominator = word.split("/")
+            bar = ceil(400 * int(numerator) / int(denominator))
+            last = 0
+        elif field == OFFSET:
+            last = hundredths(word)
+        return (NEXT_FIELD[field], "", bar, last)
+
+    def advance_char(self, state: State, char: str) -> Optional[State]:
+        field, word, bar, last = state
+        if char == " ":
+            if not self.complete(field, word, bar, last):
+                return None
+            return self.next_state(state)
+
+        if field == ITEM:
+            # The first character decides between a time signature and a note
+            if char.isdigit():
+                field = TIME_SIGNATURE
+            elif char in "ABCDEFG" and bar is not None:
+                field = PITCH
+            else:
+                return None
+        word += char
+        if not self.feasible(field, word, bar, last):
+            return None
+        return (field, word, bar, last)
+
+    def advance_text(self, state: Optional[State], text: str) -> Optional[State]:
+        for char in text:
+            if state is None:
+                return None
+            state = self.advance_char(state, char)
+        return state
+
+    def advance(self, state: State, token: int) -> Optional[State]:
+        if token in self.special_ids:
+            return state
+        return self.advance_text(state, self.token_strings[token])
+
+    def can_end(self, state: State) -> bool:
+        """Whether the text may end here, after a time signature or a note."""
+        field, word, bar, last = state
+        return field in (TIME_SIGNATURE, VELOCITY) and self.complete(
+            field, word, bar, last
+        )
+
+    def mask(self, state: State) -> "torch.Tensor":
+        """Tokens allowed in a state."""
+        import torch
+
+        mask = self.masks.get(state)
+        if mask is not None:
+            return mask
+
+        allowed = [
+            text is not None and self.advance_text(state, text) is not None
+            for text in self.token_strings
+        ]
+        if self.eos_token_id is not None:
+            allowed[self.eos_token_id] = self.can_end(state)
+        mask = torch.tensor(allowed)
+
+        if len(self.masks) >= MAX_CACHED_MASKS:
+            self.masks.clear()
+        self.masks[state] = mask
+        return mask
+
+    def constrain(self, state: State, scores: "torch.Tensor") -> "torch.Tensor":
+        mask = self.mask(state).to(scores.device)
+        if not mask.any():
+            raise Exception(f"No token continues the grammar in state {state}.")
+        return scores.masked_fill(~mask, float("-inf"))
+
+
+class NoteGrammarLogitsProcessor:
+    """
+    Logits processor for model.generate that masks the tokens breaking the
+    note grammar. Every row of the batch keeps its own state, which follows
+    the prompt and the generated tokens. Special tokens, like padding, are
+    ignored.
+    """
+
+    def __init__(self, grammar: NoteGrammar) -> None:
+        self.grammar = grammar
+        self.states: List[State] = []
+        self.consumed = 0
+
+    def __call__(
+        self, input_ids: "torch.LongTensor", scores: "torch.FloatTensor"
+    ) -> "torch.FloatTensor":
+        import torch
+
+        if not self.states:
+            self.states = [START] * input_ids.shape[0]
+
+        for row, ids in enumerate(input_ids[:, self.consumed :].tolist()):
+            for token in ids:
+                self.states[row] = self.grammar.advance(self.states[row], token)
+            if self.states[row] is None:
+                raise Exception(f"Text of row {row} does not follow the note grammar.")
+        self.consumed = input_ids.shape[1]
+
+        return torch.stack(
+            [
+                self.grammar.constrain(state, row_scores)
+                for state, row_scores in zip(self.states, scores)
+            ]
+        )
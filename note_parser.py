@@ -0,0 +1,208 @@
+import re
+from itertools import product
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from simplified_song import Instrument, Note, NoteData, parse_pitch_name
+
+# Bulk parser for text in the format of as_string: a time signature followed
+# by the notes of its measure, for every measure, words separated by single
+# spaces. A whole row is validated by a single regex match, then its words
+# are sliced into columns and converted by numpy.
+#
+# Notes are stricter than Note.is_valid: numbers are plain decimals, so
+# 'nan', '1e3' or '1_0' are rejected, and time signatures are n/d numbers.
+# Instrument(string=...), Instrument.sanitize and the NoteValidator of
+# generate_music take the bulk path for text valid here and go on word by
+# word from the first word that is not, so they accept what they did before.
+
+TIME_SIGNATURE = r'\d+/\d+'
+# The names Note.is_valid accepts, 2 to 3 characters long
+PITCH = r'[A-G](?:##|--|[#-]\d?|\d\d?)'
+FLOAT = r'[+-]?(?:\d+(?:\.\d*)?|\.\d+)'
+INT = r'[+-]?\d+'
+NOTE = f'{PITCH} {FLOAT} {FLOAT} {INT}'
+TEXT_REGEX = re.compile(f'{TIME_SIGNATURE}(?: {NOTE})*(?: {TIME_SIGNATURE}(?: {NOTE})*)*')
+# A time signature or a note followed by a space or the end of the text
+TIME_SIGNATURE_UNIT_REGEX = re.compile(f'{TIME_SIGNATURE}(?: |$)')
+NOTE_UNIT_REGEX = re.compile(f'{NOTE}(?: |$)')
+# Each word of a note, to point at the invalid one
+NOTE_WORD_REGEXES = [re.compile(regex) for regex in (PITCH, FLOAT, FLOAT, INT)]
+NOTE_REGEX = re.compile(NOTE)
+# Measures with at least one note each, the words sanitize keeps at once
+SANITIZED_REGEX = re.compile(f'(?:{TIME_SIGNATURE}(?: {NOTE})+(?: |\\Z))*')
+
+# Every name PITCH matches, with the midi number and alter of each
+PITCH_NAMES = [
+    step + rest
+    for step, rest in product(
+        'ABCDEFG',
+        ['##', '--', '#', '-']
+        + [a + d for a, d in product('#-', '0123456789')]
+        + [str(octave) for octave in range(100)],
+    )
+]
+PITCH_NAME_CODES = {name: i for i, name in enumerate(PITCH_NAMES)}
+PITCH_NAME_PITCH, PITCH_NAME_ALTER = np.array(
+    [parse_pitch_name(name) for name in PITCH_NAMES]
+).T
+
+
+''' Word index of the first invalid word of text, -1 if text is valid'''
+def validate_text(text: str) -> int:
+    if not text or TEXT_REGEX.fullmatch(text) is not None:
+        return -1
+    return first_invalid(text)[1]
+
+
+''' Character and word index of the first invalid word of text, if any'''
+def first_invalid(text: str) -> Tuple[int, int]:
+    position = 0
+    word = 0
+    # Notes can only follow a time signature
+    unit_regexes = (TIME_SIGNATURE_UNIT_REGEX,)
+    while position < len(text):
+        for regex in unit_regexes:
+            match = regex.match(text, position)
+            if match is not None:
+                break
+        else:
+            if len(unit_regexes) > 1:
+                word += invalid_note_word(text[position:].split(' ', 4))
+            return position, word
+        word += 1 if regex is TIME_SIGNATURE_UNIT_REGEX else 4
+        position = match.end()
+        unit_regexes = (TIME_SIGNATURE_UNIT_REGEX, NOTE_UNIT_REGEX)
+    if text.endswith(' '):
+        # The empty word after the last space
+        return len(text), word
+    return -1, -1
+
+
+''' Index of the invalid word in the words of a note'''
+def invalid_note_word(words: List[str]) -> int:
+    for i, (word, regex) in enumerate(zip(words, NOTE_WORD_REGEXES)):
+        if regex.fullmatch(word) is None:
+            return i
+    # The text ends before the last word of the note
+    return len(words)
+
+
+'''
+Note data of the measures in text and the word index of the first invalid
+word, -1 if all words are valid. Parsing stops at the first invalid word,
+the measures before it are kept. The data is the same as that of
+Instrument(string=...) for the same measures.
+'''
+def parse_text(text: str) -> Tuple[NoteData, int]:
+    bad_word = -1
+    if text and TEXT_REGEX.fullmatch(text) is None:
+        end, bad_word = first_invalid(text)
+        text = text[:end].rstrip(' ')
+    return parse_valid_text(text), bad_word
+
+
+''' Note data of valid text, every measure is a time signature and notes'''
+def parse_valid_text(text: str) -> NoteData:
+    data = NoteData()
+    if not text:
+        return data.freeze()
+
+    words = text.split(' ')
+    time_signatures = [i for i, word in enumerate(words) if '/' in word]
+    notes = []
+    counts = []
+    for start, end in zip(time_signatures, time_signatures[1:] + [len(words)]):
+        notes += words[start + 1 : end]
+        counts.append((end - start - 1) // 4)
+
+    codes = np.array(list(map(PITCH_NAME_CODES.__getitem__, notes[0::4])), dtype=np.int16)
+    data.pitch = PITCH_NAME_PITCH[codes].astype(np.int16)
+    data.alter = PITCH_NAME_ALTER[codes].astype(np.int8)
+    data.duration = np.array(notes[1::4], dtype=np.float64)
+    offset_words = np.array(notes[2::4])
+    data.offset = offset_words.astype(np.float64)
+    data.velocity = np.array(list(map(int, notes[3::4])), dtype=np.int16)
+
+    # Notes with the same offset word in a measure form a chord
+    n_measures = len(counts)
+    measure = np.repeat(np.arange(n_measures), counts)
+    n_notes = len(measure)
+    new_group = np.ones(n_notes, dtype=bool)
+    new_group[1:] = (measure[1:] != measure[:-1]) | (offset_words[1:] != offset_words[:-1])
+    group_starts = np.flatnonzero(new_group)
+    data.group_starts = np.append(group_starts, n_notes).astype(np.int32)
+    data.group_is_chord = np.diff(data.group_starts) > 1
+
+    data.measure_starts = np.searchsorted(
+        measure[group_starts], np.arange(n_measures + 1)
+    ).astype(np.int32)
+    data.time_signatures = [tuple(words[i].split('/')) for i in time_signatures]
+    data.measure_offsets = [None] * n_measures
+    # Float counts like add_string_measure
+    data.measure_num_notes = [float(count) for count in counts]
+    return data
+
+
+'''
+Note data and number of note words of text, read like Instrument(string=...)
+reads it: the last measure is left out, as it only ends at the next time
+signature. None if text is not valid, it is then read word by word.
+'''
+def parse_measures(text: str) -> Optional[Tuple[NoteData, int]]:
+    if TEXT_REGEX.fullmatch(text) is None:
+        return None
+    # Only time signatures hold a '/'
+    n_note_words = text.count(' ') + 1 - text.count('/')
+    end = text.rfind(' ', 0, text.rfind('/'))
+    return parse_valid_text(text[:max(end, 0)]), n_note_words
+
+
+'''
+Number of words at the start of text that Instrument.sanitize keeps, found
+by a single match: measures that have notes, all of them valid.
+'''
+def sanitized_words(text: str) -> int:
+    end = SANITIZED_REGEX.match(text).end()
+    if not end:
+        return 0
+    # The match ends after a space or at the end of the text
+    return text.count(' ', 0, end) + (text[end - 1] != ' ')
+
+
+''' Note.is_valid, with a single match for the notes valid here'''
+def is_valid_note(words: List[str]) -> bool:
+    return NOTE_REGEX.fullmatch(' '.join(words)) is not None or Note.is_valid(words)
+
+
+''' Instrument of the measures in text, raises at the first invalid word'''
+def parse_instrument(text: str) -> Instrument:
+    data, bad_word = parse_text(text)
+    if bad_word >= 0:
+        words = text.split(' ')
+        word = words[bad_word] if bad_word < len(words) else ''
+        raise Exception(f'Invalid word {word!r} at word {bad_word}.')
+    return Instrument.from_data(data, data.n_notes)
+
+
+''' (line number, word index) of every invalid row of a text file'''
+def validate_file(path: str) -> Iterator[Tuple[int, int]]:
+    with open(path, 'r') as f:
+        for i, line in enumerate(f):
+            bad_word = validate_text(line.rstrip('\n'))
+            if bad_word >= 0:
+                yield i, bad_word
+
+
+if __name__ == '__main__':
+    from sys import argv
+    from time import perf_counter
+
+    for path in argv[1:]:
+        start = perf_counter()
+        n_invalid = 0
+        for line, word in validate_file(path):
+            n_invalid += 1
+            print(f'{path}:{line + 1}: invalid word {word}')
+        print(f'{path}: {n_invalid} invalid rows, {perf_counter() - start:.2f}s')
@@ -0,0 +1,235 @@
+from typing import Dict, List, Union
+
+import numpy as np
+
+from simplified_song import (
+    Instrument,
+    Measure,
+    NoteData,
+    SPELLING_ALTERS,
+    parse_pitch_name,
+    time_signature_to_string,
+)
+
+# Fixed vocabulary tokenizer for the note language of simplified_song. Every
+# field of a note is a single token from its own range of ids:
+#
+#   4/4 G#4 0.5 2.5 100  ->  TS_4/4 P_68 D_6 O_30 V_25
+#
+# Pitches are midi numbers, durations and offsets count twelfths of a quarter
+# note (the grid Music21 quantizes midi files to) and velocities are binned.
+# A measure takes 1 + 4 * notes tokens, the same count as the tokens of
+# Measure.as_string(tokenize=True), so dataset rows map one to one.
+
+SPECIAL_TOKENS = ['<pad>', '<bos>', '<eos>', '<unk>']
+PAD, BOS, EOS, UNK = range(len(SPECIAL_TOKENS))
+
+TIME_SIGNATURE_NUMERATORS = range(1, 17)
+TIME_SIGNATURE_DENOMINATORS = (1, 2, 4, 8, 16, 32)
+N_PITCHES = 128
+# Durations and offsets are quantized to STEPS_PER_QUARTER steps of a
+# quarter note, longer values are clipped to MAX_STEPS
+STEPS_PER_QUARTER = 12
+MAX_STEPS = 16 * STEPS_PER_QUARTER
+VELOCITY_BIN_SIZE = 4
+N_VELOCITY_BINS = 128 // VELOCITY_BIN_SIZE
+
+
+def build_vocabulary() -> List[str]:
+    vocabulary = list(SPECIAL_TOKENS)
+    vocabulary += [
+        f'TS_{n}/{d}'
+        for n in TIME_SIGNATURE_NUMERATORS
+        for d in TIME_SIGNATURE_DENOMINATORS
+    ]
+    vocabulary += [f'P_{p}' for p in range(N_PITCHES)]
+    vocabulary += [f'D_{s}' for s in range(MAX_STEPS + 1)]
+    vocabulary += [f'O_{s}' for s in range(MAX_STEPS + 1)]
+    vocabulary += [f'V_{v}' for v in range(N_VELOCITY_BINS)]
+    return vocabulary
+
+
+VOCABULARY = build_vocabulary()
+TOKEN_IDS = {token: i for i, token in enumerate(VOCABULARY)}
+PITCH_START = TOKEN_IDS['P_0']
+DURATION_START = TOKEN_IDS['D_0']
+OFFSET_START = TOKEN_IDS['O_0']
+VELOCITY_START = TOKEN_IDS['V_0']
+
+
+def quantize_steps(values: np.ndarray) -> np.ndarray:
+    return np.clip(np.rint(values * STEPS_PER_QUARTER), 0, MAX_STEPS).astype(np.int64)
+
+
+class NoteTokenizer:
+    '''
+    Encodes measures and instruments to ids of a fixed vocabulary and decodes
+    ids back to them. Encoding reads the NoteData arrays directly, decoding
+    builds NoteData without going through strings.
+
+    Decoding gives the spelling Music21 uses for midi files to every pitch,
+    and the middle velocity of every bin. Everything else read from a midi
+    file survives a round trip unchanged.
+
+    Text in the format of as_string can be tokenized too by calling the
+    tokenizer, like a Hugging Face tokenizer, which lets dataset_shards write
+    rows with it.
+    '''
+
+    def __init__(self) -> None:
+        self.vocabulary = VOCABULARY
+        self.token_ids = TOKEN_IDS
+        self.pad_token_id = PAD
+        self.bos_token_id = BOS
+        self.eos_token_id = EOS
+        self.unk_token_id = UNK
+
+    def __len__(self) -> int:
+        return len(self.vocabulary)
+
+    def time_signature_id(self, time_signature: tuple) -> int:
+        return self.token_ids.get(
+            'TS_' + time_signature_to_string(time_signature), UNK
+        )
+
+    ''' Ids of rows start:end of note data, four per note'''
+    def encode_rows(self, data: NoteData, start: int, end: int) -> np.ndarray:
+        ids = np.empty((end - start, 4), dtype=np.int64)
+        ids[:, 0] = PITCH_START + np.clip(data.pitch[start:end], 0, N_PITCHES - 1)
+        ids[:, 1] = DURATION_START + quantize_steps(data.duration[start:end])
+        ids[:, 2] = OFFSET_START + quantize_steps(data.offset[start:end])
+        ids[:, 3] = VELOCITY_START + (
+            np.clip(data.velocity[start:end], 0, N_PITCHES - 1) // VELOCITY_BIN_SIZE
+        )
+        return ids.ravel()
+
+    def encode_measure(self, measure: Measure) -> List[int]:
+        rows = measure.rows
+        return [self.time_signature_id(measure.time_signature)] + self.encode_rows(
+            measure.data, rows.start, rows.stop
+        ).tolist()
+
+    def encode(
+        self, part: Union[Instrument, List[Measure]], bos=False, eos=False
+    ) -> List[int]:
+        measures = part.measures if isinstance(part, Instrument) else part
+        ids = [BOS] if bos else []
+        for measure in measures:
+            ids += self.encode_measure(measure)
+        if eos:
+            ids.append(EOS)
+        return ids
+
+    ''' Ids of text in the format of as_string, unknown words become <unk>'''
+    def encode_text(self, text: str) -> List[int]:
+        words = text.split()
+        ids = []
+        i = 0
+        while i < len(words):
+            if '/' in words[i]:
+                ids.append(self.token_ids.get('TS_' + words[i], UNK))
+                i += 1
+                continue
+            note = words[i : i + 4]
+            try:
+                pitch, _ = parse_pitch_name(note[0])
+                steps = quantize_steps(np.array([float(note[1]), float(note[2])]))
+                velocity = min(max(int(note[3]), 0), N_PITCHES - 1)
+            except Exception:
+                ids += [UNK] * len(note)
+            else:
+                ids += [
+                    PITCH_START + min(max(pitch, 0), N_PITCHES - 1),
+                    DURATION_START + int(steps[0]),
+                    OFFSET_START + int(steps[1]),
+                    VELOCITY_START + velocity // VELOCITY_BIN_SIZE,
+                ]
+            i += 4
+        return ids
+
+    def __call__(
+        self, text: Union[str, List[str]], truncation=False, max_length=None
+    ) -> Dict[str, list]:
+        texts = [text] if isinstance(text, str) else text
+        ids = [self.encode_text(t) for t in texts]
+        if truncation and max_length:
+            ids = [row[:max_length] for row in ids]
+        return {'input_ids': ids[0] if isinstance(text, str) else ids}
+
+    ''' Instrument of the measures in ids, tokens out of place are skipped'''
+    def decode(self, ids: List[int]) -> Instrument:
+        data = NoteData()
+        time_signature = None
+        # Rows of the current measure as (pitch, duration, offset, velocity)
+        notes = []
+        i = 0
+        while i < len(ids):
+            token = self.vocabulary[ids[i]] if 0 <= ids[i] < len(self) else None
+            if token is not None and token.startswith('TS_'):
+                if time_signature is not None:
+                    self.add_measure(data, time_signature, notes)
+                time_signature = tuple(int(v) for v in token[3:].split('/'))
+                notes = []
+                i += 1
+            elif time_signature is not None and self.is_note(ids[i : i + 4]):
+                notes.append(ids[i : i + 4])
+                i += 4
+            else:
+                i += 1
+        if time_signature is not None:
+            self.add_measure(data, time_signature, notes)
+
+        data.freeze()
+        return Instrument.from_data(data, data.n_notes)
+
+    def decode_measure(self, ids: List[int]) -> Measure:
+        part = self.decode(ids)
+        if not part.measures:
+            raise Exception('Ids do not hold a measure.')
+        return part.measures[0]
+
+    ''' Text in the format of as_string'''
+    def decode_text(self, ids: List[int]) -> str:
+        return self.decode(ids).as_string()
+
+    def is_note(self, ids: List[int]) -> bool:
+        starts = (PITCH_START, DURATION_START, OFFSET_START, VELOCITY_START)
+        ends = (DURATION_START, OFFSET_START, VELOCITY_START, len(self))
+        return len(ids) == 4 and all(
+            start <= i < end for i, start, end in zip(ids, starts, ends)
+        )
+
+    def add_measure(
+        self, data: NoteData, time_signature: tuple, notes: List[List[int]]
+    ) -> None:
+        num_notes = 0
+        i = 0
+        while i < len(notes):
+            # Notes with the same offset form a chord, like add_string_measure
+            j = i + 1
+            while j < len(notes) and notes[j][2] == notes[i][2]:
+                j += 1
+            for pitch, duration, offset, velocity in notes[i:j]:
+                pitch -= PITCH_START
+                data.pitch.append(pitch)
+                data.alter.append(SPELLING_ALTERS[pitch % 12])
+                data.duration.append(self.steps_to_quarters(duration - DURATION_START))
+                data.offset.append(self.steps_to_quarters(offset - OFFSET_START))
+                data.velocity.append(
+                    (velocity - VELOCITY_START) * VELOCITY_BIN_SIZE
+                    + VELOCITY_BIN_SIZE // 2
+                )
+            data.end_group(j - i > 1)
+            num_notes += j - i
+            i = j
+        data.end_measure(time_signature, None, num_notes)
+
+    # Quarter lengths with two decimals, like the values read from midi files
+    def steps_to_quarters(self, steps: int) -> float:
+        return round(steps / STEPS_PER_QUARTER, 2)
+
+    def convert_ids_to_tokens(self, ids: List[int]) -> List[str]:
+        return [self.vocabulary[i] for i in ids]
+
+    def convert_tokens_to_ids(self, tokens: List[str]) -> List[int]:
+        return [self.token_ids.get(token, UNK) for token in tokens]
@@ -0,0 +1,220 @@
+import copy
+import os
+import random
+from argparse import ArgumentParser
+from time import perf_counter
+from typing import Dict, TYPE_CHECKING
+
+import torch
+from torch import nn
+
+from generate_music import (
+    DEFAULT_MODEL_PATH,
+    DEVICE,
+    TEMPERATURE,
+    TOKENIZER_PATH,
+    TOP_K,
+    random_prompt,
+    tiny_model,
+)
+from simplified_song import Instrument
+
+if TYPE_CHECKING:
+    from transformers import GPT2LMHeadModel, GPT2TokenizerFast
+
+# Dynamic int8 quantization of the model for CPU inference. Weights of the
+# linear layers are stored as int8 and activations are quantized on the fly,
+# which needs no calibration data. GPT-2 keeps its attention and MLP weights
+# in transformers' Conv1D layers, they are turned into nn.Linear first so
+# that quantize_dynamic finds them.
+#
+# torch.ao.quantization is deprecated in favour of torchao and warns about it
+# on recent torch versions. quantize_dynamic still works there, moving to
+# torchao would add a dependency and change the checkpoint format.
+#
+#   python quantize_model.py music-gpt2-2.3 --output music-gpt2-2.3-int8
+#   python quantize_model.py music-gpt2-2.3 --compare
+#   python generate_music.py music-gpt2-2.3-int8
+
+# Weights of a quantized checkpoint, next to the config of the model
+QUANTIZED_WEIGHTS = "quantized_int8.pt"
+# Songs and tokens per song of the fp32/int8 comparison
+COMPARE_SONGS = 8
+COMPARE_TOKENS = 256
+SEED = 0
+
+
+def to_linear(model: nn.Module) -> nn.Module:
+    """Replace the Conv1D layers of a model by equal nn.Linear layers."""
+    from transformers.pytorch_utils import Conv1D
+
+    for module in list(model.modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                # Conv1D stores its weight as (in, out)
+                linear = nn.Linear(*child.weight.shape)
+                linear.weight.data = child.weight.data.t().contiguous()
+                linear.bias.data = child.bias.data
+                setattr(module, child_name, linear)
+    return model
+
+
+def quantize(model: "GPT2LMHeadModel") -> "GPT2LMHeadModel":
+    from torch.ao.quantization import quantize_dynamic
+
+    model = to_linear(model.eval())
+    return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def is_quantized(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, QUANTIZED_WEIGHTS))
+
+
+def save_quantized(model: "GPT2LMHeadModel", path: str) -> None:
+    os.makedirs(path, exist_ok=True)
+    model.config.save_pretrained(path)
+    torch.save(model.state_dict(), os.path.join(path, QUANTIZED_WEIGHTS))
+    print(f"Saved quantized model to {path}")
+
+
+def load_quantized(path: str) -> "GPT2LMHeadModel":
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    # The quantized modules are built from a model of the same config
+    model = quantize(GPT2LMHeadModel(GPT2Config.from_pretrained(path)))
+    # The packed int8 weights are quantized tensors, scales and dtypes, which
+    # torch.load unpickles without running code
+    state = torch.load(os.path.join(path, QUANTIZED_WEIGHTS), weights_only=True)
+    model.load_state_dict(state)
+    return model.eval()
+
+
+def load_model(path: str, int8: bool = False, device: str = DEVICE) -> "GPT2LMHeadModel":
+    """
+    Model at path, quantized when int8 is set or when path holds a quantized
+    checkpoint. Quantized models run on the CPU only.
+    """
+    from transformers import GPT2LMHeadModel
+
+    if is_quantized(path):
+        print(f"Loading quantized model at path {path}")
+        model = load_quantized(path)
+    else:
+        print(f"Loading model at path {path}")
+        model = GPT2LMHeadModel.from_pretrained(path)
+        if int8:
+            model = quantize(model)
+    if device != "cpu" and (int8 or is_quantized(path)):
+        raise Exception(f"int8 models run on the cpu, not on {device}.")
+    return model.to(device).eval()
+
+
+def validity(words: str) -> float:
+    """Share of the words of a generated song that Instrument.sanitize keeps."""
+    string_list = words.split(" ")
+    return len(Instrument.sanitize(words)[0]) / len(string_list)
+
+
+@torch.no_grad()
+def measure(
+    model: "GPT2LMHeadModel",
+    tokenizer: "GPT2TokenizerFast",
+    n_songs: int = COMPARE_SONGS,
+    n_tokens: int = COMPARE_TOKENS,
+    seed: int = SEED,
+) -> Dict[str, float]:
+    """
+    Tokens/s and note validity of n_songs songs generated in one batch.
+    Generation is not constrained by the note grammar, so validity is the
+    model's own.
+    """
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    prompts = [random_prompt(random.Random(s)) for s in range(seed, seed + n_songs)]
+    inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(model.device)
+    prompt_length = inputs["input_ids"].shape[1]
+    options = dict(
+        do_sample=True,
+        top_k=TOP_K,
+        temperature=TEMPERATURE,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    # A short first run so that one time setup is not timed
+    model.generate(**inputs, max_new_tokens=8, **options)
+
+    torch.manual_seed(seed)
+    start = perf_counter()
+    output = model.generate(**inputs, max_new_tokens=n_tokens, **options)
+    elapsed = perf_counter() - start
+
+    n_generated = 0
+    rates = []
+    for prompt, ids in zip(prompts, output[:, prompt_length:].tolist()):
+        if tokenizer.eos_token_id in ids:
+            ids = ids[: ids.index(tokenizer.eos_token_id)]
+        n_generated += len(ids)
+        rates.append(validity(prompt + tokenizer.decode(ids)))
+    return {
+        "tokens_per_s": n_generated / elapsed,
+        "seconds_per_song": elapsed / n_songs,
+        "validity": sum(rates) / len(rates),
+    }
+
+
+def compare(
+    model: "GPT2LMHeadModel",
+    tokenizer: "GPT2TokenizerFast",
+    n_songs: int = COMPARE_SONGS,
+    n_tokens: int = COMPARE_TOKENS,
+    seed: int = SEED,
+) -> Dict[str, Dict[str, float]]:
+    """Speed and note validity of the model and of its int8 quantization."""
+    results = {"fp32": measure(model, tokenizer, n_songs, n_tokens, seed)}
+    # Conv1D layers are replaced in place, the fp32 model is left as it is
+    quantized = quantize(copy.deepcopy(model))
+    results["int8"] = measure(quantized, tokenizer, n_songs, n_tokens, seed)
+    for name, result in results.items():
+        print(
+            f"{name}: {result['tokens_per_s']:.1f} tokens/s, "
+            f"{result['seconds_per_song']:.2f}s per song, "
+            f"{result['validity']:.1%} valid words"
+        )
+    speedup = results["int8"]["tokens_per_s"] / results["fp32"]["tokens_per_s"]
+    print(f"int8 speedup: {speedup:.2f}x")
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Quantize the model to int8 for CPU inference.")
+    parser.add_argument("model_path", nargs="?", default=DEFAULT_MODEL_PATH)
+    parser.add_argument("--output", help="Save the quantized model at this path")
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="Compare tokens/s and note validity of fp32 and int8",
+    )
+    parser.add_argument(
+        "--tiny", action="store_true", help="Use a tiny random model instead"
+    )
+    parser.add_argument("--songs", type=int, default=COMPARE_SONGS)
+    parser.add_argument("--tokens", type=int, default=COMPARE_TOKENS)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--threads", type=int, help="Torch threads, all by default")
+    args = parser.parse_args()
+
+    from transformers import GPT2LMHeadModel, GPT2TokenizerFast
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    tokenizer = GPT2TokenizerFast.from_pretrained(TOKENIZER_PATH)
+    if args.tiny:
+        torch.manual_seed(args.seed)
+        model = tiny_model(tokenizer)
+    else:
+        model = GPT2LMHeadModel.from_pretrained(args.model_path).eval()
+
+    if args.compare:
+        compare(model, tokenizer, args.songs, args.tokens, args.seed)
+    if args.output:
+        save_quantized(quantize(model), args.output)
@@ -1,16 +1,25 @@
+from collections import OrderedDict
+from copy import copy
 from fractions import Fraction
+from functools import lru_cache
 from random import randint
+import re
 import traceback
 
-from typing import List, Union, Tuple
-from music21.stream import Measure as m21Measure
-from music21.note import Note as m21Note
-from music21.chord import Chord as m21Chord
-from music21.stream import Part as m21Part
-from music21.meter import TimeSignature
-from music21.converter import parse as m21parse
-from music21.stream import Score
-from music21.midi.translate import streamToMidiFile
+import numpy as np
+
+from typing import Iterable, Iterator, List, Optional, Union, Tuple, TYPE_CHECKING
+
+from metrics import NO_METRICS, Metrics
+from song_cache import SongCache
+
+# Music21 takes seconds to import, so it is imported where midi files are
+# read or written. Working with strings never imports it.
+if TYPE_CHECKING:
+    from music21.stream import Measure as m21Measure
+    from music21.note import Note as m21Note
+    from music21.chord import Chord as m21Chord
+    from music21.stream import Part as m21Part
 
 
 # Convert time signature to tuple: '4/4' -> (4,4)
@@ -22,6 +31,373 @@ def time_signature_to_string(t: tuple) -> str:
     return f'{t[0]}/{t[1]}'
 
 
+STEPS = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+STEP_NAMES = {v: k for k, v in STEPS.items()}
+ACCIDENTALS = {'': 0, '#': 1, '##': 2, '-': -1, '--': -2}
+ACCIDENTAL_NAMES = {v: k for k, v in ACCIDENTALS.items()}
+# Spelling Music21 gives the pitches of midi notes
+SPELLINGS = ['C', 'C#', 'D', 'E-', 'E', 'F', 'F#', 'G', 'G#', 'A', 'B-', 'B']
+SPELLING_ALTERS = np.array([ACCIDENTALS[s[1:]] for s in SPELLINGS], dtype=np.int8)
+# Music21 reads 'C-1' as C flat in octave 1, the accidental is matched first
+PITCH_NAME_REGEX = re.compile(r'([A-G])(##|--|#|-|)(-?\d+)?')
+# Range of midi pitches, transpose() refuses to move notes out of it
+MIN_PITCH = 0
+MAX_PITCH = 127
+# Midi readers, mido_song reads the same measures as Music21 much faster
+READERS = ('music21', 'mido')
+# Midi writers, midi_writer writes measures at their full bar length
+WRITERS = ('music21', 'mido')
+# Characters read at a time from text songs
+TEXT_CHUNK_SIZE = 1 << 20
+# Serialized measures kept in MEASURE_CACHE, shared by every song
+MEASURE_CACHE_SIZE = 1 << 16
+
+
+# Convert pitch name to midi number and accidental: 'C#4' -> (61, 1).
+# Octave defaults to 4 like in Music21.
+def parse_pitch_name(name: str) -> Tuple[int, int]:
+    match = PITCH_NAME_REGEX.fullmatch(name)
+    if match is None:
+        raise Exception(f'Cannot convert {name} to a pitch.')
+    step, accidental, octave = match.groups()
+    octave = 4 if octave is None else int(octave)
+    alter = ACCIDENTALS[accidental]
+    return (octave + 1) * 12 + STEPS[step] + alter, alter
+
+
+# Convert midi number and accidental to pitch name: (61, 1) -> 'C#4'
+@lru_cache(maxsize=None)
+def pitch_to_name(midi: int, alter: int) -> str:
+    natural = midi - alter
+    return f'{STEP_NAMES[natural % 12]}{ACCIDENTAL_NAMES[alter]}{natural // 12 - 1}'
+
+
+# Convert pitch name to midi number: 'C#4' -> 61
+def pitch_name_to_midi(name: str) -> int:
+    return parse_pitch_name(name)[0]
+
+
+# Convert midi number to pitch name: 61 -> 'C#4'
+def midi_to_pitch_name(midi: int) -> str:
+    return f'{SPELLINGS[midi % 12]}{midi // 12 - 1}'
+
+
+# Accidentals of pitches transposed by semitones. Score.transpose(semitones)
+# moves pitches by Music21's Interval(semitones), which sets their midi
+# number and so spells them like SPELLINGS whatever their spelling was.
+# song_cache.compare_cached() checks it against Music21.
+def transpose_alters(pitch: np.ndarray, semitones: int) -> np.ndarray:
+    return SPELLING_ALTERS[(pitch + semitones) % 12]
+
+
+# Transpose pitch name by semitones, spelled like Music21's
+# Score.transpose(semitones), see transpose_alters(): 'C4', 3 -> 'E-4'
+def transpose_pitch_name(name: str, semitones: int) -> str:
+    return midi_to_pitch_name(pitch_name_to_midi(name) + semitones)
+
+
+# Items of an iterator, the time taken to get each one is added to stage
+def timed(items: Iterable, metrics: Metrics, stage: str) -> Iterator:
+    items = iter(items)
+    while True:
+        with metrics.timer(stage):
+            item = next(items, None)
+        if item is None:
+            return
+        yield item
+
+
+# Time signature of the first measure of a song, the one Music21 reports
+def first_time_signature(parts: List['Instrument']) -> Optional[tuple]:
+    for part in parts:
+        if part.measures:
+            return tuple(part.measures[0].time_signature)
+    return None
+
+
+# Words of a text file, read in chunks so the file is never held whole
+def iter_words(path: str, chunk_size: int = TEXT_CHUNK_SIZE) -> Iterator[str]:
+    with open(path, 'r') as f:
+        rest = ''
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            words = (rest + chunk).split()
+            # The last word may continue in the next chunk
+            rest = words.pop() if words and not chunk[-1].isspace() else ''
+            yield from words
+        if rest:
+            yield rest
+
+
+# Split words into (time signature, note words) for every measure. A measure
+# ends at the next time signature, so the last one is left out like the end
+# of unfinished model output.
+def split_string_measures(words: Iterable[str]) -> Iterator[Tuple[tuple, List[str]]]:
+    measure = []
+    time_signature_present = False
+    for word in words:
+        if '/' in word:
+            if time_signature_present:
+                yield string_to_time_signature(measure[0]), measure[1:]
+                measure = []
+            else:
+                time_signature_present = True
+        measure.append(word)
+
+
+class NoteData:
+    '''
+    Columnar storage for the notes of an instrument. Each note is a row of the
+    note arrays: pitch as a midi number, alter (the accidental, which keeps
+    the spelling of the pitch), duration, offset in measure and velocity.
+
+    Rows are grouped into single notes or chords by group_starts, and groups
+    into measures by measure_starts. Both hold the index of the first element
+    of every group/measure followed by the total count, so group i spans rows
+    group_starts[i]:group_starts[i + 1].
+
+    Note, Chord and Measure objects are views into this data. Rows are
+    appended while parsing and converted to numpy arrays by freeze().
+    '''
+
+    NOTE_DTYPES = {
+        'pitch': np.int16,
+        'alter': np.int8,
+        'duration': np.float64,
+        'offset': np.float64,
+        'velocity': np.int16,
+    }
+
+    def __init__(self) -> None:
+        self.pitch = []
+        self.alter = []
+        self.duration = []
+        self.offset = []
+        self.velocity = []
+        self.group_starts = [0]
+        self.group_is_chord = []
+        self.measure_starts = [0]
+        # Per measure values
+        self.time_signatures: List[tuple] = []
+        self.measure_offsets: List[Fraction] = []
+        self.measure_num_notes: List[Union[int, float]] = []
+
+    @property
+    def n_notes(self) -> int:
+        return len(self.pitch)
+
+    @property
+    def n_measures(self) -> int:
+        return len(self.time_signatures)
+
+    def freeze(self) -> 'NoteData':
+        for field, dtype in NoteData.NOTE_DTYPES.items():
+            setattr(self, field, np.asarray(getattr(self, field), dtype=dtype))
+        self.group_starts = np.asarray(self.group_starts, dtype=np.int32)
+        self.group_is_chord = np.asarray(self.group_is_chord, dtype=bool)
+        self.measure_starts = np.asarray(self.measure_starts, dtype=np.int32)
+        return self
+
+    def add_note(
+        self, name: str, duration: float, offset: float, velocity: int
+    ) -> None:
+        pitch, alter = parse_pitch_name(name)
+        self.pitch.append(pitch)
+        self.alter.append(alter)
+        self.duration.append(duration)
+        self.offset.append(offset)
+        self.velocity.append(velocity)
+
+    def end_group(self, is_chord: bool) -> None:
+        self.group_starts.append(len(self.pitch))
+        self.group_is_chord.append(is_chord)
+
+    def end_measure(
+        self, time_signature: tuple, offset: Fraction, num_notes: Union[int, float]
+    ) -> None:
+        self.measure_starts.append(len(self.group_is_chord))
+        self.time_signatures.append(time_signature)
+        self.measure_offsets.append(offset)
+        self.measure_num_notes.append(num_notes)
+
+    def add_m21_note(self, m21_note: 'm21Note') -> None:
+        self.add_note(
+            m21_note.pitch.nameWithOctave,
+            # Allow only two decimal places for floating values
+            float(round(m21_note.quarterLength, 2)),
+            float(round(m21_note.offset, 2)),
+            int(m21_note.volume.velocity),
+        )
+
+    def add_m21_chord(self, m21_chord: 'm21Chord') -> None:
+        m21_chord.sortAscending()
+        for note in m21_chord:
+            # Music21 does not include the offset relative to the measure
+            # for a note, so we need to add the offset of the chord in
+            # the measure.
+            note.offset += m21_chord.offset
+            self.add_m21_note(note)
+        self.end_group(True)
+
+    def add_m21_measure(
+        self, measure_data: 'm21Measure', time_signature: tuple, offset: Fraction
+    ) -> None:
+        from music21.chord import Chord as m21Chord
+        from music21.note import Note as m21Note
+
+        num_notes = 0
+        # Flatten data to make it better to iterate over
+        for data in measure_data.flatten():
+            if isinstance(data, m21Note):
+                self.add_m21_note(data)
+                self.end_group(False)
+                num_notes += 1
+
+            elif isinstance(data, m21Chord):
+                self.add_m21_chord(data)
+                num_notes += 1
+            # Ignore anything else
+        self.end_measure(time_signature, offset, num_notes)
+
+    def add_string_note(self, string_list: List[str]) -> None:
+        if not Note.is_valid(string_list=string_list):
+            raise Exception(f'Cannot convert string list {string_list} to note.')
+        self.add_note(
+            string_list[0],
+            float(string_list[1]),
+            float(string_list[2]),
+            int(string_list[3]),
+        )
+
+    def add_string_chord(self, string_list: List[str]) -> None:
+        # Each note should be of length 4 so a chord list should be a
+        # multiple of 4.
+        if len(string_list) % 4 != 0 or len(string_list) == 0:
+            raise Exception('String list for chord should be multiple of 4')
+
+        for i in range(int(len(string_list) / 4)):
+            self.add_string_note(string_list[i * 4 : i * 4 + 4])
+        self.end_group(True)
+
+    def add_string_measure(
+        self, string_list: List[str], time_signature: tuple, offset: Fraction
+    ) -> None:
+        num_notes = 0
+        if string_list:
+            if len(string_list) % 4 != 0:
+                raise Exception('String list for a measure should be multiple of 4.')
+
+            i = 0
+            while i < len(string_list):
+                j = i + 4
+                # Extend pointer j if note data has the same offset (implying a chord)
+                while (
+                    j < len(string_list) and string_list[i + 2] == string_list[j + 2]
+                ):
+                    j += 4
+                # Either a chord or note exist in the slice
+                if j - i == 4:
+                    self.add_string_note(string_list[i:j])
+                    self.end_group(False)
+                else:
+                    self.add_string_chord(string_list[i:j])
+                num_notes += (j - i) / 4
+                i = j
+        self.end_measure(time_signature, offset, num_notes)
+
+    def name(self, row: int) -> str:
+        return pitch_to_name(int(self.pitch[row]), int(self.alter[row]))
+
+    def set_name(self, row: int, name: str) -> None:
+        self.pitch[row], self.alter[row] = parse_pitch_name(name)
+
+    ''' Tokens of rows start:end, in the format of Note.as_string'''
+    def tokens(
+        self, start: int, end: int, duration=True, offset=True, velocity=True
+    ) -> List[str]:
+        columns = [
+            map(
+                pitch_to_name,
+                self.pitch[start:end].tolist(),
+                self.alter[start:end].tolist(),
+            )
+        ]
+        if duration:
+            columns.append(map(str, self.duration[start:end].tolist()))
+        if offset:
+            columns.append(map(str, self.offset[start:end].tolist()))
+        if velocity:
+            columns.append(map(str, self.velocity[start:end].tolist()))
+        # Interleave the columns note by note
+        tokens = [None] * ((end - start) * len(columns))
+        for i, column in enumerate(columns):
+            tokens[i :: len(columns)] = column
+        return tokens
+
+    ''' Copy of rows start:end as a single note or chord'''
+    def copy_rows(self, start: int, end: int, is_chord: bool) -> 'NoteData':
+        data = NoteData()
+        for field in NoteData.NOTE_DTYPES:
+            setattr(data, field, getattr(self, field)[start:end].copy())
+        data.group_starts = np.array([0, end - start], dtype=np.int32)
+        data.group_is_chord = np.array([is_chord])
+        data.measure_starts = np.zeros(1, dtype=np.int32)
+        return data
+
+    ''' Copy of measures start:end with rows and groups renumbered from 0'''
+    def copy_measures(self, start: int, end: int) -> 'NoteData':
+        group_start = self.measure_starts[start]
+        group_end = self.measure_starts[end]
+        row_start = self.group_starts[group_start]
+        row_end = self.group_starts[group_end]
+
+        data = NoteData()
+        for field in NoteData.NOTE_DTYPES:
+            setattr(data, field, getattr(self, field)[row_start:row_end].copy())
+        data.group_starts = self.group_starts[group_start : group_end + 1] - row_start
+        data.group_is_chord = self.group_is_chord[group_start:group_end].copy()
+        data.measure_starts = self.measure_starts[start : end + 1] - group_start
+        data.time_signatures = self.time_signatures[start:end]
+        data.measure_offsets = self.measure_offsets[start:end]
+        data.measure_num_notes = self.measure_num_notes[start:end]
+        return data
+
+    '''
+    Transpose every note, spelled like Music21's Score.transpose(semitones)
+    without Music21, see transpose_alters(). song_cache.compare_cached()
+    checks that both give the same measures.
+    '''
+    def transpose_spelled(self, semitones: int) -> None:
+        self.alter = transpose_alters(self.pitch, semitones)
+        self.pitch = self.pitch + semitones
+
+    '''
+    Transpose rows start:end in place, all of them stay in the midi range.
+    Without respell the accidentals are kept, which keeps the spelling of
+    octave shifts.
+    '''
+    def transpose_rows(
+        self, start: int, end: int, semitones: int, respell: bool = True
+    ) -> None:
+        pitch = self.pitch[start:end] + semitones
+        self.check_pitch_range(pitch, semitones)
+        if respell:
+            self.alter[start:end] = transpose_alters(self.pitch[start:end], semitones)
+        self.pitch[start:end] = pitch
+
+    ''' Copy of the data with every note transposed, other fields are shared'''
+    def transposed(self, semitones: int) -> 'NoteData':
+        self.check_pitch_range(self.pitch + semitones, semitones)
+        data = copy(self)
+        data.transpose_spelled(semitones)
+        return data
+
+    def check_pitch_range(self, pitch: np.ndarray, semitones: int) -> None:
+        if len(pitch) and (pitch.min() < MIN_PITCH or pitch.max() > MAX_PITCH):
+            raise Exception(
+                f'Transposing by {semitones} semitones moves notes out of the midi range.'
+            )
+
+
 class Note:
     '''
     The representation of a note is a sequence of numbers. For the model to
@@ -31,41 +407,93 @@ class Note:
     A full note representation:
         G#4 0.5 2.5 130 = G#4 half note that is 2.5 quarter notes in the measure
             with 130 velocity.
+
+    A note is a view of a row in NoteData, notes created on their own hold
+    data with a single row.
     '''
 
+    __slots__ = ('data', 'row')
+
     def __init__(
         self,
-        m21_note: m21Note = None,
+        m21_note: 'm21Note' = None,
         string: str = None,
         string_list: List[str] = None,
     ) -> None:
-        self.name: str = None
-        self.duration: float = None
-        self.offset: float = None
-        self.velocity: int = None
-
+        data = NoteData()
         if m21_note:
-            self.name = m21_note.pitch.nameWithOctave
-            # Allow only two decimal places for floating values
-            self.duration = float(round(m21_note.quarterLength, 2))
-            self.offset = float(round(m21_note.offset, 2))
-            self.velocity = int(m21_note.volume.velocity)
+            data.add_m21_note(m21_note)
 
         # Should come from the model
         elif string_list or string:
             if string:
                 string_list = string.split(' ')
-            if not Note.is_valid(string_list=string_list):
-                raise Exception(f'Cannot convert string list {string_list} to note.')
-            self.name = string_list[0]
-            self.duration = float(string_list[1])
-            self.offset = float(string_list[2])
-            self.velocity = int(string_list[3])
+            data.add_string_note(string_list)
         else:
             raise Exception('Object required for note')
 
+        self.data = data.freeze()
+        self.row = 0
+
+    ''' View of a row in note data'''
+    @classmethod
+    def view(cls, data: NoteData, row: int) -> 'Note':
+        note = cls.__new__(cls)
+        note.data = data
+        note.row = row
+        return note
+
+    @property
+    def name(self) -> str:
+        return self.data.name(self.row)
+
+    @name.setter
+    def name(self, name: str) -> None:
+        self.data.set_name(self.row, name)
+
+    @property
+    def pitch(self) -> int:
+        return int(self.data.pitch[self.row])
+
+    # Octave of the written name, B#3 is in octave 3 with the pitch of C4
+    @property
+    def octave(self) -> int:
+        return int(self.data.pitch[self.row] - self.data.alter[self.row]) // 12 - 1
+
+    def transpose(self, semitones: int, respell: bool = True) -> None:
+        self.data.transpose_rows(self.row, self.row + 1, semitones, respell)
+
+    @property
+    def duration(self) -> float:
+        return float(self.data.duration[self.row])
+
+    @duration.setter
+    def duration(self, duration: float) -> None:
+        self.data.duration[self.row] = duration
+
+    @property
+    def offset(self) -> float:
+        return float(self.data.offset[self.row])
+
+    @offset.setter
+    def offset(self, offset: float) -> None:
+        self.data.offset[self.row] = offset
+
+    @property
+    def velocity(self) -> int:
+        return int(self.data.velocity[self.row])
+
+    @velocity.setter
+    def velocity(self, velocity: int) -> None:
+        self.data.velocity[self.row] = velocity
+
+    def __deepcopy__(self, memo) -> 'Note':
+        return Note.view(self.data.copy_rows(self.row, self.row + 1, False), 0)
+
     ''' Get Music21 representation of note'''
-    def music21(self) -> m21Note:
+    def music21(self) -> 'm21Note':
+        from music21.note import Note as m21Note
+
         note = m21Note(self.name)
         note.quarterLength = self.duration
         note.offset = self.offset
@@ -76,13 +504,7 @@ class Note:
     def as_string(
         self, duration=True, offset=True, velocity=True, tokenize=False
     ) -> str:
-        s = [self.name]
-        if duration:
-            s.append(str(self.duration))
-        if offset:
-            s.append(str(self.offset))
-        if velocity:
-            s.append(str(self.velocity))
+        s = self.data.tokens(self.row, self.row + 1, duration, offset, velocity)
         return s if tokenize else ' '.join(s)
 
     def __str__(self) -> str:
@@ -94,6 +516,8 @@ class Note:
             return False
         if not 2 <= len(string_list[0]) <= 3:
             return False
+        if PITCH_NAME_REGEX.fullmatch(string_list[0]) is None:
+            return False
         try:
             float(string_list[1])
             float(string_list[2])
@@ -107,114 +531,210 @@ class Chord:
     '''
     A chord is composed of different notes played at the same time. Although
     notes can be in a chord  structure in a measure, this class was created
-    to mimic how Music21 reads midi data. 
+    to mimic how Music21 reads midi data.
+
+    A chord is a view of a group of rows in NoteData.
     '''
+
+    __slots__ = ('data', 'group')
+
     def __init__(
         self,
-        m21_chord: m21Chord = None,
+        m21_chord: 'm21Chord' = None,
         string: str = None,
         string_list: List[str] = None,
     ) -> None:
-        self.notes: List[Note] = []
-
+        data = NoteData()
         if m21_chord:
-            m21_chord.sortAscending()
-            for note in m21_chord:
-                # Music21 does not include the offset relative to the measure
-                # for a note, so we need to add the offset of the chord in
-                # the measure. 
-                note.offset += m21_chord.offset
-                self.notes.append(Note(note))
+            data.add_m21_chord(m21_chord)
 
         elif string_list or string:
             if string:
                 string_list = string.split(' ')
-
-            # Each note should be of length 4 so a chord list should be a
-            # multiple of 4.
-            if len(string_list) % 4 != 0 or len(string_list) == 0:
-                raise Exception('String list for chord should be multiple of 4')
-
-            for i in range(int(len(string_list) / 4)):
-                # Array slicing does not make a copy, reducing any memory
-                # overload that may occur when iterating over a dataset
-                self.notes.append(Note(string_list=string_list[i * 4 : i * 4 + 4]))
+            data.add_string_chord(string_list)
         else:
             raise Exception('Object required for chord')
 
-        self.offset = self.notes[0].offset
+        self.data = data.freeze()
+        self.group = 0
+
+    ''' View of a group in note data'''
+    @classmethod
+    def view(cls, data: NoteData, group: int) -> 'Chord':
+        chord = cls.__new__(cls)
+        chord.data = data
+        chord.group = group
+        return chord
+
+    @property
+    def rows(self) -> range:
+        starts = self.data.group_starts
+        return range(starts[self.group], starts[self.group + 1])
+
+    @property
+    def notes(self) -> List[Note]:
+        return [Note.view(self.data, row) for row in self.rows]
+
+    @property
+    def offset(self) -> float:
+        return float(self.data.offset[self.rows.start])
+
+    def transpose(self, semitones: int) -> None:
+        rows = self.rows
+        self.data.transpose_rows(rows.start, rows.stop, semitones)
+
+    def __deepcopy__(self, memo) -> 'Chord':
+        rows = self.rows
+        return Chord.view(self.data.copy_rows(rows.start, rows.stop, True), 0)
+
+    def music21(self) -> 'm21Chord':
+        from music21.chord import Chord as m21Chord
 
-    def music21(self) -> m21Chord:
         return m21Chord([n.music21() for n in self.notes])
 
     # If tokenize is set to true, an array of note string are returned,
-    # otherwise a string. 
+    # otherwise a string.
     def as_string(
         self, duration=True, offset=True, velocity=True, tokenize=False
     ) -> Union[str, list]:
-        s = []
-        for note in self.notes:
-            if tokenize:
-                s += note.as_string(duration, offset, velocity, tokenize)
-            else:
-                s.append(note.as_string(duration, offset, velocity, tokenize))
+        rows = self.rows
+        s = self.data.tokens(rows.start, rows.stop, duration, offset, velocity)
         return s if tokenize else ' '.join(s)
 
     def __str__(self) -> str:
         return self.as_string()
 
 
+class MeasureCache:
+    '''
+    Least recently used tokens and text of measures, keyed by content so
+    that measures repeated in a song, across songs and in augmented copies
+    are formatted once. The key holds the bytes of the note columns, a
+    measure changed in place gets a new entry. Every identical measure
+    shares the same token tuple and text.
+    '''
+
+    def __init__(self, size: int = MEASURE_CACHE_SIZE) -> None:
+        self.size = size
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> Tuple[Tuple[str, ...], str]:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: tuple, tokens: List[str]) -> Tuple[Tuple[str, ...], str]:
+        entry = self.entries[key] = (tuple(tokens), ' '.join(tokens))
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return entry
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+MEASURE_CACHE = MeasureCache()
+
+
 class Measure:
-    ''' 
+    '''
     A measure holds notes and chords and inherently "rests" (or whenever a note
     is not played)
+
+    A measure is a view of a range of groups in NoteData.
     '''
+
+    __slots__ = ('data', 'index')
+
     def __init__(
         self,
         time_signature: tuple,
         offset: Fraction = None,
-        measure_data: m21Measure = None,
+        measure_data: 'm21Measure' = None,
         string: str = None,
         string_list: List[str] = None,
     ) -> None:
-        self.time_signature = time_signature
-        self.offset = offset
-        self.measure_data: List[Union[Note, Chord]] = []
-        self.num_notes = 0
-
+        data = NoteData()
         if measure_data:
-            # Flatten data to make it better to iterate over
-            measure_data = measure_data.flatten()
-            for data in measure_data:
-                if isinstance(data, m21Note):
-                    self.measure_data.append(Note(data))
-                    self.num_notes += 1
-
-                elif isinstance(data, m21Chord):
-                    self.measure_data.append(Chord(data))
-                    self.num_notes += 1
-                # Ignore anything else 
+            data.add_m21_measure(measure_data, time_signature, offset)
 
         elif string_list or string:
             if string:
                 string_list = string.split(' ')
             if len(string_list) % 4 != 0 or len(string_list) == 0:
-                raise Exception('String list for a measure should be multiple of 4.')
+                raise Exception(
+                    'String list for a measure should be multiple of 4.'
+                )
+            data.add_string_measure(string_list, time_signature, offset)
+        else:
+            data.end_measure(time_signature, offset, 0)
 
-            i = 0
-            while i < len(string_list):
-                j = i + 4
-                # Extend pointer j if note data has the same offset (implying a chord)
-                while j < len(string_list) and string_list[i + 2] == string_list[j + 2]:
-                    j += 4
-                seq = string_list[i:j]
-                # Either a chord or note exist in seq
-                data = Note(string_list=seq) if j - i == 4 else Chord(string_list=seq)
-                self.num_notes += (j - i) / 4
-                self.measure_data.append(data)
-                i = j
+        self.data = data.freeze()
+        self.index = 0
+
+    ''' View of a measure in note data'''
+    @classmethod
+    def view(cls, data: NoteData, index: int) -> 'Measure':
+        measure = cls.__new__(cls)
+        measure.data = data
+        measure.index = index
+        return measure
+
+    @property
+    def time_signature(self) -> tuple:
+        return self.data.time_signatures[self.index]
+
+    @time_signature.setter
+    def time_signature(self, time_signature: tuple) -> None:
+        self.data.time_signatures[self.index] = time_signature
+
+    @property
+    def offset(self) -> Fraction:
+        return self.data.measure_offsets[self.index]
+
+    @property
+    def num_notes(self) -> Union[int, float]:
+        return self.data.measure_num_notes[self.index]
+
+    @property
+    def groups(self) -> range:
+        starts = self.data.measure_starts
+        return range(starts[self.index], starts[self.index + 1])
+
+    @property
+    def rows(self) -> range:
+        groups = self.groups
+        starts = self.data.group_starts
+        return range(starts[groups.start], starts[groups.stop])
+
+    @property
+    def measure_data(self) -> List[Union[Note, Chord]]:
+        return [
+            Chord.view(self.data, group)
+            if self.data.group_is_chord[group]
+            else Note.view(self.data, self.data.group_starts[group])
+            for group in self.groups
+        ]
+
+    def transpose(self, semitones: int) -> None:
+        rows = self.rows
+        self.data.transpose_rows(rows.start, rows.stop, semitones)
+
+    def __deepcopy__(self, memo) -> 'Measure':
+        return Measure.view(self.data.copy_measures(self.index, self.index + 1), 0)
+
+    def music21(self) -> 'm21Measure':
+        from music21.meter import TimeSignature
+        from music21.stream import Measure as m21Measure
 
-    def music21(self) -> m21Measure:
         measure = m21Measure(
             timeSignature=TimeSignature(
                 f'{self.time_signature[0]}/{self.time_signature[1]}'
@@ -225,17 +745,33 @@ class Measure:
             measure.insert(offset, note_or_chord.music21())
         return measure
 
+    ''' Cached tokens and text of the measure with every note property'''
+    def serialized(self) -> Tuple[Tuple[str, ...], str]:
+        rows = self.rows
+        data = self.data
+        key = (tuple(self.time_signature),) + tuple(
+            getattr(data, field)[rows.start : rows.stop].tobytes()
+            for field in NoteData.NOTE_DTYPES
+        )
+        entry = MEASURE_CACHE.get(key)
+        if entry is None:
+            tokens = [time_signature_to_string(self.time_signature)]
+            tokens += data.tokens(rows.start, rows.stop)
+            entry = MEASURE_CACHE.put(key, tokens)
+        return entry
+
     def as_string(
         self, duration=True, offset=True, velocity=True, tokenize=False
     ) -> str:
+        if duration and offset and velocity:
+            tokens, text = self.serialized()
+            # Callers may extend the token list, the cached tuple is shared
+            return list(tokens) if tokenize else text
+
         # Start with time signature
         s = [f'{self.time_signature[0]}/{self.time_signature[1]}']
-
-        for note_or_chord in self.measure_data:
-            if tokenize:
-                s += note_or_chord.as_string(duration, offset, velocity, tokenize)
-            else:
-                s.append(note_or_chord.as_string(duration, offset, velocity, tokenize))
+        rows = self.rows
+        s += self.data.tokens(rows.start, rows.stop, duration, offset, velocity)
 
         return s if tokenize else ' '.join(s)
 
@@ -245,19 +781,25 @@ class Measure:
 
 class Instrument:
     '''
-    An instrument contains measures which contains note and chord data. 
+    An instrument contains measures which contains note and chord data. All
+    notes of an instrument are stored in a single NoteData and its measures
+    are views into it.
     '''
     def __init__(
-        self, stream: m21Part = None, string: str = None, string_list: List[str] = None
+        self, stream: 'm21Part' = None, string: str = None, string_list: List[str] = None
     ) -> None:
+        self.data = NoteData()
         self.measures: List[Measure] = []
         self.num_notes = None
 
         if stream:
-            if len(stream.flat.notes) == 0:
+            from music21.stream import Measure as m21Measure
+
+            notes = stream.flat.notes
+            if len(notes) == 0:
                 raise Exception('Instrument stream is empty.')
 
-            self.num_notes = len(stream.flat.notes)
+            self.num_notes = len(notes)
 
             base_time_signature = (4, 4)
             for measure in stream.getElementsByClass(m21Measure):
@@ -266,31 +808,63 @@ class Instrument:
                         measure.timeSignature.numerator,
                         measure.timeSignature.denominator,
                     )
-                self.measures.append(Measure(base_time_signature, measure_data=measure))
+                self.data.add_m21_measure(measure, base_time_signature, None)
 
         elif string_list or string:
-            if string:
-                string_list = string.split(' ')
+            # Imported here since note_parser builds on this module
+            from note_parser import parse_measures
 
-            measure = []
-            time_signature_present = False
-            n_notes = 0
-            for i in range(len(string_list)):
-                if '/' not in string_list[i]:
-                    n_notes += 1
-                else:
-                    if time_signature_present:
-                        time_signature = string_to_time_signature(measure[0])
-                        self.measures.append(
-                            Measure(time_signature, string_list=measure[1:])
-                        )
-                        measure = []
-                    else:
-                        time_signature_present = True
-                measure.append(string_list[i])
-            self.num_notes = n_notes
+            # Valid text is parsed at once, other text word by word
+            parsed = parse_measures(string) if string else None
+            if parsed is not None:
+                self.data, self.num_notes = parsed
+            else:
+                if string:
+                    string_list = string.split(' ')
+
+                # Words can come from a generator, they are counted on the way
+                n_notes = 0
+
+                def counted(words: Iterable[str]) -> Iterator[str]:
+                    nonlocal n_notes
+                    for word in words:
+                        if '/' not in word:
+                            n_notes += 1
+                        yield word
+
+                for time_signature, words in split_string_measures(counted(string_list)):
+                    self.data.add_string_measure(words, time_signature, None)
+                self.num_notes = n_notes
+
+        self.data.freeze()
+        self.measures = [
+            Measure.view(self.data, i) for i in range(self.data.n_measures)
+        ]
+
+    ''' Instrument with measures viewing existing note data'''
+    @classmethod
+    def from_data(cls, data: NoteData, num_notes: int = None) -> 'Instrument':
+        instrument = cls()
+        instrument.data = data
+        instrument.num_notes = num_notes
+        instrument.measures = [
+            Measure.view(data, i) for i in range(data.n_measures)
+        ]
+        return instrument
+
+    ''' Transpose every note in place, spelled like NoteData.transpose_spelled'''
+    def transpose(self, semitones: int) -> None:
+        self.data = self.data.transposed(semitones)
+        for measure in self.measures:
+            measure.data = self.data
+
+    ''' Transposed copy, sharing every array but the pitches and accidentals'''
+    def transposed(self, semitones: int) -> 'Instrument':
+        return Instrument.from_data(self.data.transposed(semitones), self.num_notes)
+
+    def music21(self) -> 'm21Part':
+        from music21.stream import Part as m21Part
 
-    def music21(self) -> m21Part:
         part = m21Part(id=str(len(self.measures)))
         part.append([measure.music21() for measure in self.measures])
 
@@ -310,14 +884,16 @@ class Instrument:
 
     def __str__(self) -> str:
         return self.as_string()
-    
+
     # Helper function for removing and weird outputs from the model
     def sanitize(s: str) -> Tuple[List[str], int]:
-        string_list = s.split(' ')
-        return_list = []
+        from note_parser import sanitized_words
 
-        ptr = 0
-        last_note = 0
+        string_list = s.split(' ')
+        # Valid measures are matched at once, the rest is checked note by note
+        ptr = sanitized_words(s)
+        return_list = string_list[:ptr]
+        last_note = max(ptr - 4, 0)
         while ptr < len(string_list):
             if '/' in string_list[ptr]:
                 return_list.append(string_list[ptr])
@@ -331,7 +907,6 @@ class Instrument:
         return return_list, last_note
 
 
-
 class Song:
     '''
     A Song is equivalent to a midi file and contains Instrument data.
@@ -342,47 +917,61 @@ class Song:
         string: str = None,
         string_list: List[str] = None,
         transpose: int = None,
+        cache: SongCache = None,
+        reader: str = 'music21',
+        metrics: Metrics = None,
     ) -> None:
         self.name: str = None
         self.parts: List[Instrument] = None
         self.time_signature = None
         self.num_notes = 0
         self.parsed = False
+        # Reason the song failed to load
+        self.error: str = None
+        self.metrics = metrics or NO_METRICS
+        if reader not in READERS:
+            raise Exception(f'Unknown midi reader {reader}, use one of {READERS}')
+        self.reader = reader
 
         try:
             if path:
                 if path.endswith('.mid'):
-                    # Parse midi file
-                    stream = m21parse(path)
-                    parts = stream.parts.stream()
-
-                    if transpose:
-                        parts = parts.transpose(transpose)
+                    if cache is None:
+                        self.parse_midi(path, transpose)
+                    else:
+                        # Cache the song as parsed, transposition is applied
+                        # afterwards on the cached data
+                        with self.metrics.timer('cache'):
+                            key = cache.key(path)
+                            cached = cache.get(key)
+                        if cached is None:
+                            self.metrics.count('cache_misses')
+                            self.parse_midi(path)
+                            with self.metrics.timer('cache'):
+                                cache.put(key, self.parts)
+                        else:
+                            self.metrics.count('cache_hits')
+                            self.parts = cached
+                            self.time_signature = first_time_signature(cached)
+                        if transpose:
+                            with self.metrics.timer('transpose'):
+                                self.transpose_names(transpose)
 
-                    self.time_signature = (
-                        stream.flat.timeSignature.numerator,
-                        stream.flat.timeSignature.denominator,
-                    )
                     self.name = path[(-(path[::-1].find('/'))) : -4]
-                    self.parts = [
-                        Instrument(part, self.time_signature) for part in parts
-                    ]
                     self.parsed = True
                     self.num_notes = sum([i.num_notes for i in self.parts])
                     print(
                         f'Loaded Song: {self.name} with {len(self.parts)} parts and {self.num_notes} notes.'
                     )
                 elif path.endswith('.txt'):
-                    # Parse text file
-                    with open(path, 'r') as f:
-                        lines = f.readlines()
-                        self.parts = [Instrument(string=' '.join(lines))]
-                        self.num_notes = self.parts[0].num_notes
-                        self.name = path[(-(path[::-1].find('/'))) : -4]
-                        self.parsed = True
-                        print(
-                            f'Loaded Song: {self.name} with {len(self.parts)} parts and {self.num_notes} notes.'
-                        )
+                    # Parse text file, streamed word by word
+                    self.parts = [Instrument(string_list=iter_words(path))]
+                    self.num_notes = self.parts[0].num_notes
+                    self.name = path[(-(path[::-1].find('/'))) : -4]
+                    self.parsed = True
+                    print(
+                        f'Loaded Song: {self.name} with {len(self.parts)} parts and {self.num_notes} notes.'
+                    )
             elif string_list or string:
                 if string:
                     string_list = string.split(' ')
@@ -393,10 +982,130 @@ class Song:
                 print(f'Loaded Song from string with {self.parts[0].num_notes} notes.')
 
         except Exception as e:
+            self.error = f'{type(e).__name__}: {e}'
             print(f'Failed to load song with path: {path}, exception: {e}.')
             traceback.print_exc()
 
-    def to_midi(self, path: str) -> None:
+    def parse_midi(self, path: str, transpose: int = None) -> None:
+        if self.reader == 'mido':
+            # Imported here since mido_song builds on this module
+            from mido_song import Song as MidoSong
+
+            # Reads the measures too, they are not timed on their own
+            with self.metrics.timer('parse'):
+                song = MidoSong(midi_path=path)
+            self.time_signature = song.time_signature
+            self.parts = song.parts
+            if transpose:
+                with self.metrics.timer('transpose'):
+                    self.transpose_names(transpose)
+            return
+
+        from music21.converter import parse as m21parse
+
+        with self.metrics.timer('parse'):
+            stream = m21parse(path)
+            parts = stream.parts.stream()
+
+        if transpose:
+            with self.metrics.timer('transpose'):
+                parts = parts.transpose(transpose)
+
+        self.time_signature = (
+            stream.flat.timeSignature.numerator,
+            stream.flat.timeSignature.denominator,
+        )
+        with self.metrics.timer('measures'):
+            self.parts = [Instrument(part, self.time_signature) for part in parts]
+
+    '''
+    Parts of a midi file one at a time, without keeping the parts already
+    returned. The mido reader converts one track at a time, Music21 reads
+    the whole score first. With a cache, parts are read from it, or written
+    to it as they are read from the file, one at a time.
+    '''
+    @staticmethod
+    def iter_parts(
+        path: str,
+        transpose: int = None,
+        reader: str = 'music21',
+        cache: SongCache = None,
+        metrics: Metrics = NO_METRICS,
+    ) -> Iterator[Instrument]:
+        parts = None
+        if cache is not None:
+            with metrics.timer('cache'):
+                key = cache.key(path)
+                parts = cache.iter_entry(key)
+            if parts is None:
+                metrics.count('cache_misses')
+                parts = cache.put_iter(key, Song.read_parts(path, reader, metrics))
+            else:
+                metrics.count('cache_hits')
+                parts = timed(parts, metrics, 'cache')
+        if parts is None:
+            parts = Song.read_parts(path, reader, metrics)
+        for part in parts:
+            if transpose:
+                with metrics.timer('transpose'):
+                    part.data.transpose_spelled(transpose)
+            yield part
+
+    ''' Parts of a midi file as they are read, see iter_parts()'''
+    @staticmethod
+    def read_parts(
+        path: str, reader: str = 'music21', metrics: Metrics = NO_METRICS
+    ) -> Iterator[Instrument]:
+        if reader == 'mido':
+            from mido_song import Song as MidoSong
+
+            yield from timed(MidoSong().iter_parts(path), metrics, 'parse')
+            return
+
+        from music21.converter import parse as m21parse
+
+        with metrics.timer('parse'):
+            stream = m21parse(path)
+        time_signature = (
+            stream.flat.timeSignature.numerator,
+            stream.flat.timeSignature.denominator,
+        )
+        for part in stream.parts.stream():
+            with metrics.timer('measures'):
+                instrument = Instrument(part, time_signature)
+            yield instrument
+
+    # Transpose every note name by a number of semitones without Music21
+    def transpose_names(self, semitones: int) -> None:
+        for part in self.parts:
+            part.data.transpose_spelled(semitones)
+
+    ''' Transpose every part in place, no note may leave the midi range'''
+    def transpose(self, semitones: int) -> None:
+        # Check every part before changing any of them
+        transposed = [part.data.transposed(semitones) for part in self.parts]
+        for part, data in zip(self.parts, transposed):
+            part.data = data
+            for measure in part.measures:
+                measure.data = data
+
+    ''' Copy of the song with every part transposed'''
+    def transposed(self, semitones: int) -> 'Song':
+        song = copy(self)
+        song.parts = [part.transposed(semitones) for part in self.parts]
+        return song
+
+    ''' Write the song to a midi file, midi_writer writes it without Music21'''
+    def to_midi(self, path: str, writer: str = 'mido') -> None:
+        if writer == 'mido':
+            from midi_writer import write_song
+
+            write_song(self, path)
+            return
+
+        from music21.midi.translate import streamToMidiFile
+        from music21.stream import Score
+
         score = Score()
 
         for i, part in enumerate(self.parts):
@@ -411,3 +1120,24 @@ class Song:
             for part in self.parts:
                 for measure in part.measures:
                     f.write(str(measure) + '\n')
+
+
+# Differences between the parts and measures of two songs, an empty list if
+# they read the same. Checks faster ways of reading songs against Music21.
+def compare_songs(expected: Song, song: Song) -> List[str]:
+    differences = []
+    if len(expected.parts) != len(song.parts):
+        differences.append(
+            f'{len(expected.parts)} parts expected, got {len(song.parts)}'
+        )
+    for p, (a, b) in enumerate(zip(expected.parts, song.parts)):
+        if a.num_notes != b.num_notes:
+            differences.append(f'part {p}: {a.num_notes} notes expected, got {b.num_notes}')
+        if len(a.measures) != len(b.measures):
+            differences.append(
+                f'part {p}: {len(a.measures)} measures expected, got {len(b.measures)}'
+            )
+        for i, (m_a, m_b) in enumerate(zip(a.measures, b.measures)):
+            if str(m_a) != str(m_b):
+                differences.append(f'part {p} measure {i}: {m_a} != {m_b}')
+    return differences
@@ -0,0 +1,201 @@
+import os
+import pickle
+import shutil
+import tempfile
+from hashlib import sha256
+from typing import Any, Iterable, Iterator, List, Optional
+
+CACHE_DIR = './.song_cache'
+# Upper bound for the size of the cache directory, least recently used
+# entries are evicted once it is exceeded.
+MAX_CACHE_BYTES = 2 * 1024**3
+# Bump whenever the pickled song structure changes to invalidate old entries
+CACHE_VERSION = 3
+# Transpositions compare_cached() checks
+CHECK_TRANSPOSES = range(-5, 7)
+
+
+class SongCache:
+    '''
+    On-disk cache of parsed songs. Entries are keyed by the content hash of
+    the source file, so renamed or copied files share an entry and modified
+    files get a new one. Every entry is a file in the cache directory holding
+    the items of the entry, the parts of a song, pickled one after the other
+    so they can be read and written one at a time. The modification time of
+    a file is used as its last access time.
+    '''
+
+    def __init__(
+        self, path: str = CACHE_DIR, max_bytes: int = MAX_CACHE_BYTES
+    ) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    ''' Key of a source file, changes with its content and the cache version'''
+    def key(self, file_path: str) -> str:
+        digest = sha256(f'v{CACHE_VERSION}'.encode())
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key + '.pkl')
+
+    ''' Items of an entry, None if it is missing or unreadable'''
+    def get(self, key: str) -> Optional[List[Any]]:
+        items = self.iter_entry(key)
+        if items is None:
+            return None
+        try:
+            return list(items)
+        except Exception:
+            # Removed by iter_entry, treated as a miss
+            return None
+
+    '''
+    Items of an entry, unpickled as they are iterated, None if it is missing.
+    An item that can not be read removes the entry and raises.
+    '''
+    def iter_entry(self, key: str) -> Optional[Iterator[Any]]:
+        entry = self.entry_path(key)
+        try:
+            f = open(entry, 'rb')
+        except FileNotFoundError:
+            return None
+        # Mark as recently used
+        os.utime(entry)
+        return self.read_items(key, f)
+
+    def read_items(self, key: str, f) -> Iterator[Any]:
+        with f:
+            while True:
+                try:
+                    item = pickle.load(f)
+                except EOFError:
+                    return
+                except Exception as e:
+                    # A corrupt or outdated entry is removed
+                    print(f'Removing unreadable cache entry {f.name}, exception: {e}.')
+                    self.remove(key)
+                    raise
+                yield item
+
+    def put(self, key: str, items: Iterable[Any]) -> None:
+        for _ in self.put_iter(key, items):
+            pass
+
+    '''
+    Pass items through while writing them to an entry. The entry is only
+    stored once every item was written, when the iteration stops early
+    nothing is stored.
+    '''
+    def put_iter(self, key: str, items: Iterable[Any]) -> Iterator[Any]:
+        entry = self.entry_path(key)
+        # Write to a temporary file first so that concurrent workers never
+        # read a partially written entry
+        tmp = f'{entry}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                for item in items:
+                    # Pickled before the item is used, which may change it
+                    pickle.dump(item, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    yield item
+            os.replace(tmp, entry)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.evict()
+
+    def remove(self, key: str) -> None:
+        try:
+            os.remove(self.entry_path(key))
+        except FileNotFoundError:
+            pass
+
+    ''' Invalidate the entry of a single source file'''
+    def invalidate(self, file_path: str) -> None:
+        self.remove(self.key(file_path))
+
+    ''' Invalidate every entry'''
+    def clear(self) -> None:
+        for name in os.listdir(self.path):
+            if name.endswith('.pkl'):
+                self.remove(name[:-4])
+
+    ''' Remove least recently used entries until the cache fits max_bytes'''
+    def evict(self) -> None:
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.pkl'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.name[:-4]))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.remove(key)
+            total -= size
+
+
+def compare_cached(
+    path: str, transposes=CHECK_TRANSPOSES, reader: str = 'music21'
+) -> List[str]:
+    '''
+    Check of cached songs against parsed ones. Cached songs are transposed
+    after they are read from the cache, which must give the same measures as
+    Music21 transposing the parsed score, and so must Song.transposed(),
+    Song.transpose() and Measure.transpose().
+    Returns the differences for every transpose, an empty list if they agree.
+    '''
+    # Imported here since simplified_song builds on this module
+    from simplified_song import Song, compare_songs
+
+    cache = SongCache(tempfile.mkdtemp(prefix='song_cache_'))
+    differences = []
+    try:
+        # Fills the cache
+        untransposed = Song(path, cache=cache, reader=reader)
+        for transpose in transposes:
+            expected = Song(path, transpose=transpose)
+            if not expected.parsed:
+                return [f'Music21 could not read {path}']
+            song = Song(path, transpose=transpose, cache=cache, reader=reader)
+            # Song.transposed() spells notes the same way
+            transposed = untransposed.transposed(transpose)
+            # So do the transposes in place, of parts and of the rows of
+            # measures, on fresh copies from the cache
+            in_place = Song(path, cache=cache, reader=reader)
+            in_place.transpose(transpose)
+            by_measure = Song(path, cache=cache, reader=reader)
+            for part in by_measure.parts:
+                for measure in part.measures:
+                    measure.transpose(transpose)
+            for name, other in (
+                ('', song),
+                ('transposed() ', transposed),
+                ('transpose() ', in_place),
+                ('Measure.transpose() ', by_measure),
+            ):
+                differences += [
+                    f'{name}transpose {transpose}: {difference}'
+                    for difference in compare_songs(expected, other)
+                ]
+    finally:
+        shutil.rmtree(cache.path, ignore_errors=True)
+    return differences
+
+
+if __name__ == '__main__':
+    from sys import argv
+
+    for path in argv[1:]:
+        differences = compare_cached(path)
+        print(f'{path}: {"OK" if not differences else "DIFFERENT"}')
+        for difference in differences:
+            print(f'  {difference}')
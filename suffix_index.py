@@ -0,0 +1,301 @@
+import json
+import mmap
+import os
+from argparse import ArgumentParser
+from collections import Counter
+from typing import List, Tuple
+
+import numpy as np
+
+from dataset_shards import load_tokenizer
+
+# Suffix array over the tokens of the dataset, the draft model of speculative
+# decoding. The rows of the dataset are tokenized and joined by the eos
+# token, every suffix of the joined tokens is sorted, and a context is
+# looked up by binary search for its longest suffix found in the dataset.
+# The tokens that most often followed it there are the draft.
+#
+# Songs also repeat their own measures, so a long enough match in the
+# context itself is drafted from first, see context_draft().
+#
+# The index is built once and memory mapped when it is loaded:
+#
+#   python suffix_index.py dataset_512.txt --index suffix_index
+#   python generate_music.py --speculative suffix_index
+#   python suffix_index.py --compare music-gpt2-2.3 --index suffix_index
+
+INDEX_DIR = "./suffix_index"
+DATASET_PATH = "dataset_512.txt"
+TOKENS_FILE = "tokens.bin"
+SUFFIXES_FILE = "suffixes.npy"
+INDEX_FILE = "index.json"
+# Big endian, so the bytes of token sequences compare like their ids
+TOKEN_DTYPE = np.dtype(">u2")
+# Suffixes are sorted on their first MAX_MATCH tokens, longer matches are
+# cut to it
+MAX_MATCH = 64
+# Shorter matches tell too little about what follows
+MIN_MATCH = 4
+# Occurrences of a match whose next tokens are counted to pick the draft
+CANDIDATES = 32
+# Drafting stops at tokens following fewer of the occurrences
+MIN_SHARE = 0.7
+# Matches inside the context, shorter ones repeat by chance
+CONTEXT_MIN_MATCH = 6
+CONTEXT_MAX_MATCH = 32
+ROWS_PER_BATCH = 1000
+
+
+def suffix_array(tokens: np.ndarray, max_match: int = MAX_MATCH) -> np.ndarray:
+    """
+    Start of every suffix of tokens, sorted on their first max_match tokens
+    by prefix doubling. A suffix that ends sorts before the longer ones it
+    is a prefix of, like bytes do.
+    """
+    n = len(tokens)
+    rank = tokens.astype(np.int64)
+    order = np.argsort(rank, kind="stable")
+    length = 1
+    while length < max_match:
+        # Ranks of the first length tokens, then of the next length tokens
+        following = np.full(n, -1, dtype=np.int64)
+        following[: n - length] = rank[length:]
+        order = np.lexsort((following, rank))
+        sorted_rank = rank[order]
+        sorted_following = following[order]
+        new_group = np.ones(n, dtype=bool)
+        new_group[1:] = (sorted_rank[1:] != sorted_rank[:-1]) | (
+            sorted_following[1:] != sorted_following[:-1]
+        )
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = np.cumsum(new_group) - 1
+        length *= 2
+        if new_group.all():
+            break
+    dtype = np.int32 if n < 2**31 else np.int64
+    return order.astype(dtype)
+
+
+def build_index(
+    path: str = DATASET_PATH,
+    index_dir: str = INDEX_DIR,
+    tokenizer=None,
+    max_match: int = MAX_MATCH,
+) -> None:
+    tokenizer = tokenizer if tokenizer is not None else load_tokenizer()
+    separator = tokenizer.eos_token_id
+    with open(path, "r") as f:
+        lines = [line for line in f.read().split("\n") if line]
+
+    rows = []
+    for start in range(0, len(lines), ROWS_PER_BATCH):
+        for ids in tokenizer(lines[start : start + ROWS_PER_BATCH])["input_ids"]:
+            rows.append(np.asarray(ids + [separator], dtype=TOKEN_DTYPE))
+    # Concatenation gives the native byte order
+    tokens = np.concatenate(rows + [np.empty(0, dtype=TOKEN_DTYPE)]).astype(TOKEN_DTYPE)
+    suffixes = suffix_array(tokens, max_match)
+
+    os.makedirs(index_dir, exist_ok=True)
+    tokens.tofile(os.path.join(index_dir, TOKENS_FILE))
+    np.save(os.path.join(index_dir, SUFFIXES_FILE), suffixes)
+    with open(os.path.join(index_dir, INDEX_FILE), "w") as f:
+        json.dump({"separator": separator, "max_match": max_match, "tokens": len(tokens)}, f)
+    print(f"Indexed {len(rows)} rows with {len(tokens)} tokens in {index_dir}")
+
+
+class SuffixIndex:
+    """
+    Memory mapped suffix index. Nothing is read before a lookup, which only
+    touches the pages its binary search visits.
+    """
+
+    def __init__(self, index_dir: str = INDEX_DIR) -> None:
+        with open(os.path.join(index_dir, INDEX_FILE)) as f:
+            info = json.load(f)
+        self.separator: int = info["separator"]
+        self.max_match: int = info["max_match"]
+        self.n_tokens: int = info["tokens"]
+        self.suffixes = np.load(os.path.join(index_dir, SUFFIXES_FILE), mmap_mode="r")
+        with open(os.path.join(index_dir, TOKENS_FILE), "rb") as f:
+            # Empty files can not be memory mapped
+            self.tokens = (
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.n_tokens else b""
+            )
+
+    def __len__(self) -> int:
+        return self.n_tokens
+
+    def suffix(self, i: int, length: int) -> bytes:
+        start = int(self.suffixes[i]) * TOKEN_DTYPE.itemsize
+        return self.tokens[start : start + length * TOKEN_DTYPE.itemsize]
+
+    def lower_bound(self, pattern: bytes, length: int, lo: int, hi: int) -> int:
+        while lo < hi:
+            middle = (lo + hi) // 2
+            if self.suffix(middle, length) < pattern:
+                lo = middle + 1
+            else:
+                hi = middle
+        return lo
+
+    def upper_bound(self, pattern: bytes, length: int, lo: int, hi: int) -> int:
+        while lo < hi:
+            middle = (lo + hi) // 2
+            if self.suffix(middle, length) <= pattern:
+                lo = middle + 1
+            else:
+                hi = middle
+        return lo
+
+    def find(self, pattern: List[int], lo: int = 0, hi: int = None) -> Tuple[int, int]:
+        """Range of the suffixes starting with pattern, inside lo:hi if given."""
+        hi = self.n_tokens if hi is None else hi
+        length = len(pattern)
+        key = np.asarray(pattern, dtype=TOKEN_DTYPE).tobytes()
+        lo = self.lower_bound(key, length, lo, hi)
+        if lo == hi or self.suffix(lo, length) != key:
+            return lo, lo
+        return lo, self.upper_bound(key, length, lo, hi)
+
+    def longest_match(self, context: List[int]) -> Tuple[int, int, int]:
+        """Length and suffix range of the longest suffix of context in the index."""
+        best = (0, 0, 0)
+        # Every suffix of a match matches too, so its length is bisected
+        low, high = MIN_MATCH, min(len(context), self.max_match)
+        while low <= high:
+            length = (low + high) // 2
+            lo, hi = self.find(context[len(context) - length :])
+            if lo < hi:
+                best = (length, lo, hi)
+                low = length + 1
+            else:
+                high = length - 1
+        return best
+
+    def next_token(self, length: int, lo: int, hi: int) -> Tuple[int, float]:
+        """Most common token after the matches of a range, and its share."""
+        step = max((hi - lo) // CANDIDATES, 1)
+        following = Counter(
+            self.token(start)
+            for start in (int(self.suffixes[i]) + length for i in range(lo, hi, step))
+            if start < self.n_tokens
+        )
+        if not following:
+            return self.separator, 1.0
+        token, count = following.most_common(1)[0]
+        return token, count / sum(following.values())
+
+    def draft(self, context: List[int], n_tokens: int, min_share: float = MIN_SHARE) -> List[int]:
+        """
+        Up to n_tokens tokens likely to follow context. Every token is the
+        most common one after the longest match of the context and the draft
+        so far. Drafting stops at a token that follows less than min_share of
+        the matches, which the model would likely reject.
+        """
+        if n_tokens <= 0 or not self.n_tokens:
+            return []
+        length, lo, hi = self.longest_match(context)
+        draft = []
+        while length and len(draft) < n_tokens:
+            token, share = self.next_token(length, lo, hi)
+            # Drafts end with their row
+            if token == self.separator or share < min_share:
+                break
+            draft.append(token)
+            if length < self.max_match:
+                # The matches followed by token are a part of the range
+                lo, hi = self.find((context + draft)[-length - 1 :], lo, hi)
+                length += 1
+            else:
+                # Suffixes are sorted on max_match tokens only
+                length, lo, hi = self.longest_match(context + draft)
+        return draft
+
+    def token(self, i: int) -> int:
+        return int.from_bytes(
+            self.tokens[i * TOKEN_DTYPE.itemsize : (i + 1) * TOKEN_DTYPE.itemsize], "big"
+        )
+
+
+def context_draft(
+    context: List[int],
+    n_tokens: int,
+    min_match: int = CONTEXT_MIN_MATCH,
+    max_match: int = CONTEXT_MAX_MATCH,
+) -> List[int]:
+    """
+    Up to n_tokens tokens that followed the last earlier occurrence of the
+    longest suffix of context in context itself, nothing when no suffix of
+    min_match tokens repeats.
+    """
+    size = TOKEN_DTYPE.itemsize
+    data = np.asarray(context, dtype=TOKEN_DTYPE).tobytes()
+    for length in range(min(max_match, len(context) - 1), min_match - 1, -1):
+        pattern = data[-length * size :]
+        # An occurrence ending before the suffix does, on a token boundary
+        position = data.rfind(pattern, 0, len(data) - size)
+        while position > 0 and position % size:
+            position = data.rfind(pattern, 0, position + len(pattern) - 1)
+        if position >= 0:
+            start = position // size + length
+            return list(context[start : start + n_tokens])
+    return []
+
+
+def compare(model, tokenizer, index: SuffixIndex, n_tokens: int, seed: int, n_draft: int) -> None:
+    """Generate the same number of tokens with and without speculative decoding."""
+    from time import perf_counter
+
+    from generate_music import GenerationSession, SpeculativeSession, random_prompt
+
+    prompt = random_prompt()
+    results = {}
+    for name, session in (
+        ("plain", GenerationSession(model, tokenizer, seed=seed)),
+        ("speculative", SpeculativeSession(model, tokenizer, index, n_draft, seed=seed)),
+    ):
+        list(session.feed(prompt))
+        start = perf_counter()
+        for _ in session.generate(n_tokens):
+            pass
+        elapsed = perf_counter() - start
+        results[name] = session.n_generated / elapsed
+        print(f"{name}: {session.n_generated} tokens in {elapsed:.2f}s, {results[name]:.1f} tokens/s")
+    print(session.stats())
+    print(f"Speedup: {results['speculative'] / results['plain']:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Build the suffix index of speculative decoding.")
+    parser.add_argument("path", nargs="?", default=DATASET_PATH, help="Text dataset to index")
+    parser.add_argument("--index", default=INDEX_DIR)
+    parser.add_argument("--max-match", type=int, default=MAX_MATCH)
+    parser.add_argument(
+        "--compare",
+        metavar="MODEL_PATH",
+        help="Instead of building, compare plain and speculative decoding with this model",
+    )
+    parser.add_argument("--tokens", type=int, default=512)
+    parser.add_argument("--draft", type=int, help="Tokens drafted per step")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.compare:
+        import random
+
+        from transformers import GPT2LMHeadModel
+
+        from generate_music import DRAFT_TOKENS
+
+        random.seed(args.seed)
+        model = GPT2LMHeadModel.from_pretrained(args.compare)
+        compare(
+            model,
+            load_tokenizer(),
+            SuffixIndex(args.index),
+            args.tokens,
+            args.seed,
+            args.draft or DRAFT_TOKENS,
+        )
+    else:
+        build_index(args.path, args.index, max_match=args.max_match)
@@ -0,0 +1,279 @@
+import os
+import random
+from argparse import ArgumentParser
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from dataset_shards import TOKEN_DTYPE, ShardDataset, load_tokenizer
+from note_tokenizer import NoteTokenizer
+
+# Training data without padding. Rows of the dataset hold from MIN_SEQ to
+# MAX_SEQ words, batches padded to their longest row waste a fifth of every
+# step and rows longer than the context are truncated. Instead, rows are
+# packed one after the other into blocks of BLOCK_SIZE tokens:
+#
+#   4/4 C4 ... 98 <eos> 3/4 E4 ... 51 <eos> 4/4 G4 ... | 4/4 A4 ... <eos> ...
+#   '------ row ------'  '------ row ------'  '-- row, cut at a measure --'
+#
+# A row that does not fit is cut before one of its time signatures and goes
+# on at the start of the next block, so every block starts a measure. Only
+# the end of a block, shorter than a measure, is padded. Separators and
+# padding have no labels, padding is masked out of attention. Rows see the
+# rows packed before them in their block, the separator tells them apart.
+#
+# Rows can also be bucketed instead, batches of rows of similar lengths are
+# padded much less than random ones. That is what Trainer does with
+# group_by_length=True, bucket_batches() does the same for the report.
+#
+#   python training_data.py dataset_512.txt
+#   python training_data.py dataset_shards --tokenizer notes
+
+DATASET_PATH = "dataset_512.txt"
+# Context of the model
+BLOCK_SIZE = 1024
+# per_device_train_batch_size of the training notebook
+BATCH_SIZE = 2
+# Batches whose rows are sorted by length together, like Trainer's
+# group_by_length
+BUCKET_BATCHES = 50
+TOKENIZER = "bpe"
+TOKENIZERS = ("bpe", "notes")
+# Label of the tokens the loss ignores
+IGNORE_INDEX = -100
+# Rows tokenized per call of the tokenizer
+TOKENIZE_BATCH = 1000
+SEED = 0
+
+
+class MeasureBoundaries:
+    """
+    Finds where measures start in a row of token ids. A measure starts with
+    the first token of its time signature, the word holding the "/". Works
+    with any tokenizer: BPE tokens start a word when they start with a space,
+    note tokens are whole words.
+    """
+
+    def __init__(self, tokenizer) -> None:
+        if isinstance(tokenizer, NoteTokenizer):
+            strings = [" " + token for token in tokenizer.vocabulary]
+        else:
+            strings = [tokenizer.decode([i]) for i in range(len(tokenizer))]
+        self.word_start = np.array([s.startswith(" ") for s in strings])
+        self.slash = np.array(["/" in s for s in strings])
+
+    def __call__(self, row: np.ndarray) -> np.ndarray:
+        """Positions of the measure starts of a row."""
+        word_start = self.word_start[row]
+        # The row itself starts a word
+        word_start[:1] = True
+        words = np.flatnonzero(word_start)
+        slashes = np.flatnonzero(self.slash[row])
+        return np.unique(words[np.searchsorted(words, slashes, side="right") - 1])
+
+
+class PackedDataset:
+    """
+    Rows packed into blocks of block_size tokens, see above. Rows are
+    shuffled first: consecutive rows of the dataset are overlapping windows
+    of the same part, packed together a block would repeat itself.
+
+    Items have the input_ids, attention_mask and labels of a block, all
+    blocks have the same length so default_data_collator batches them as
+    they are.
+    """
+
+    def __init__(
+        self,
+        rows: List[np.ndarray],
+        tokenizer,
+        block_size: int = BLOCK_SIZE,
+        seed: int = SEED,
+    ) -> None:
+        self.block_size = block_size
+        self.separator = tokenizer.eos_token_id
+        pad = tokenizer.pad_token_id
+        self.pad = self.separator if pad is None else pad
+        self.boundaries = MeasureBoundaries(tokenizer)
+        self.n_row_tokens = sum(len(row) for row in rows)
+
+        # Per block its tokens and which of them are separators
+        self.blocks: List[np.ndarray] = []
+        self.separators: List[np.ndarray] = []
+        self.pieces: List[np.ndarray] = []
+        self.used = 0
+        order = list(range(len(rows)))
+        random.Random(seed).shuffle(order)
+        for i in order:
+            self.add_row(np.asarray(rows[i]))
+        self.end_block()
+
+        # Blocks are kept as token ids and expanded to items when used
+        self.lengths = np.array([len(block) for block in self.blocks])
+        self.input_ids = np.full((len(self.blocks), block_size), self.pad, dtype=np.int32)
+        self.is_separator = np.zeros((len(self.blocks), block_size), dtype=bool)
+        for i, (block, separators) in enumerate(zip(self.blocks, self.separators)):
+            self.input_ids[i, : len(block)] = block
+            self.is_separator[i, : len(block)] = separators
+        del self.blocks, self.separators
+
+    def add_row(self, row: np.ndarray) -> None:
+        while len(row):
+            # Rows after the first of a block follow a separator
+            separator = 1 if self.used else 0
+            space = self.block_size - self.used - separator
+            if len(row) <= space:
+                self.add_piece(row, separator)
+                return
+
+            # Cut before the last measure that still starts inside the block
+            starts = self.boundaries(row)
+            starts = starts[(starts > 0) & (starts <= space)]
+            if len(starts):
+                cut = starts[-1]
+            elif not self.used:
+                # A measure longer than a block is cut anywhere
+                cut = space
+            else:
+                cut = 0
+            if cut:
+                self.add_piece(row[:cut], separator)
+                row = row[cut:]
+            self.end_block()
+
+    def add_piece(self, piece: np.ndarray, separator: int) -> None:
+        if separator:
+            self.pieces.append(np.array([-1]))
+        self.pieces.append(piece)
+        self.used += separator + len(piece)
+
+    def end_block(self) -> None:
+        if not self.pieces:
+            return
+        block = np.concatenate(self.pieces)
+        separators = block == -1
+        block[separators] = self.separator
+        self.blocks.append(block)
+        self.separators.append(separators)
+        self.pieces = []
+        self.used = 0
+
+    def __len__(self) -> int:
+        return len(self.input_ids)
+
+    def __getitem__(self, i: int) -> Dict[str, np.ndarray]:
+        input_ids = self.input_ids[i].astype(np.int64)
+        attention_mask = np.zeros(self.block_size, dtype=np.int64)
+        attention_mask[: self.lengths[i]] = 1
+        labels = np.where(self.is_separator[i], IGNORE_INDEX, input_ids)
+        labels[self.lengths[i] :] = IGNORE_INDEX
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "labels": labels,
+        }
+
+    @property
+    def padding_ratio(self) -> float:
+        """Share of the tokens of the blocks that are not tokens of rows."""
+        return 1 - self.n_row_tokens / self.input_ids.size
+
+
+def load_rows(path: str = DATASET_PATH, tokenizer=None) -> List[np.ndarray]:
+    """
+    Token ids of every row of a text dataset, or of a shard directory
+    written by generate_dataset.py. Rows are not truncated, packing keeps all
+    of their tokens.
+    """
+    if os.path.isdir(path):
+        shards = ShardDataset(path)
+        return [shards.row(i) for i in range(len(shards))]
+
+    tokenizer = tokenizer if tokenizer is not None else load_tokenizer()
+    with open(path, "r") as f:
+        lines = [line for line in f.read().split("\n") if line]
+    rows = []
+    for start in range(0, len(lines), TOKENIZE_BATCH):
+        for ids in tokenizer(lines[start : start + TOKENIZE_BATCH])["input_ids"]:
+            rows.append(np.asarray(ids, dtype=TOKEN_DTYPE))
+    return rows
+
+
+def random_batches(n_rows: int, batch_size: int = BATCH_SIZE, rng=random) -> List[List[int]]:
+    order = list(range(n_rows))
+    rng.shuffle(order)
+    return [order[i : i + batch_size] for i in range(0, n_rows, batch_size)]
+
+
+def bucket_batches(
+    lengths: List[int],
+    batch_size: int = BATCH_SIZE,
+    rng=random,
+    bucket_batches: int = BUCKET_BATCHES,
+) -> List[List[int]]:
+    """
+    Batches of rows of similar lengths. Rows are shuffled, then sorted by
+    length in groups of bucket_batches batches, so batches stay random
+    while their rows are close in length.
+    """
+    order = list(range(len(lengths)))
+    rng.shuffle(order)
+    size = batch_size * bucket_batches
+    batches = []
+    for start in range(0, len(order), size):
+        group = sorted(order[start : start + size], key=lambda i: -lengths[i])
+        batches += [group[i : i + batch_size] for i in range(0, len(group), batch_size)]
+    rng.shuffle(batches)
+    return batches
+
+
+def padding_ratio(lengths: List[int], batches: List[List[int]]) -> float:
+    """Share of padding in batches padded to their longest row."""
+    real = sum(lengths[i] for batch in batches for i in batch)
+    total = sum(max(lengths[i] for i in batch) * len(batch) for batch in batches)
+    return 1 - real / total
+
+
+def report(
+    rows: List[np.ndarray],
+    tokenizer,
+    block_size: int = BLOCK_SIZE,
+    batch_size: int = BATCH_SIZE,
+    seed: int = SEED,
+) -> Dict[str, Tuple[float, float]]:
+    """Padding ratio and row tokens per batch of every way to batch rows."""
+    rng = random.Random(seed)
+    # Random batches of rows truncated to the context, like the notebook
+    lengths = [min(len(row), block_size) for row in rows]
+    n_row_tokens = sum(len(row) for row in rows)
+    n_truncated = n_row_tokens - sum(lengths)
+    results = {}
+    for name, batches in (
+        ("random", random_batches(len(rows), batch_size, rng)),
+        ("bucket", bucket_batches(lengths, batch_size, rng)),
+    ):
+        results[name] = (padding_ratio(lengths, batches), sum(lengths) / len(batches))
+
+    packed = PackedDataset(rows, tokenizer, block_size, seed)
+    n_batches = -(-len(packed) // batch_size)
+    results["pack"] = (packed.padding_ratio, n_row_tokens / n_batches)
+
+    print(f"{len(rows)} rows with {n_row_tokens} tokens, batches of {batch_size}")
+    print(f"Truncating rows to {block_size} tokens drops {n_truncated} tokens")
+    for name, (ratio, tokens) in results.items():
+        print(f"{name}: {ratio:.1%} padding, {tokens:.0f} row tokens per batch")
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Report the padding of packed and bucketed training batches.")
+    parser.add_argument("path", nargs="?", default=DATASET_PATH, help="Text dataset or shard directory")
+    parser.add_argument("--tokenizer", choices=TOKENIZERS, default=TOKENIZER)
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--seed", type=int, default=SEED)
+    args = parser.parse_args()
+
+    tokenizer = NoteTokenizer() if args.tokenizer == "notes" else load_tokenizer()
+    rows = load_rows(args.path, tokenizer)
+    report(rows, tokenizer, args.block_size, args.batch_size, args.seed)